@@ -1,4 +1,15 @@
-from django.http import HttpResponseServerError, JsonResponse
+import hmac
+import ipaddress
+
+from common.metrics import registry
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseServerError,
+    JsonResponse,
+)
 
 
 def ping(request):
@@ -13,3 +24,37 @@ def always_500(request):
     A health check endpoint that returns 500
     """
     return HttpResponseServerError()
+
+
+def can_read_metrics(request) -> bool:
+    """
+    Whether the request has the metrics token or comes from an allowed peer
+    """
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if token and hmac.compare_digest(authorization, f'Bearer {token}'):
+        return True
+
+    try:
+        ip = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(
+        ip in ipaddress.ip_network(network, strict=False)
+        for network in settings.METRICS_ALLOWED_IPS
+    )
+
+
+def metrics(request):
+    """
+    Metrics of the process in Prometheus text format
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from .apis import metrics
+
+
+@override_settings(
+    METRICS_ENABLED=True, METRICS_TOKEN='secret', METRICS_ALLOWED_IPS=['10.0.0.0/8']
+)
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+
+    def test_anonymous_is_forbidden(self):
+        request = self.factory.get('/metrics/', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(metrics(request).status_code, 403)
+
+    def test_forwarded_address_is_not_trusted(self):
+        request = self.factory.get(
+            '/metrics/', REMOTE_ADDR='192.0.2.1', HTTP_X_FORWARDED_FOR='10.0.0.1'
+        )
+        self.assertEqual(metrics(request).status_code, 403)
+
+    def test_token_or_allowed_peer_reads(self):
+        requests = [
+            self.factory.get(
+                '/metrics/', REMOTE_ADDR='192.0.2.1', HTTP_AUTHORIZATION='Bearer secret'
+            ),
+            self.factory.get('/metrics/', REMOTE_ADDR='10.1.2.3'),
+        ]
+        for request in requests:
+            self.assertEqual(metrics(request).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='', METRICS_ALLOWED_IPS=[])
+    def test_nobody_reads_without_settings(self):
+        request = self.factory.get('/metrics/', HTTP_AUTHORIZATION='Bearer ')
+        self.assertEqual(metrics(request).status_code, 403)
@@ -4,4 +4,5 @@ from django.urls import include, path
 urlpatterns = [
     path('auth/', include('authentication.urls')),
     path('ping/', apis.ping, name='ping'),
+    path('metrics/', apis.metrics, name='metrics'),
 ]
@@ -1,9 +1,11 @@
 from rest_framework import serializers
-from user.models import User
+from user.models import User, phone_number_validator
 
 
 class PhoneNumberSerializer(serializers.Serializer):
-    phone_number = serializers.CharField(max_length=15)
+    phone_number = serializers.CharField(
+        max_length=15, validators=[phone_number_validator]
+    )
 
 
 class VerifyOTPSerializer(PhoneNumberSerializer):
@@ -2,40 +2,32 @@ import logging
 import random
 
 from common.cache.redis_cache import CacheManagement
-from django.conf import settings
-from kavenegar import APIException, HTTPException, KavenegarAPI
+from common.sms import sms_client
 
 logger = logging.getLogger(__name__)
 cache = CacheManagement()
 
+OTP_TTL = 120  # seconds
+
 
 def generate_otp(length=6):
     """Generate a random numeric OTP of specified length"""
     return ''.join(random.choices('0123456789', k=length))
 
 
-def cache_otp(phone_number, otp, ttl=120):
+def cache_otp(phone_number, otp, ttl=OTP_TTL):
     """Cache OTP in Redis with phone number as key"""
     key = f"otp:{phone_number}"
     cache.set_key(key, otp, ttl)
     return True
 
 
+def get_otp(phone_number):
+    """Return the cached OTP of a phone number, None when there is none"""
+    return cache.get_key(f"otp:{phone_number}") or None
+
+
 def send_otp_sms(phone_number, otp):
-    """Send OTP via Kaveh Negar SMS service"""
-    if not hasattr(settings, 'KAVEH_NEGAR_API_KEY'):
-        raise ValueError("Kaveh Negar API key not configured")
-
-    try:
-        api = KavenegarAPI(settings.KAVEH_NEGAR_API_KEY)
-        params = {
-            'sender': '2000660110',
-            'receptor': phone_number,
-            'message': f'Your verification code is: {otp}',
-        }
-        response = api.sms_send(params)
-        logger.info(f"OTP sent to {phone_number}: {response}")
-        return True
-    except (APIException, HTTPException) as e:
-        logger.error(f"Kaveh Negar API error: {e}")
-        return False
+    """Send OTP via the SMS provider, raise SMSError when it is not sent"""
+    sms_client.deliver(phone_number, f'Your verification code is: {otp}')
+    return True
@@ -0,0 +1,26 @@
+from common.cache import PermanentError, TaskQueue
+from common.sms import SMSError
+
+from .services import OTP_TTL, get_otp, send_otp_sms
+
+sms_queue = TaskQueue('sms')
+
+
+@sms_queue.task(expires=OTP_TTL)
+def deliver_otp(phone_number):
+    """
+    Send the cached OTP of a phone number from the sms queue, only transient
+    errors are retried. The OTP is not a job argument, so it is not kept in
+    the queue or its dead letters.
+    """
+    if (otp := get_otp(phone_number)) is None:
+        # expired or already used
+        return True
+
+    try:
+        return send_otp_sms(phone_number, otp)
+    except SMSError as e:
+        if e.transient:
+            raise
+        # a rejected SMS fails again and a timed out one may have been sent
+        raise PermanentError(str(e)) from e
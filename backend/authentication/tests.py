@@ -1,7 +1,16 @@
+import json
+import time
 from unittest.mock import patch
 
+from authentication.services import cache_otp
+from authentication.tasks import deliver_otp, sms_queue
+from common.cache.middleware import RateLimitMiddleware
 from common.cache.redis_cache import CacheManagement
-from django.test import TestCase
+from common.sms import SMSClient, SMSError
+from common.sms.fake import FakeSMSProvider
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -16,12 +25,15 @@ class AuthenticationTests(TestCase):
         self.phone_number = '+989123456789'
         self.valid_otp = '123456'
         self.cache = CacheManagement()
+        # the limits of the OTP routes count every request of the suite
+        self.cache.remove_pattern_key('RATELIMIT:*')
 
     def tearDown(self):
         # Clear cache after each test
         self.cache.remove_key(f'otp:{self.phone_number}')
+        sms_queue.purge()
 
-    @patch('authentication.services.send_otp_sms')
+    @patch('authentication.tasks.send_otp_sms')
     def test_request_otp_success(self, mock_send_otp):
         mock_send_otp.return_value = True
 
@@ -56,21 +68,24 @@ class AuthenticationTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('phone_number', response.data)
 
-    @patch('authentication.services.send_otp_sms')
-    def test_request_otp_sms_failure(self, mock_send_otp):
-        mock_send_otp.return_value = False
+    @patch('authentication.tasks.send_otp_sms')
+    def test_request_otp_sms_is_queued(self, mock_send_otp):
+        mock_send_otp.side_effect = SMSError('HTTP 503', transient=True)
 
+        # the provider is not called in the request, its failure is retried
         response = self.client.post(
             self.request_otp_url,
             {'phone_number': self.phone_number},
             format='json',
         )
-        self.assertEqual(
-            response.status_code,
-            status.HTTP_500_INTERNAL_SERVER_ERROR,
-        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_send_otp.assert_not_called()
 
-    @patch('authentication.services.send_otp_sms')
+        self.assertTrue(sms_queue.run_once())
+        otp = self.cache.get_key(f'otp:{self.phone_number}')
+        mock_send_otp.assert_called_once_with(self.phone_number, otp)
+
+    @patch('authentication.tasks.send_otp_sms')
     def test_verify_otp_success(self, mock_send_otp):
         mock_send_otp.return_value = True
 
@@ -128,3 +143,86 @@ class AuthenticationTests(TestCase):
             format='json',
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DeliverOTPTests(TestCase):
+    def setUp(self):
+        self.provider = FakeSMSProvider().start()
+        self.client = SMSClient(url=self.provider.url, api_key='tests')
+        patcher = patch('authentication.services.sms_client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.phone_number = '+989123456789'
+        cache_otp(self.phone_number, '123456')
+
+    def tearDown(self):
+        self.client.close()
+        self.provider.stop()
+        sms_queue.purge()
+        CacheManagement().remove_key(f'otp:{self.phone_number}')
+
+    def deliver(self):
+        job = deliver_otp.delay(self.phone_number)
+        sms_queue.work(burst=True)
+        return job
+
+    def test_cached_otp_is_sent(self):
+        job = self.deliver()
+
+        self.assertEqual(sms_queue.status(job), 'done')
+        self.assertIn('123456', self.provider.messages[0]['message'])
+
+    def test_otp_is_not_kept_in_the_queue(self):
+        self.provider.fail(400)
+        job = self.deliver()
+
+        letter = sms_queue.dead_letters()[job]
+        self.assertNotIn('123456', json.dumps(letter))
+        self.assertNotIn(self.phone_number, json.dumps(letter))
+
+    def test_used_otp_is_not_sent(self):
+        CacheManagement().remove_key(f'otp:{self.phone_number}')
+
+        job = self.deliver()
+        self.assertEqual(sms_queue.status(job), 'done')
+        self.assertEqual(self.provider.messages, [])
+
+    def test_timed_out_sms_is_not_sent_again(self):
+        self.provider.latency = 0.3
+        self.client.timeout = (1, 0.1)
+
+        job = self.deliver()
+        self.assertEqual(sms_queue.status(job), 'dead')
+        self.assertEqual(sms_queue.dead_letters()[job]['attempts'], 1)
+
+        time.sleep(0.4)  # the provider accepts it after the timeout
+        self.assertEqual(len(self.provider.messages), 1)
+
+    def test_rejected_sms_is_dead_lettered(self):
+        self.provider.fail(400)
+
+        job = self.deliver()
+        self.assertEqual(sms_queue.status(job), 'dead')
+        self.assertEqual(sms_queue.dead_letters()[job]['attempts'], 1)
+        self.assertEqual(self.provider.messages, [])
+
+    def test_unavailable_provider_is_retried(self):
+        self.client.attempts = 1
+        self.provider.fail(503)
+
+        job = deliver_otp.delay(self.phone_number)
+        sms_queue.run_once()
+        self.assertEqual(sms_queue.status(job), 'retrying')
+
+
+class AuthRouteLimitTests(TestCase):
+    def tearDown(self):
+        CacheManagement().remove_pattern_key('RATELIMIT:*')
+
+    def test_auth_requests_are_limited_before_the_view(self):
+        middleware = RateLimitMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().post(reverse('verify_otp'), 'not', 'text/plain')
+        rate = settings.RATELIMIT_AUTH_ROUTE_RATE
+
+        statuses = [middleware(request).status_code for _ in range(rate + 1)]
+        self.assertEqual(statuses, [200] * rate + [429])
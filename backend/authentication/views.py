@@ -1,4 +1,4 @@
-from common.cache import CacheManagement, RateLimit
+from common.cache import CacheManagement, Policy, RateLimit, by_field, by_ip, by_subnet
 from django.conf import settings
 from drf_spectacular.utils import OpenApiExample, OpenApiResponse, extend_schema
 from rest_framework import status
@@ -8,7 +8,8 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from user.models import User
 
 from .serializers import PhoneNumberSerializer, VerifyOTPSerializer
-from .services import cache_otp, generate_otp, send_otp_sms
+from .services import cache_otp, generate_otp
+from .tasks import deliver_otp
 
 
 class RequestOTPView(APIView):
@@ -23,7 +24,7 @@ class RequestOTPView(APIView):
         request=PhoneNumberSerializer,
         responses={
             200: OpenApiResponse(
-                description="OTP sent successfully.",
+                description="OTP generated and queued for sending.",
                 response=dict,  # Use `dict` for simple inline object or define a schema
                 examples=[
                     OpenApiExample(
@@ -61,24 +62,39 @@ class RequestOTPView(APIView):
                     )
                 ],
             ),
-            500: OpenApiResponse(
-                description="Internal Server Error: Failed to send OTP.",
-                response=dict,
-                examples=[
-                    OpenApiExample(
-                        'SMS Send Failure',
-                        value={"error": "Failed to send OTP"},
-                        response_only=True,
-                        status_codes=["500"],
-                    )
-                ],
-            ),
         },
     )
     @RateLimit(
-        rate=settings.RATELIMIT_USER_RATE,
-        window=settings.RATELIMIT_USER_WINDOW,
-        freeze=settings.RATELIMIT_USER_FREEZE,
+        policies=(
+            Policy(
+                'ip',
+                settings.RATELIMIT_USER_RATE,
+                settings.RATELIMIT_USER_WINDOW,
+                by_ip(),
+                freeze=settings.RATELIMIT_USER_FREEZE,
+            ),
+            Policy(
+                'phone_number',
+                settings.RATELIMIT_OTP_PHONE_RATE,
+                settings.RATELIMIT_OTP_PHONE_WINDOW,
+                by_field('phone_number'),
+                freeze=settings.RATELIMIT_USER_FREEZE,
+            ),
+            Policy(
+                'subnet',
+                settings.RATELIMIT_OTP_SUBNET_RATE,
+                settings.RATELIMIT_OTP_SUBNET_WINDOW,
+                by_subnet(),
+            ),
+            Policy(
+                'global',
+                settings.RATELIMIT_OTP_GLOBAL_RATE,
+                settings.RATELIMIT_OTP_GLOBAL_WINDOW,
+                algorithm='gcra',
+            ),
+        ),
+        # no SMS is sent while the limits can not be checked
+        fail_open=False,
     )
     def post(self, request):
         serializer = PhoneNumberSerializer(data=request.data)
@@ -98,11 +114,9 @@ class RequestOTPView(APIView):
         otp = generate_otp()
         cache_otp(phone_number, otp)
 
-        # Send OTP via SMS
-        if not send_otp_sms(phone_number, otp):
-            error_msg = {"error": "Failed to send OTP"}
-            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            return Response(error_msg, status=status_code)
+        # Send OTP via SMS, the sms queue workers call the provider and
+        # retry it off the request
+        deliver_otp.delay(phone_number)
 
         return Response(
             {"message": "OTP sent successfully"},
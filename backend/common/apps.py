@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class CommonConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "common"
+
+    def ready(self):
+        from common.cache.lookup import lookup_cache
+
+        lookup_cache.connect()
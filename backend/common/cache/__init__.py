@@ -1,4 +1,18 @@
-from common.cache.rate_limit import RateLimit  # noqa
+from common.cache.async_redis_cache import AsyncCacheManagement  # noqa
+from common.cache.limiters import Policy  # noqa
+from common.cache.rate_limit import (  # noqa
+    RateLimit,
+    by_field,
+    by_ip,
+    by_subnet,
+    by_user,
+)
+from common.cache.queue import PermanentError, TaskQueue  # noqa
 from common.cache.redis_cache import CacheManagement  # noqa
 from common.cache.redis_decorator import ApiCache  # noqa
-from common.cache.redis_lock import CacheLock  # noqa
+from common.cache.redis_lock import AsyncCacheLock, CacheLock, LockTimeout  # noqa
+from common.cache.redis_semaphore import (  # noqa
+    AsyncCacheSemaphore,
+    CacheSemaphore,
+    provider_semaphore,
+)
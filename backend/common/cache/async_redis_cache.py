@@ -0,0 +1,271 @@
+from typing import Any, Iterable, Optional
+
+from common.cache.codecs import ValueSerializer
+from common.cache.connection import async_redis_connections
+from common.cache.local_cache import local_caches
+from common.cache.redis_cache import CacheManagement
+from django.conf import settings
+from django.db.models.base import ModelBase
+from redis.exceptions import NoScriptError
+
+
+class AsyncCacheManagement:
+    """
+    The asyncio version of CacheManagement for async views. It uses the same
+    key names, tags and value encoding, so both can share the cached data.
+    The client of the running event loop is used for every call.
+    """
+
+    default_ttl = settings.REDIS_CACHE_LONG_TTL
+    tag_prefix = settings.REDIS_CACHE_TAG_PREFIX
+    batch_size = settings.REDIS_CACHE_DELETE_BATCH_SIZE
+
+    tag_name = CacheManagement.tag_name
+    _tag_commands = CacheManagement._tag_commands
+    _publish_commands = CacheManagement._publish_commands
+    _encode = CacheManagement._encode
+    _decode = CacheManagement._decode
+
+    def __init__(
+        self,
+        *,
+        db: int = 0,
+        codec: str = settings.REDIS_CACHE_CODEC,
+        compress_threshold: Optional[int] = settings.REDIS_CACHE_COMPRESS_THRESHOLD,
+    ):
+        self.serializer = ValueSerializer(
+            codec=codec,
+            compressor=settings.REDIS_CACHE_COMPRESSOR,
+            threshold=compress_threshold,
+        )
+        self.number = db
+        self.local = local_caches[db] if settings.REDIS_LOCAL_CACHE_ENABLED else None
+
+    @property
+    def db(self):
+        return async_redis_connections.con_db(self.number)
+
+    def pipeline(self, transaction: bool = True):
+        transaction = transaction and async_redis_connections.transactions
+        return self.db.pipeline(transaction=transaction)
+
+    async def _invalidate(self, *keys: str, publish: bool = True) -> None:
+        """
+        Evict changed keys from the local caches of all processes (of this
+        one only when the message was sent with the write)
+        """
+        if self.local and keys:
+            if (message := self.local.invalidation(list(keys))) and publish:
+                await self.db.publish(*message)
+
+    async def _command_many(self, commands: list, invalidate: tuple = ()) -> Any:
+        """
+        Send (name, args, kwargs) commands in one round trip and return the
+        result of the first one
+        """
+        publish = self._publish_commands(invalidate)
+        pipe = self.pipeline()
+        for name, args, kwargs in [*commands, *publish]:
+            getattr(pipe, name)(*args, **kwargs)
+
+        result = (await pipe.execute())[0]
+        await self._invalidate(*invalidate, publish=not publish)
+        return result
+
+    async def set_expire(self, key: str, ttl: int) -> bool:
+        return await self.db.expire(key, ttl)
+
+    async def is_exists(self, key) -> bool:
+        """
+        Check if the key exists in the cache or not
+        """
+        return bool(await self.db.exists(key))
+
+    async def set_key(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[int] = default_ttl,
+        tags: Iterable = (),
+    ) -> bool:
+        """
+        Set the key:value data with an optional TTL
+        """
+        value = self._encode(value)
+        commands = [
+            ('set', (key, value), {'ex': ttl or None}),
+            *self._tag_commands(key, tags, ttl),
+        ]
+        return await self._command_many(commands, invalidate=(key,))
+
+    async def setnx_key(
+        self, key: str, value: Any, ttl: Optional[int] = default_ttl
+    ) -> bool:
+        """
+        Set the key:value data if the key does not exist
+        """
+        value = self._encode(value)
+        result = await self.db.set(key, value, nx=True, ex=ttl or None)
+        await self._invalidate(key)
+        return bool(result)
+
+    async def get_key(self, key: str) -> Any:
+        """
+        Return data of a key
+        """
+        data = await self.db.execute_command('GET', key, NEVER_DECODE=True)
+        return self._decode(data)
+
+    async def incr_key(self, key: str, value: int = 1) -> int:
+        """
+        Increase value of a key by given number
+        """
+        result = await self.db.incr(key, value)
+        await self._invalidate(key)
+        return result
+
+    async def remove_key(self, key: str | ModelBase) -> int:
+        """
+        Delete a key from cache (it can be str or django model class)
+        """
+        if isinstance(key, ModelBase):
+            removed = await self._unlink([f'{key.__name__}:all'])
+            return removed + await self.invalidate_tags(key)
+
+        result = await self.db.unlink(key)
+        await self._invalidate(key)
+        return result
+
+    async def _unlink(self, keys: list, tag_name: Optional[str] = None) -> int:
+        """
+        Delete keys in pipelined batches (and remove them from the tag)
+        """
+        pipe = self.pipeline(transaction=False)
+
+        for start in range(0, len(keys), self.batch_size):
+            end = start + self.batch_size
+            for batch in async_redis_connections.group_keys(keys[start:end]):
+                pipe.unlink(*batch)
+                pipe.zrem(tag_name, *batch) if tag_name else None
+
+        result = await pipe.execute()
+        await self._invalidate(*keys)
+        return sum(result[::2] if tag_name else result)
+
+    async def remove_pattern_key(self, pattern: str) -> None:
+        """
+        Delete keys from cache follow with a pattern
+        """
+        keys = [
+            key async for key in self.db.scan_iter(match=pattern, count=self.batch_size)
+        ]
+        await self._unlink(keys) if keys else None
+
+    async def tag_keys(
+        self, key: str, *tags: str | ModelBase, ttl: Optional[int] = None
+    ):
+        """
+        Register an existing key under the given tags
+        """
+        commands = self._tag_commands(key, tags, ttl)
+        return await self._command_many(commands) if commands else None
+
+    async def invalidate_tags(self, *tags: str | ModelBase) -> int:
+        """
+        Delete every key registered under the given tags
+        """
+        removed = 0
+
+        for tag in tags:
+            tag_name = self.tag_name(tag)
+
+            if keys := await self.db.zrange(tag_name, 0, -1):
+                removed += await self._unlink(keys, tag_name)
+
+        return removed
+
+    async def hset(
+        self,
+        hash_name: str,
+        mapping: dict,
+        ttl: Optional[int] = None,
+        tags: Iterable = (),
+    ) -> bool:
+        """
+        Storing data as HashMap structure
+        """
+        commands = [
+            ('hset', (hash_name,), {'mapping': mapping}),
+            *([('expire', (hash_name, ttl), {})] if ttl else []),
+            *self._tag_commands(hash_name, tags, ttl),
+        ]
+        return await self._command_many(commands, invalidate=(hash_name,))
+
+    async def hset_key(
+        self, hash_name: str, key: str, value: str, ttl: Optional[int] = None
+    ) -> bool:
+        """
+        Storing a field in HashMap structure
+        """
+        commands = [
+            ('hset', (hash_name, key, value), {}),
+            *([('expire', (hash_name, ttl), {})] if ttl else []),
+        ]
+        return await self._command_many(commands, invalidate=(hash_name,))
+
+    async def hget(self, hash_name: str, raw: bool = False) -> dict:
+        """
+        Reading data of HashMap structure (`raw` keeps the values as bytes)
+        """
+        if not raw:
+            return await self.db.hgetall(hash_name)
+
+        data = await self.db.execute_command('HGETALL', hash_name, NEVER_DECODE=True)
+        return {key.decode(): value for key, value in data.items()}
+
+    async def hget_key(self, hash_name: str, key: str) -> str | None:
+        """
+        Reading a field of HashMap structure
+        """
+        return await self.db.hget(hash_name, key)
+
+    async def hget_keys(self, hash_name: str, *keys: str) -> list:
+        """
+        Reading some fields of HashMap structure
+        """
+        return await self.db.hmget(hash_name, keys)
+
+    async def hdel(self, hash_name: str) -> int:
+        """
+        Delete a HashMap data
+        """
+        result = await self.db.delete(hash_name)
+        await self._invalidate(hash_name)
+        return result
+
+    async def hdel_key(self, hash_name: str, key: str) -> int:
+        """
+        Delete a field of HashMap structure
+        """
+        result = await self.db.hdel(hash_name, key)
+        await self._invalidate(hash_name)
+        return result
+
+    async def hincr_key(self, hash_name: str, key: str, amount: int = 1) -> int:
+        """
+        Increase value of a key in HashMap structure
+        """
+        result = await self.db.hincrby(hash_name, key, amount)
+        await self._invalidate(hash_name)
+        return result
+
+    async def run_script(self, script, keys: list, args: list) -> Any:
+        """
+        Run a LuaScript atomically on the server, it is loaded when the
+        server does not have it yet
+        """
+        try:
+            return await self.db.evalsha(script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            await self.db.script_load(script.source)
+            return await self.db.evalsha(script.sha, len(keys), *keys, *args)
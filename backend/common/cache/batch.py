@@ -0,0 +1,134 @@
+import logging
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from .metrics import deferred_write_errors
+
+logger = logging.getLogger(__name__)
+
+_pending = object()
+
+
+class CacheFuture:
+    """
+    Result of a command that was queued in a batch. It is resolved when the
+    batch is flushed.
+    """
+
+    def __init__(self, callback: Optional[Callable] = None) -> None:
+        self._callback = callback
+        self._value = _pending
+
+    @classmethod
+    def resolved(cls, value: Any) -> 'CacheFuture':
+        future = cls()
+        future._value = value
+        return future
+
+    @property
+    def done(self) -> bool:
+        return self._value is not _pending
+
+    def set_result(self, value: Any) -> None:
+        if not isinstance(value, Exception) and self._callback:
+            value = self._callback(value)
+        self._value = value
+
+    def result(self) -> Any:
+        """
+        Return the result of the command (or raise its error)
+        """
+        if self._value is _pending:
+            raise RuntimeError('The batch of this command is not flushed yet')
+
+        if isinstance(self._value, Exception):
+            raise self._value
+
+        return self._value
+
+
+class CacheBatch:
+    """
+    Commands queued on one pipeline of a Redis database and sent to the
+    server in a single round trip on flush. The error of a command is kept
+    in its future, and logged and counted since writes are rarely read.
+    """
+
+    def __init__(self, db, deferred: bool = False) -> None:
+        self.db = db
+        self.deferred = deferred
+        self.pipe = db.pipeline(transaction=False)
+        self.futures = []
+
+    def queue(self, name: str, *args, callback=None, **kwargs) -> CacheFuture:
+        getattr(self.pipe, name)(*args, **kwargs)
+        future = CacheFuture(callback)
+        self.futures.append(future)
+        return future
+
+    def flush(self) -> None:
+        if not self.futures:
+            return
+
+        futures, self.futures = self.futures, []
+        results = self.pipe.execute(raise_on_error=False)
+
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                logger.warning(f'Batched cache command failed: {result}')
+                deferred_write_errors.inc(error=type(result).__name__)
+            future.set_result(result)
+
+
+@dataclass
+class BatchScope:
+    """
+    The batches that are open in the current context.
+
+    A deferred scope (opened by the request middleware) creates a batch for
+    every database on first use; writes are queued and reads flush the
+    queue together with themselves. An explicit scope (CacheManagement.batch)
+    holds the batch of one database whose reads return futures too.
+    """
+
+    deferred: bool
+    batches: dict = field(default_factory=dict)
+    parent: Optional['BatchScope'] = None
+
+    def get(self, number: int, db) -> Optional[CacheBatch]:
+        if (batch := self.batches.get(number)) is not None:
+            return batch
+
+        if self.deferred:
+            batch = self.batches[number] = CacheBatch(db, deferred=True)
+            return batch
+
+        return self.parent.get(number, db) if self.parent else None
+
+    def flush(self) -> None:
+        """
+        Flush every batch, the first error is raised after all of them
+        """
+        error = None
+        for batch in self.batches.values():
+            try:
+                batch.flush()
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+
+current_scope: ContextVar[Optional[BatchScope]] = ContextVar(
+    'cache_batch_scope', default=None
+)
+
+
+def get_batch(number: int, db) -> Optional[CacheBatch]:
+    """
+    Return the open batch of a database in the current context
+    """
+    scope = current_scope.get()
+    return scope.get(number, db) if scope else None
@@ -0,0 +1,175 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from common.metrics import registry
+from django.conf import settings
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+from .metrics import circuit_rejected, circuit_transitions
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of sending a command to a server that is failing
+    """
+
+    def __init__(self, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PoolExhaustedError(ConnectionError):
+    """
+    No connection of the pool was free in time, the workers are busy but
+    the server is not known to fail
+    """
+
+
+class CircuitBreaker:
+    """
+    Stop calling a Redis server after `failures` connection errors or
+    timeouts in a row, so a slow server costs a quick error instead of a
+    socket timeout in every worker. After `reset_timeout` seconds one
+    command is let through as a probe: it closes the circuit when it
+    succeeds and opens it again when it fails.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failures: int = settings.REDIS_BREAKER_FAILURES,
+        reset_timeout: float = settings.REDIS_BREAKER_RESET_TIMEOUT,
+    ) -> None:
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failed = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            self.state = state
+            circuit_transitions.inc(node=self.name, state=state)
+
+    def allow(self) -> bool:
+        """
+        Whether a command may be sent, the first one after the reset
+        timeout becomes the probe
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            # a probe that did not finish is replaced after the timeout too
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()
+                self._set_state(HALF_OPEN)
+                return True
+
+            circuit_rejected.inc(node=self.name)
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failed = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failed += 1
+            if self.state == HALF_OPEN or self.failed >= self.failures:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    @property
+    def retry_after(self) -> float:
+        """
+        Seconds until the next probe
+        """
+        if self.state == CLOSED:
+            return 0
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    @contextmanager
+    def guard(self):
+        """
+        Run a command through the breaker
+        """
+        if not self.allow():
+            retry_after = self.retry_after
+            raise CircuitOpenError(
+                f'Circuit of Redis {self.name} is open, '
+                f'retry in {retry_after:.1f} seconds',
+                retry_after,
+            )
+
+        try:
+            yield
+        except PoolExhaustedError:
+            raise
+        except (ConnectionError, TimeoutError):
+            self.record_failure()
+            raise
+        except ResponseError:
+            # an error reply still means the server is up
+            self.record_success()
+            raise
+        else:
+            self.record_success()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def breaker_named(name: str) -> CircuitBreaker:
+    """
+    Return the breaker of a server by its `host:port`
+    """
+    if (breaker := breakers.get(name)) is None:
+        with breakers_lock:
+            breaker = breakers.setdefault(name, CircuitBreaker(name))
+
+    return breaker
+
+
+def breaker_for(pool) -> CircuitBreaker:
+    """
+    Return the breaker of the server of a connection pool
+    """
+    options = pool.connection_kwargs
+    return breaker_named(
+        f'{options.get("host", "localhost")}:{options.get("port", 6379)}'
+    )
+
+
+@contextmanager
+def guard(pool=None, node: str = ''):
+    """
+    Run a command to the server of the pool (or the `host:port` node of a
+    cluster) through its breaker (REDIS_BREAKER_ENABLED)
+    """
+    if not settings.REDIS_BREAKER_ENABLED:
+        yield
+        return
+
+    breaker = breaker_named(node) if node else breaker_for(pool)
+    with breaker.guard():
+        yield
+
+
+registry.gauge(
+    'redis_circuit_state',
+    'State of the circuit breaker of every Redis server '
+    '(0 closed, 1 half open, 2 open)',
+    labels=('node',),
+    collect=lambda: [
+        ({'node': name}, STATES[breaker.state]) for name, breaker in breakers.items()
+    ],
+)
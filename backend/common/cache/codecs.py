@@ -0,0 +1,206 @@
+import json
+import pickle
+import zlib
+from typing import Any, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+# 0xFE never appears in UTF-8, so a framed value can not be mistaken for the
+# plain JSON text that is stored for small values
+MAGIC = b'\xfe'
+
+
+class RawCodec:
+    """
+    Bytes stored as they are (used for rendered ApiCache bodies)
+    """
+
+    id = 0
+    name = 'raw'
+    plain = True
+
+    def dumps(self, value: bytes) -> bytes:
+        return value
+
+    def loads(self, data: bytes) -> bytes:
+        return data
+
+
+class JSONCodec:
+    """
+    JSON, encoded with orjson when it is installed
+    """
+
+    id = 1
+    name = 'json'
+    plain = True
+
+    def dumps(self, value: Any) -> bytes:
+        if orjson is not None:
+            try:
+                return orjson.dumps(value)
+            except TypeError:
+                pass
+
+        return json.dumps(value).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class MsgpackCodec:
+    """
+    Compact binary encoding of JSON-like values (requires msgpack)
+    """
+
+    id = 2
+    name = 'msgpack'
+    plain = False
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise ImproperlyConfigured('msgpack codec requires the msgpack package')
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+class PickleCodec:
+    """
+    Any python object. Only for trusted data written by our own services.
+    """
+
+    id = 3
+    name = 'pickle'
+    plain = False
+
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class ZlibCompressor:
+    id = 1
+    name = 'zlib'
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 1)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class Lz4Compressor:
+    id = 2
+    name = 'lz4'
+
+    def __init__(self) -> None:
+        if lz4 is None:
+            raise ImproperlyConfigured('lz4 compressor requires the lz4 package')
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.decompress(data)
+
+
+CODECS = {
+    codec.name: codec for codec in (RawCodec, JSONCodec, MsgpackCodec, PickleCodec)
+}
+COMPRESSORS = {
+    compressor.name: compressor for compressor in (ZlibCompressor, Lz4Compressor)
+}
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+COMPRESSORS_BY_ID = {compressor.id: compressor for compressor in COMPRESSORS.values()}
+
+
+class ValueSerializer:
+    """
+    Encode values with a codec and compress the ones bigger than threshold.
+
+    Framed values are `MAGIC + header + payload`, the header byte holds the
+    codec id (high nibble) and compressor id (low nibble), so any instance
+    can read values written with another codec. Small values of the plain
+    codecs are stored unframed, which keeps them readable as before.
+    """
+
+    def __init__(
+        self,
+        codec: str = 'json',
+        compressor: str = 'zlib',
+        threshold: Optional[int] = None,
+    ) -> None:
+        self.codec = CODECS[codec]()
+        self.compressor = COMPRESSORS[compressor]()
+        self.threshold = threshold
+        self._raw = RawCodec()
+
+    def _frame(self, codec, payload: bytes) -> bytes:
+        compressor = None
+
+        if self.threshold is not None and len(payload) >= self.threshold:
+            compressor = self.compressor
+            payload = compressor.compress(payload)
+
+        if compressor is None and codec.plain and payload[:1] != MAGIC:
+            return payload
+
+        header = codec.id << 4 | (compressor.id if compressor else 0)
+        return MAGIC + bytes([header]) + payload
+
+    def _unframe(self, data: bytes) -> tuple:
+        if data[:1] != MAGIC:
+            return None, data
+
+        header, payload = data[1], data[2:]
+        codec_id, compressor_id = header >> 4, header & 0x0F
+
+        if compressor_id:
+            payload = COMPRESSORS_BY_ID[compressor_id]().decompress(payload)
+
+        return codec_id, payload
+
+    def dumps(self, value: Any) -> bytes:
+        return self._frame(self.codec, self.codec.dumps(value))
+
+    def loads(self, data: bytes) -> Any:
+        codec_id, payload = self._unframe(data)
+
+        if codec_id is None or codec_id == JSONCodec.id:
+            return JSONCodec().loads(payload)
+
+        if codec_id == PickleCodec.id and self.codec.id != PickleCodec.id:
+            raise ValueError('Pickled values are only loaded by the pickle codec')
+
+        return CODECS_BY_ID[codec_id]().loads(payload)
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Frame (and compress) raw bytes
+        """
+        return self._frame(self._raw, data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._unframe(data)[1]
@@ -1,5 +1,220 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import defaultdict
+from functools import cached_property
+
 import redis
+import redis.asyncio
+import redis.asyncio.client
+import redis.asyncio.cluster
+import redis.client
+import redis.cluster
+from common.metrics import registry
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from redis.crc import key_slot
+
+from . import memory
+from .breaker import PoolExhaustedError, guard
+from .memory import AsyncMemoryRedis, MemoryRedis
+from .metrics import (
+    observe_command,
+    pool_acquire_seconds,
+    pool_exhausted,
+    record_round_trip,
+)
+from .sharding import AsyncShardedRedis, HashRing, ShardedRedis
+
+
+class InstrumentedConnection(redis.Connection):
+    """
+    Count every packet sent to Redis (one per command or per pipeline)
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        record_round_trip()
+        return super().send_packed_command(command, check_health)
+
+
+class AsyncInstrumentedConnection(redis.asyncio.Connection):
+    """
+    Count every packet sent to Redis by the asyncio client
+    """
+
+    async def send_packed_command(self, command, check_health=True):
+        record_round_trip()
+        return await super().send_packed_command(command, check_health)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        command = 'MULTI' if self.transaction else 'PIPELINE'
+        with guard(self.connection_pool), observe_command(command):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Record latency and errors of every command and pipeline, and fail fast
+    while the circuit breaker of the server is open
+    """
+
+    def execute_command(self, *args, **options):
+        with guard(self.connection_pool), observe_command(str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class AsyncInstrumentedPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        command = 'MULTI' if self.is_transaction else 'PIPELINE'
+        with guard(self.connection_pool), observe_command(command):
+            return await super().execute(raise_on_error)
+
+
+class AsyncInstrumentedRedis(redis.asyncio.Redis):
+    """
+    The asyncio version of InstrumentedRedis
+    """
+
+    async def execute_command(self, *args, **options):
+        with guard(self.connection_pool), observe_command(str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncInstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedClusterPipeline(redis.cluster.ClusterPipeline):
+    def execute(self, raise_on_error=True):
+        # the commands may go to several nodes, their breakers are not used
+        with observe_command('PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedisCluster(redis.RedisCluster):
+    """
+    The cluster version of InstrumentedRedis, every node has its own
+    circuit breaker
+    """
+
+    def _execute_command(self, target_node, *args, **kwargs):
+        with guard(node=target_node.name), observe_command(str(args[0]).upper()):
+            return super()._execute_command(target_node, *args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        if shard_hint:
+            raise redis.cluster.RedisClusterException(
+                'shard_hint is deprecated in cluster mode'
+            )
+
+        return InstrumentedClusterPipeline(
+            nodes_manager=self.nodes_manager,
+            commands_parser=self.commands_parser,
+            startup_nodes=self.nodes_manager.startup_nodes,
+            result_callbacks=self.result_callbacks,
+            cluster_response_callbacks=self.cluster_response_callbacks,
+            cluster_error_retry_attempts=self.retry.get_retries(),
+            read_from_replicas=self.read_from_replicas,
+            load_balancing_strategy=self.load_balancing_strategy,
+            reinitialize_steps=self.reinitialize_steps,
+            retry=self.retry,
+            lock=self._lock,
+            transaction=transaction,
+        )
+
+
+class AsyncInstrumentedClusterPipeline(redis.asyncio.cluster.ClusterPipeline):
+    async def execute(self, raise_on_error=True, allow_redirections=True):
+        with observe_command('PIPELINE'):
+            return await super().execute(raise_on_error, allow_redirections)
+
+
+class AsyncInstrumentedRedisCluster(redis.asyncio.RedisCluster):
+    """
+    The asyncio version of InstrumentedRedisCluster
+    """
+
+    async def _execute_command(self, target_node, *args, **kwargs):
+        with guard(node=target_node.name), observe_command(str(args[0]).upper()):
+            return await super()._execute_command(target_node, *args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        if shard_hint:
+            raise redis.cluster.RedisClusterException(
+                'shard_hint is deprecated in cluster mode'
+            )
+        return AsyncInstrumentedClusterPipeline(self, transaction)
+
+
+class InstrumentedPool(redis.BlockingConnectionPool):
+    """
+    A pool that waits up to `timeout` seconds for a free connection instead
+    of failing, and records how long getting a connection takes
+    """
+
+    def get_connection(self, *args, **options):
+        started = time.perf_counter()
+
+        try:
+            return super().get_connection(*args, **options)
+        except redis.ConnectionError as error:
+            if isinstance(error.__context__, queue.Empty):
+                pool_exhausted.inc(db=self.connection_kwargs.get('db', 0))
+                raise PoolExhaustedError(str(error)) from error
+            raise
+        finally:
+            pool_acquire_seconds.observe(
+                time.perf_counter() - started, db=self.connection_kwargs.get('db', 0)
+            )
+
+    def stats(self) -> dict:
+        created = len(self._connections)
+        idle = sum(connection is not None for connection in list(self.pool.queue))
+        return {'in_use': created - idle, 'idle': idle, 'created': created}
+
+
+class AsyncInstrumentedPool(redis.asyncio.BlockingConnectionPool):
+    """
+    The asyncio version of InstrumentedPool
+    """
+
+    async def get_connection(self, *args, **options):
+        started = time.perf_counter()
+
+        try:
+            return await super().get_connection(*args, **options)
+        except redis.ConnectionError as error:
+            if isinstance(error.__context__, asyncio.TimeoutError):
+                pool_exhausted.inc(db=self.connection_kwargs.get('db', 0))
+                raise PoolExhaustedError(str(error)) from error
+            raise
+        finally:
+            pool_acquire_seconds.observe(
+                time.perf_counter() - started, db=self.connection_kwargs.get('db', 0)
+            )
+
+    def stats(self) -> dict:
+        idle = len(self._available_connections)
+        in_use = len(self._in_use_connections)
+        return {'in_use': in_use, 'idle': idle, 'created': idle + in_use}
+
+
+def cache_nodes() -> list:
+    """
+    Return (host, port) of the REDIS_CACHE_NODES servers
+    """
+    return [node.rsplit(':', 1) for node in settings.REDIS_CACHE_NODES]
 
 
 class RedisDBPool:
@@ -9,33 +224,303 @@ class RedisDBPool:
     connection pool.
     Here we override this behavior and used an existing connection pool by
     passing an already created connection pool instance to the
-    connection_pool argument of the Redis class
+    connection_pool argument of the Redis class.
+
+    Pools are created on first use of each database and again in a forked
+    process. They open up to REDIS_POOL_MAX_CONNECTIONS connections on demand
+    and a caller waits up to REDIS_POOL_TIMEOUT seconds for a free one.
     """
 
+    pool_class = InstrumentedPool
+    client_class = InstrumentedRedis
+    connection_class = InstrumentedConnection
+    # whether MULTI/EXEC can cover commands on different keys
+    transactions = True
+    # whether PUBLISH can be queued on a pipeline
+    pipelined_publish = True
+
     def __init__(self, size) -> None:
         self.size = size
-        self.connections = [
-            redis.Redis(connection_pool=self.pool(num)) for num in range(size)
-        ]
+        self.pid = os.getpid()
+        self.clients = {}
+        self.lock = threading.Lock()
 
-    def pool(self, db):
-        return redis.ConnectionPool(
-            host=settings.REDIS_CACHE_HOST,
-            port=settings.REDIS_CACHE_PORT,
+    def options(self) -> dict:
+        return dict(
             username=settings.REDIS_CACHE_USERNAME,
             password=settings.REDIS_CACHE_PASSWORD,
-            db=db,
             decode_responses=True,
-            max_connections=1000,
-            socket_timeout=60,
+            max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            connection_class=self.connection_class,
+        )
+
+    def pool(
+        self,
+        db,
+        host=settings.REDIS_CACHE_HOST,
+        port=settings.REDIS_CACHE_PORT,
+    ):
+        return self.pool_class(
+            host=host,
+            port=port,
+            db=db,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+            **self.options(),
+        )
+
+    def client(self, num):
+        return self.client_class(connection_pool=self.pool(num))
+
+    @property
+    def connections(self) -> dict:
+        if self.pid != os.getpid():
+            # the pools of the parent process are left to it
+            self.pid, self.clients = os.getpid(), {}
+
+        return self.clients
+
+    def con_db(self, num):
+        if num >= self.size:
+            raise ValueError(
+                'requested database number is bigger than initialized connections'
+            )
+
+        connections = self.connections
+        if (client := connections.get(num)) is None:
+            with self.lock:
+                if (client := connections.get(num)) is None:
+                    client = connections[num] = self.client(num)
+
+        return client
+
+    def group_keys(self, keys: list) -> list:
+        """
+        Split keys into the groups that one multi-key command can take
+        """
+        return [keys]
+
+    def all_clients(self) -> list:
+        return list(self.connections.items())
+
+    def client_pools(self, client) -> list:
+        return [client.connection_pool]
+
+    def stats(self) -> list:
+        """
+        Return (db, stats) of the pools of this process
+        """
+        return [
+            (num, pool.stats())
+            for num, client in self.all_clients()
+            for pool in self.client_pools(client)
+        ]
+
+
+class AsyncRedisDBPool(RedisDBPool):
+    """
+    The asyncio version of RedisDBPool. Connections of redis.asyncio are bound
+    to the event loop that created them, so a set of pools is created for
+    every running loop and dropped with it.
+    """
+
+    pool_class = AsyncInstrumentedPool
+    client_class = AsyncInstrumentedRedis
+    connection_class = AsyncInstrumentedConnection
+
+    def __init__(self, size) -> None:
+        super().__init__(size)
+        self.loops = weakref.WeakKeyDictionary()
+
+    @property
+    def connections(self) -> dict:
+        loop = asyncio.get_running_loop()
+
+        if (connections := self.loops.get(loop)) is None:
+            connections = self.loops[loop] = {}
+
+        return connections
+
+    def all_clients(self) -> list:
+        return [
+            item
+            for connections in list(self.loops.values())
+            for item in list(connections.items())
+        ]
+
+
+class ShardedDBPool(RedisDBPool):
+    """
+    Spread the keys of every database over the REDIS_CACHE_NODES servers by
+    consistent hashing (see ShardedRedis). Each node keeps the numbered
+    databases and its own pools.
+    """
+
+    sharded_class = ShardedRedis
+
+    def client(self, num):
+        clients = [
+            self.client_class(connection_pool=self.pool(num, host, int(port)))
+            for host, port in cache_nodes()
+        ]
+        return self.sharded_class(
+            clients,
+            settings.REDIS_CACHE_NODES,
+            settings.REDIS_CACHE_SHARD_REPLICAS,
         )
 
+    @cached_property
+    def ring(self) -> HashRing:
+        return HashRing(settings.REDIS_CACHE_NODES, settings.REDIS_CACHE_SHARD_REPLICAS)
+
+    def group_keys(self, keys: list) -> list:
+        nodes = defaultdict(list)
+        for key in keys:
+            nodes[self.ring.get_node(key)].append(key)
+        return list(nodes.values())
+
+    def client_pools(self, client) -> list:
+        return [node.connection_pool for node in client.clients]
+
+
+class AsyncShardedDBPool(ShardedDBPool, AsyncRedisDBPool):
+    sharded_class = AsyncShardedRedis
+
+
+class ClusterDBPool(RedisDBPool):
+    """
+    Use a Redis Cluster started from the REDIS_CACHE_NODES servers. A
+    cluster has only db 0, so every logical database shares it and
+    flush_db clears the whole cluster. Keys are routed by their hash slot;
+    keys that must be used together are colocated with a hash-tag, e.g.
+    `RATELIMIT:{route:ip:1.2.3.4}` and `RATELIMIT:{route:ip:1.2.3.4}:block`.
+    """
+
+    transactions = False
+    pipelined_publish = False
+
     def con_db(self, num):
-        if num > self.size:
+        if num >= self.size:
             raise ValueError(
                 'requested database number is bigger than initialized connections'
             )
-        return self.connections[num]
+        return super().con_db(0)
+
+    def group_keys(self, keys: list) -> list:
+        slots = defaultdict(list)
+        for key in keys:
+            slots[key_slot(str(key).encode())].append(key)
+        return list(slots.values())
+
+    def startup_nodes(self, node_class) -> list:
+        return [node_class(host, int(port)) for host, port in cache_nodes()]
+
+    def options(self) -> dict:
+        # the cluster clients create the connections of their nodes
+        options = super().options()
+        options.pop('connection_class')
+        return options
+
+    def client(self, num):
+        return InstrumentedRedisCluster(
+            startup_nodes=self.startup_nodes(redis.cluster.ClusterNode),
+            **self.options(),
+        )
+
+    def client_pools(self, client) -> list:
+        return [
+            node.redis_connection.connection_pool
+            for node in client.get_nodes()
+            if node.redis_connection
+        ]
+
+    def stats(self) -> list:
+        return [
+            (
+                num,
+                {
+                    'in_use': len(pool._in_use_connections),
+                    'idle': len(pool._available_connections),
+                    'created': pool._created_connections,
+                },
+            )
+            for num, client in self.all_clients()
+            for pool in self.client_pools(client)
+        ]
+
+
+class AsyncClusterDBPool(ClusterDBPool, AsyncRedisDBPool):
+    def client(self, num):
+        return AsyncInstrumentedRedisCluster(
+            startup_nodes=self.startup_nodes(redis.asyncio.cluster.ClusterNode),
+            **self.options(),
+        )
+
+    def client_pools(self, client) -> list:
+        # the nodes of the asyncio cluster client manage their own connections
+        return []
+
+
+class MemoryDBPool(RedisDBPool):
+    """
+    Keep the databases in the memory of the process (see MemoryRedis), for
+    tests and benchmarks. Nothing is shared between processes.
+    """
+
+    def client(self, num):
+        return MemoryRedis(memory.databases[num], memory.broker)
+
+    def client_pools(self, client) -> list:
+        return []
+
+
+class AsyncMemoryDBPool(MemoryDBPool, AsyncRedisDBPool):
+    def client(self, num):
+        return AsyncMemoryRedis(super().client(num))
+
+
+DB_POOLS = {
+    'single': (RedisDBPool, AsyncRedisDBPool),
+    'sharded': (ShardedDBPool, AsyncShardedDBPool),
+    'cluster': (ClusterDBPool, AsyncClusterDBPool),
+    'memory': (MemoryDBPool, AsyncMemoryDBPool),
+}
+
+if settings.REDIS_CACHE_MODE not in DB_POOLS:
+    raise ImproperlyConfigured(f'REDIS_CACHE_MODE must be one of {", ".join(DB_POOLS)}')
+
+_pool_class, _async_pool_class = DB_POOLS[settings.REDIS_CACHE_MODE]
+redis_connections = _pool_class(settings.REDIS_CACHE_DB_COUNT)
+async_redis_connections = _async_pool_class(settings.REDIS_CACHE_DB_COUNT)
+
+
+def collect_pool_stats(name: str):
+    """
+    Return a collector of one pool stat for the connection gauges
+    """
+
+    def collect():
+        values = {}
+
+        for client, pools in (
+            ('sync', redis_connections),
+            ('async', async_redis_connections),
+        ):
+            for db, stats in pools.stats():
+                key = (('db', db), ('client', client))
+                values[key] = values.get(key, 0) + stats[name]
+
+        return [(dict(key), value) for key, value in values.items()]
+
+    return collect
 
 
-redis_connections = RedisDBPool(settings.REDIS_CACHE_DB_COUNT)
+for _stat in ('in_use', 'idle', 'created'):
+    registry.gauge(
+        f'redis_pool_connections_{_stat}',
+        f'Connections of the Redis pools ({_stat.replace("_", " ")})',
+        labels=('db', 'client'),
+        collect=collect_pool_stats(_stat),
+    )
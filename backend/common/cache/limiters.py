@@ -0,0 +1,530 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from django.conf import settings
+
+from .connection import redis_connections
+from .memory import encode
+from .scripts import LuaScript
+
+# Every algorithm is a function (key, now, rate, window, cost, apply) that
+# returns allowed, remaining and reset (in ms). It writes only when `apply`
+# is set and the request is allowed, so all policies can be checked before
+# any of them is counted.
+ALGORITHMS_LUA = '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+
+-- a counter per window, which lets a burst of 2 * rate pass around the
+-- window edge
+local function fixed_window(key, rate, window, cost, apply)
+  local count = tonumber(redis.call('GET', key) or '0')
+  if count + cost > rate then
+    return 0, math.max(rate - count, 0), math.max(redis.call('PTTL', key), 0)
+  end
+  if not apply then
+    return 1, rate - count - cost, 0
+  end
+
+  count = redis.call('INCRBY', key, cost)
+  if redis.call('PTTL', key) < 0 then
+    redis.call('PEXPIRE', key, window)
+  end
+  return 1, math.max(rate - count, 0), redis.call('PTTL', key)
+end
+
+-- the time of every request in a sorted set, exact but O(rate) memory
+local function sliding_log(key, rate, window, cost, apply)
+  redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+  local count = redis.call('ZCARD', key)
+  local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+
+  if count + cost > rate then
+    local reset = oldest[2] and tonumber(oldest[2]) + window - now or window
+    return 0, math.max(rate - count, 0), reset
+  end
+  if not apply then
+    return 1, rate - count - cost, 0
+  end
+
+  for i = 1, cost do
+    redis.call('ZADD', key, now, clock[1] .. clock[2] .. ':' .. i)
+  end
+  redis.call('PEXPIRE', key, window)
+
+  oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+  return 1, rate - count - cost, tonumber(oldest[2]) + window - now
+end
+
+-- counters of the current and previous windows in a hash, the previous one
+-- is weighted by how much of it is still inside the sliding window
+local function sliding_window(key, rate, window, cost, apply)
+  local current = math.floor(now / window)
+  local elapsed = now - current * window
+  local count = tonumber(redis.call('HGET', key, current) or '0')
+  local previous = tonumber(redis.call('HGET', key, current - 1) or '0')
+  local estimated = previous * (window - elapsed) / window + count
+
+  if estimated + cost > rate then
+    local reset = window - elapsed
+    if previous > 0 and count + cost <= rate then
+      reset = math.max(reset - (rate - count - cost) * window / previous, 1)
+    end
+    return 0, math.max(rate - estimated, 0), reset
+  end
+  if not apply then
+    return 1, rate - estimated - cost, 0
+  end
+
+  redis.call('HINCRBY', key, current, cost)
+  for _, field in ipairs(redis.call('HKEYS', key)) do
+    if tonumber(field) < current - 1 then
+      redis.call('HDEL', key, field)
+    end
+  end
+  redis.call('PEXPIRE', key, window * 2)
+  return 1, rate - estimated - cost, window - elapsed
+end
+
+-- generic cell rate algorithm: one theoretical arrival time per key, which
+-- spaces requests window / rate apart and allows a burst of `rate`
+local function gcra(key, rate, window, cost, apply)
+  local emission = window / rate
+  local tat = math.max(tonumber(redis.call('GET', key) or '0'), now)
+  local new_tat = tat + emission * cost
+  local allow_at = new_tat - window
+
+  if allow_at > now then
+    return 0, math.max((window - (tat - now)) / emission, 0), allow_at - now
+  end
+  if apply then
+    redis.call('SET', key, new_tat, 'PX', math.ceil(new_tat - now))
+  end
+  return 1, (window - (new_tat - now)) / emission, new_tat - now
+end
+'''
+
+# KEYS = (state, block) of every policy, ARGV = (algorithm, rate, window in
+# ms, freeze in ms, cost) of every policy, then 'check' to check the
+# policies without counting the request. Returns {allowed, remaining,
+# reset in ms, policy} of the policy that denied the request, or of the
+# most restrictive one. While the block key of a policy exists (set on a
+# denied request when freeze > 0) every request is denied and the block is
+# renewed. The clock of the server is used, so app servers with skewed
+# clocks share the same windows.
+LIMIT = (
+    ALGORITHMS_LUA
+    + '''
+local limits = {
+  fixed_window = fixed_window,
+  sliding_log = sliding_log,
+  sliding_window = sliding_window,
+  gcra = gcra,
+}
+local policies = #KEYS / 2
+local check = ARGV[policies * 5 + 1] == 'check'
+
+local function policy(i)
+  local base = (i - 1) * 5
+  return KEYS[i * 2 - 1], KEYS[i * 2], limits[ARGV[base + 1]],
+    tonumber(ARGV[base + 2]), tonumber(ARGV[base + 3]),
+    tonumber(ARGV[base + 4]), tonumber(ARGV[base + 5])
+end
+
+local function deny(block, freeze, remaining, reset, i)
+  if freeze > 0 then
+    redis.call('SET', block, 1, 'PX', freeze)
+    reset = freeze
+  end
+  return {0, math.floor(remaining), math.ceil(reset), i}
+end
+
+for i = 1, policies do
+  local _, block, _, _, _, freeze = policy(i)
+  if redis.call('PTTL', block) > 0 then
+    return deny(block, freeze, 0, 0, i)
+  end
+end
+
+-- with several policies nothing is counted unless every one allows
+if policies > 1 or check then
+  for i = 1, policies do
+    local key, block, limit, rate, window, freeze, cost = policy(i)
+    local allowed, remaining, reset = limit(key, rate, window, cost, false)
+    if allowed == 0 then
+      return deny(block, freeze, remaining, reset, i)
+    end
+  end
+end
+
+if check then
+  return {1, -1, 0, 0}
+end
+
+local result = {1, -1, 0, 0}
+for i = 1, policies do
+  local key, block, limit, rate, window, freeze, cost = policy(i)
+  local allowed, remaining, reset = limit(key, rate, window, cost, true)
+  if allowed == 0 then
+    return deny(block, freeze, remaining, reset, i)
+  end
+  if result[2] < 0 or remaining < result[2] then
+    result = {1, math.floor(remaining), math.ceil(reset), i}
+  end
+end
+return result
+'''
+)
+
+
+def _fixed_window(client, key, now, rate, window, cost, apply):
+    count = int(client.get(key) or 0)
+    if count + cost > rate:
+        return 0, max(rate - count, 0), max(client.pttl(key), 0)
+    if not apply:
+        return 1, rate - count - cost, 0
+
+    count = client.incrby(key, cost)
+    if client.pttl(key) < 0:
+        client.pexpire(key, window)
+    return 1, max(rate - count, 0), client.pttl(key)
+
+
+def _sliding_log(client, key, now, rate, window, cost, apply):
+    log = client._get(key, list, create=True)
+    log[:] = [stamp for stamp in log if stamp > now - window]
+    client._set_expiry(encode(key), window / 1000)
+
+    if len(log) + cost > rate:
+        reset = log[0] + window - now if log else window
+        return 0, max(rate - len(log), 0), reset
+    if not apply:
+        return 1, rate - len(log) - cost, 0
+
+    log.extend([now] * cost)
+    return 1, rate - len(log), log[0] + window - now
+
+
+def _sliding_window(client, key, now, rate, window, cost, apply):
+    current, elapsed = divmod(now, window)
+    count = int(client.hget(key, current) or 0)
+    previous = int(client.hget(key, current - 1) or 0)
+    estimated = previous * (window - elapsed) / window + count
+
+    if estimated + cost > rate:
+        reset = window - elapsed
+        if previous > 0 and count + cost <= rate:
+            reset = max(reset - (rate - count - cost) * window / previous, 1)
+        return 0, max(rate - estimated, 0), reset
+    if not apply:
+        return 1, rate - estimated - cost, 0
+
+    client.hincrby(key, current, cost)
+    for field in list(client.hgetall(key)):
+        if int(field) < current - 1:
+            client.hdel(key, field)
+    client.pexpire(key, window * 2)
+    return 1, rate - estimated - cost, window - elapsed
+
+
+def _gcra(client, key, now, rate, window, cost, apply):
+    emission = window / rate
+    tat = max(float(client.get(key) or 0), now)
+    new_tat = tat + emission * cost
+    allow_at = new_tat - window
+
+    if allow_at > now:
+        return 0, max((window - (tat - now)) / emission, 0), allow_at - now
+    if apply:
+        client.set(key, new_tat, px=math.ceil(new_tat - now))
+    return 1, (window - (new_tat - now)) / emission, new_tat - now
+
+
+ALGORITHMS = {
+    'fixed_window': _fixed_window,
+    'sliding_log': _sliding_log,
+    'sliding_window': _sliding_window,
+    'gcra': _gcra,
+}
+
+# The most requests an algorithm lets pass at once, in rates: a fixed
+# window allows a full window at its end and another at the start of the
+# next one. The others never pass more than a bucket of `rate` tokens.
+BURSTS = {'fixed_window': 2}
+
+
+def _limit(client, keys: list, args: list) -> list:
+    """
+    The python version of the LIMIT script
+    """
+    now = int(time.time() * 1000)
+    check = len(args) > len(keys) // 2 * 5 and args[-1] in ('check', b'check')
+    policies = []
+    for i in range(len(keys) // 2):
+        start, end = i * 5, i * 5 + 5
+        algorithm, *numbers = args[start:end]
+        algorithm = algorithm.decode() if isinstance(algorithm, bytes) else algorithm
+        rate, window, freeze, cost = (int(number) for number in numbers)
+        policies.append((keys[i * 2], keys[i * 2 + 1], ALGORITHMS[algorithm]))
+        policies[-1] += (rate, window, freeze, cost)
+
+    def deny(block, freeze, remaining, reset, i):
+        if freeze > 0:
+            client.set(block, 1, px=freeze)
+            reset = freeze
+        return [0, math.floor(remaining), math.ceil(reset), i]
+
+    for i, (_, block, _, _, _, freeze, _) in enumerate(policies, 1):
+        if client.pttl(block) > 0:
+            return deny(block, freeze, 0, 0, i)
+
+    if len(policies) > 1 or check:
+        for i, (key, block, limit, rate, window, freeze, cost) in enumerate(
+            policies, 1
+        ):
+            allowed, remaining, reset = limit(
+                client, key, now, rate, window, cost, False
+            )
+            if not allowed:
+                return deny(block, freeze, remaining, reset, i)
+
+    if check:
+        return [1, -1, 0, 0]
+
+    result = [1, -1, 0, 0]
+    for i, (key, block, limit, rate, window, freeze, cost) in enumerate(policies, 1):
+        allowed, remaining, reset = limit(client, key, now, rate, window, cost, True)
+        if not allowed:
+            return deny(block, freeze, remaining, reset, i)
+        if result[1] < 0 or remaining < result[1]:
+            result = [1, math.floor(remaining), math.ceil(reset), i]
+    return result
+
+
+LIMIT_SCRIPT = LuaScript(LIMIT, _limit)
+
+
+@dataclass(frozen=True)
+class Policy:
+    """
+    One limit of `rate` requests per `window` seconds. `key` extracts the
+    part of the key from the request, e.g. the client IP or a field of the
+    body; the policy is skipped when it returns None.
+    """
+
+    name: str
+    rate: int
+    window: float
+    key: Optional[Callable] = None
+    algorithm: str = settings.RATELIMIT_ALGORITHM
+    freeze: float = 0
+    cost: int = 1
+
+
+@dataclass(frozen=True)
+class RateLimitResult:
+    """
+    Outcome of a rate limited request. `reset` is the number of seconds
+    until the quota is restored, or until a denied request may be retried.
+    `policy` is the name of the policy that denied the request, or of the
+    most restrictive one.
+    """
+
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: float
+    policy: Optional[str] = None
+
+    def headers(self) -> dict:
+        reset = str(math.ceil(self.reset))
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': reset,
+        }
+        if self.policy:
+            headers['X-RateLimit-Policy'] = self.policy
+        if not self.allowed:
+            headers['Retry-After'] = reset
+        return headers
+
+
+class LocalLimiter:
+    """
+    An in-process token bucket per key in front of the Redis limit. Its
+    tokens refill evenly, `rate` per `window` seconds, and it holds as many
+    as the `algorithm` of the limit lets pass at once (BURSTS), so it never
+    sheds a request that Redis would allow. A denial of Redis is
+    remembered until its reset, which keeps a flood from one client off
+    Redis until the client may retry. The number of keys is bounded, the
+    least recently used ones are dropped.
+
+    With `remember_only` no bucket is used, the first denial must reach
+    Redis to freeze the key.
+    """
+
+    def __init__(
+        self,
+        rate: int,
+        window: float,
+        algorithm: str = settings.RATELIMIT_ALGORITHM,
+        max_keys: int = settings.RATELIMIT_LOCAL_MAX_KEYS,
+        remember_only: bool = False,
+    ) -> None:
+        self.rate = rate
+        self.capacity = rate * BURSTS.get(algorithm, 1)
+        self.refill = rate / window
+        self.max_keys = max_keys
+        self.remember_only = remember_only
+        # key -> [tokens, updated at, blocked until]
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(
+        self, key: str, take: bool = True, bucket: bool = False
+    ) -> Optional[RateLimitResult]:
+        """
+        Take a token of the key, return the result when the request is shed
+        (`bucket` uses the bucket of a remember_only limiter too)
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.buckets.pop(key, None) or [self.capacity, now, 0]
+            self.buckets[key] = state
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+            tokens, updated, blocked_until = state
+            if blocked_until > now:
+                return RateLimitResult(False, self.rate, 0, blocked_until - now)
+            if self.remember_only and not bucket:
+                return None
+
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill)
+            state[:2] = tokens, now
+            if tokens < 1:
+                return RateLimitResult(False, self.rate, 0, (1 - tokens) / self.refill)
+
+            state[0] = tokens - 1 if take else tokens
+            return None
+
+    def update(self, key: str, result: RateLimitResult) -> None:
+        """
+        Remember a denial of Redis until its reset
+        """
+        if result.allowed:
+            return
+
+        with self.lock:
+            if (bucket := self.buckets.get(key)) is not None:
+                bucket[2] = time.monotonic() + result.reset
+
+    def clear(self, key: str) -> None:
+        with self.lock:
+            self.buckets.pop(key, None)
+
+
+def _arguments(checks: list, check: bool = False) -> tuple:
+    keys, args = [], []
+    for policy, key in checks:
+        keys += [key, f'{key}:block']
+        args += [
+            policy.algorithm,
+            policy.rate,
+            int(policy.window * 1000),
+            int(policy.freeze * 1000),
+            policy.cost,
+        ]
+    if check:
+        args.append('check')
+    return keys, args
+
+
+def _result(checks: list, response: list) -> RateLimitResult:
+    allowed, remaining, reset, index = (int(value) for value in response)
+    if not index:
+        return RateLimitResult(True, 0, 0, 0)
+
+    policy = checks[index - 1][0]
+    return RateLimitResult(
+        bool(allowed), policy.rate, remaining, reset / 1000, policy.name
+    )
+
+
+def _groups(checks: list) -> list:
+    """
+    Split (policy, key) pairs into the groups one script call can take, a
+    key and its `:block` key share a hash tag
+    """
+    pairs = {key: (policy, key) for policy, key in checks}
+    return [
+        [pairs[key] for key in keys]
+        for keys in redis_connections.group_keys(list(pairs))
+    ]
+
+
+def _merge(result: Optional[RateLimitResult], group: RateLimitResult):
+    """
+    Keep the most restrictive result of the groups that allowed a request
+    """
+    if result is None or not result.limit:
+        return group
+    return group if group.limit and group.remaining < result.remaining else result
+
+
+def hit(cache, checks: list) -> RateLimitResult:
+    """
+    Count a request against (policy, key) pairs; it is counted by none of
+    them unless all allow it. The pairs on one node are checked and counted
+    in one round trip. When they are spread over several nodes (a sharded
+    or cluster cache) every node is checked first and then counted, a round
+    trip more per node, and only concurrent requests between the two
+    passes can be counted by some policies and denied by others.
+    """
+    groups = _groups(checks)
+
+    for group in groups if len(groups) > 1 else ():
+        keys, args = _arguments(group, check=True)
+        result = _result(group, cache.run_script(LIMIT_SCRIPT, keys, args))
+        if not result.allowed:
+            return result
+
+    result = None
+    for group in groups:
+        keys, args = _arguments(group)
+        current = _result(group, cache.run_script(LIMIT_SCRIPT, keys, args))
+        if not current.allowed:
+            return current
+        result = _merge(result, current)
+
+    return result or _result(checks, [1, 0, 0, 0])
+
+
+async def async_hit(cache, checks: list) -> RateLimitResult:
+    """
+    The asyncio version of hit
+    """
+    groups = _groups(checks)
+
+    for group in groups if len(groups) > 1 else ():
+        keys, args = _arguments(group, check=True)
+        response = await cache.run_script(LIMIT_SCRIPT, keys, args)
+        if not (result := _result(group, response)).allowed:
+            return result
+
+    result = None
+    for group in groups:
+        keys, args = _arguments(group)
+        response = await cache.run_script(LIMIT_SCRIPT, keys, args)
+        current = _result(group, response)
+        if not current.allowed:
+            return current
+        result = _merge(result, current)
+
+    return result or _result(checks, [1, 0, 0, 0])
@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Optional
+
+import redis
+from django.conf import settings
+from redis import RedisError
+
+from .connection import cache_nodes, redis_connections
+from .metrics import local_cache_invalidations, local_cache_requests
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class LocalCache:
+    """
+    A bounded per-process LRU cache that sits in front of a Redis database.
+
+    Every write to the database publishes the changed keys on a pub/sub
+    channel, and a background thread of each process evicts them from its
+    own copy. Entries also expire after a short local TTL, so a lost
+    invalidation message can not keep a stale value forever.
+
+    With `tracking` the thread enables RESP3 client tracking in broadcast
+    mode for the key `prefixes` (all keys when empty) instead, so the
+    servers push the changed keys themselves, also for writes that do not
+    go through CacheManagement.
+    """
+
+    def __init__(
+        self,
+        *,
+        db: int,
+        max_size: int,
+        ttl: int,
+        channel: str,
+        tracking: bool = False,
+        prefixes: tuple = (),
+    ) -> None:
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.channel = f'{channel}:{db}'
+        self.tracking = tracking
+        self.prefixes = tuple(prefixes)
+        self.version = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._origin = None
+
+    @property
+    def connection(self):
+        return redis_connections.con_db(self.db)
+
+    def _ensure_listener(self) -> None:
+        """
+        Start the invalidation listener once per process (also after fork)
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._data.clear()
+            self._pid = os.getpid()
+            self._origin = uuid.uuid4().hex
+            threading.Thread(
+                target=self._listen,
+                args=(self._pid,),
+                name=f'local-cache-{self.db}',
+                daemon=True,
+            ).start()
+
+    def _listen(self, pid: int) -> None:
+        """
+        Evict keys that other processes published as changed
+        """
+        while self._pid == pid:
+            try:
+                if self.tracking:
+                    self._track(pid)
+                    continue
+
+                pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+
+                # messages may have been missed while (re)connecting
+                self.clear()
+
+                while self._pid == pid:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self._handle(message['data'])
+
+            except RedisError as e:
+                logger.warning(f'Local cache listener error: {e}')
+                time.sleep(1)
+
+    def _tracking_connection(self, host: str, port: int) -> redis.Connection:
+        connection = redis.Connection(
+            host=host,
+            port=port,
+            username=settings.REDIS_CACHE_USERNAME,
+            password=settings.REDIS_CACHE_PASSWORD,
+            protocol=3,
+            decode_responses=True,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        )
+        connection.connect()
+        connection._parser.set_invalidation_push_handler(self._on_invalidate)
+
+        prefixes = [part for prefix in self.prefixes for part in ('PREFIX', prefix)]
+        connection.send_command('CLIENT', 'TRACKING', 'ON', 'BCAST', *prefixes)
+        connection.read_response()
+        return connection
+
+    def _track(self, pid: int) -> None:
+        """
+        Read the invalidations pushed by the tracking servers
+        """
+        nodes = cache_nodes() or [
+            (settings.REDIS_CACHE_HOST, settings.REDIS_CACHE_PORT)
+        ]
+        connections = []
+
+        try:
+            for host, port in nodes:
+                connections.append(self._tracking_connection(host, int(port)))
+
+            # keys may have changed while (re)connecting
+            self.clear()
+
+            while self._pid == pid:
+                for connection in connections:
+                    if connection.can_read(timeout=1.0 / len(connections)):
+                        connection.read_response(push_request=True)
+
+        finally:
+            for connection in connections:
+                connection.disconnect()
+
+    def _on_invalidate(self, data: list) -> None:
+        # data[1] is None when the database was flushed
+        self._evict(data[1], source='tracking')
+
+    def _handle(self, data: str) -> None:
+        origin, keys = json.loads(data)
+
+        if origin == self._origin:
+            return
+
+        self._evict(keys, source='pubsub')
+
+    def _evict(self, keys: Optional[list], source: str = 'local') -> None:
+        local_cache_invalidations.inc(db=self.db, source=source)
+
+        with self._lock:
+            self.version += 1
+
+            if keys is None:
+                self._data.clear()
+                return
+
+            for key in keys:
+                self._data.pop(key, None)
+
+    def get(self, key: str) -> Any:
+        """
+        Return the local value of a key or MISSING
+        """
+        self._ensure_listener()
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._data[key]
+                entry = None
+
+            if entry is None:
+                local_cache_requests.inc(db=self.db, result='miss')
+                return MISSING
+
+            local_cache_requests.inc(db=self.db, result='hit')
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any, version: int) -> None:
+        """
+        Store a value that was read from Redis when `version` was current
+        """
+        self._ensure_listener()
+
+        with self._lock:
+            # an invalidation arrived while the value was being read
+            if version != self.version:
+                return
+
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys: str, publish: bool = True) -> None:
+        """
+        Evict keys locally (and publish them to the other processes)
+        """
+        if (message := self.invalidation(list(keys))) and publish:
+            self.connection.publish(*message)
+
+    def clear(self, publish: bool = False) -> None:
+        """
+        Evict every local key (and publish it to the other processes)
+        """
+        if (message := self.invalidation(None)) and publish:
+            self.connection.publish(*message)
+
+    def invalidation(self, keys: Optional[list]) -> Optional[tuple]:
+        """
+        Evict keys (None for all) locally and return the message to
+        publish to the other processes
+        """
+        self._ensure_listener()
+        self._evict(keys)
+        return self.message(keys)
+
+    def message(self, keys: Optional[list]) -> Optional[tuple]:
+        """
+        Return the (channel, message) that evicts keys (None for all) from
+        the other processes, None when the servers track the keys
+        """
+        self._ensure_listener()
+
+        if not self.tracking:
+            return self.channel, json.dumps([self._origin, keys])
+
+
+local_caches = {
+    db: LocalCache(
+        db=db,
+        max_size=settings.REDIS_LOCAL_CACHE_SIZE,
+        ttl=settings.REDIS_LOCAL_CACHE_TTL,
+        channel=settings.REDIS_LOCAL_CACHE_CHANNEL,
+        tracking=settings.REDIS_LOCAL_CACHE_TRACKING,
+        prefixes=settings.REDIS_LOCAL_CACHE_TRACKING_PREFIXES,
+    )
+    for db in range(settings.REDIS_CACHE_DB_COUNT)
+}
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+from typing import Callable
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.base import ModelBase
+from django.db.models.signals import post_delete, post_save
+from redis import RedisError
+
+from .metrics import lookup_cache_requests
+from .redis_cache import CacheManagement
+
+logger = logging.getLogger(__name__)
+
+
+class LookupCache:
+    """
+    Short-TTL cache of single object lookups by model and filter kwargs.
+
+    Found objects are stored pickled as `[instance]` and missing ones as
+    `[]`, so repeated 404 probes and hot objects are answered without a
+    database query. Found entries are tagged with the pk of the object and
+    missing ones with a `missing` tag of the model, the tags expire with
+    their entries. Saving an object drops both (a new or changed object may
+    match a missing lookup) and deleting it drops the entries of its pk,
+    after the transaction commits.
+
+    While Redis fails the lookups go to the database.
+    """
+
+    prefix = settings.REDIS_LOOKUP_CACHE_PREFIX
+
+    def __init__(
+        self,
+        *,
+        labels: list = settings.REDIS_LOOKUP_CACHE_MODELS,
+        ttl: int = settings.REDIS_LOOKUP_CACHE_TTL,
+        negative_ttl: int = settings.REDIS_LOOKUP_CACHE_NEGATIVE_TTL,
+    ):
+        self.labels = {label.lower() for label in labels}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = CacheManagement(db=settings.REDIS_CACHE_GENERAL_DB, codec='pickle')
+
+    def enabled_for(self, model: ModelBase) -> bool:
+        return model._meta.label_lower in self.labels
+
+    def _tag(self, model: ModelBase, name) -> str:
+        return f'{self.prefix}:{model._meta.label_lower}:{name}'
+
+    def key(self, model: ModelBase, **kwargs) -> str:
+        """
+        Return the key of a lookup, the filter kwargs are hashed
+        """
+        filters = {
+            name: value.pk if isinstance(value, models.Model) else value
+            for name, value in kwargs.items()
+        }
+        data = json.dumps(filters, sort_keys=True, default=str).encode()
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        return f'{self.prefix}:{model._meta.label_lower}:{digest}'
+
+    def get(self, model: ModelBase, fetch: Callable, **kwargs) -> models.Model | None:
+        """
+        Return the object of the lookup, `fetch(model, **kwargs)` loads it on a miss
+        """
+        key = self.key(model, **kwargs)
+        label = model._meta.label_lower
+
+        try:
+            cached = self.cache.get_key(key)
+        except RedisError:
+            lookup_cache_requests.inc(model=label, result='bypass')
+            return fetch(model, **kwargs)
+
+        if isinstance(cached, list):
+            result = 'hit' if cached else 'negative_hit'
+            lookup_cache_requests.inc(model=label, result=result)
+            return cached[0] if cached else None
+
+        lookup_cache_requests.inc(model=label, result='miss')
+        instance = fetch(model, **kwargs)
+
+        try:
+            if instance is None:
+                self.cache.set_key(
+                    key, [], self.negative_ttl, tags=(self._tag(model, 'missing'),)
+                )
+            else:
+                self.cache.set_key(
+                    key, [instance], self.ttl, tags=(self._tag(model, instance.pk),)
+                )
+        except RedisError as e:
+            logger.warning(f'Lookup cache of {label} is not stored: {e}')
+
+        return instance
+
+    def invalidate(self, model: ModelBase, pk, missing: bool = True) -> int:
+        """
+        Drop the cached lookups that may return another result now
+        """
+        tags = [self._tag(model, pk)]
+        if missing:
+            tags.append(self._tag(model, 'missing'))
+
+        try:
+            return self.cache.invalidate_tags(*tags)
+        except RedisError as e:
+            # the entries expire after the short TTL
+            logger.warning(f'Lookup cache of {model._meta.label_lower} is stale: {e}')
+            return 0
+
+    def _on_save(self, sender, instance, **kwargs) -> None:
+        pk = instance.pk
+        transaction.on_commit(lambda: self.invalidate(sender, pk))
+
+    def _on_delete(self, sender, instance, **kwargs) -> None:
+        pk = instance.pk
+        transaction.on_commit(lambda: self.invalidate(sender, pk, missing=False))
+
+    def connect(self) -> None:
+        """
+        Invalidate the lookups of the cached models on save and delete
+        """
+        for label in self.labels:
+            model = apps.get_model(label)
+            uid = f'lookup_cache:{label}'
+            post_save.connect(self._on_save, model, weak=False, dispatch_uid=uid)
+            post_delete.connect(self._on_delete, model, weak=False, dispatch_uid=uid)
+
+
+lookup_cache = LookupCache()
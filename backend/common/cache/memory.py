@@ -0,0 +1,552 @@
+import fnmatch
+import hashlib
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+from redis.client import NEVER_DECODE
+from redis.exceptions import NoScriptError, ResponseError
+
+from .metrics import record_round_trip
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+def encode(value: Any) -> bytes:
+    """
+    Encode a value the way redis-py sends it to the server
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value).encode()
+    if isinstance(value, str):
+        return value.encode()
+    raise TypeError(f'Invalid input of type: {type(value).__name__!r}')
+
+
+def decode(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, dict):
+        return {decode(key): decode(item) for key, item in value.items()}
+    if isinstance(value, (list, set)):
+        return type(value)(decode(item) for item in value)
+    return value
+
+
+class MemoryStore:
+    """
+    Keys of one logical database. A value is bytes (string), dict (hash) or
+    set, the expiry times are kept apart like in Redis.
+    """
+
+    def __init__(self) -> None:
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.RLock()
+
+    def alive(self, key: bytes) -> bool:
+        if (expires_at := self.expires.get(key)) is not None:
+            if expires_at <= time.monotonic():
+                self.data.pop(key, None)
+                self.expires.pop(key, None)
+        return key in self.data
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.expires.clear()
+
+
+class MemoryBroker:
+    """
+    In-process pub/sub channels
+    """
+
+    def __init__(self) -> None:
+        self.channels = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel: bytes, message: bytes) -> int:
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+
+        for subscriber in subscribers:
+            subscriber.put((channel, message))
+
+        return len(subscribers)
+
+
+class MemoryPubSub:
+    def __init__(self, broker: MemoryBroker, decode_responses: bool) -> None:
+        self.broker = broker
+        self.decode_responses = decode_responses
+        self.messages = queue.Queue()
+        self.subscribed = set()
+
+    def subscribe(self, *channels) -> None:
+        with self.broker.lock:
+            for channel in map(encode, channels):
+                self.broker.channels[channel].add(self.messages)
+                self.subscribed.add(channel)
+
+    def unsubscribe(self, *channels) -> None:
+        with self.broker.lock:
+            for channel in map(encode, channels or list(self.subscribed)):
+                self.broker.channels[channel].discard(self.messages)
+                self.subscribed.discard(channel)
+
+    def get_message(self, ignore_subscribe_messages=True, timeout=0.0):
+        try:
+            channel, data = self.messages.get(timeout=timeout or None)
+        except queue.Empty:
+            return None
+
+        message = {'type': 'message', 'pattern': None, 'channel': channel, 'data': data}
+        return decode(message) if self.decode_responses else message
+
+    def close(self) -> None:
+        self.unsubscribe()
+
+
+class MemoryPipeline:
+    """
+    Commands queued and run together while the store is locked, so the
+    pipeline is always atomic
+    """
+
+    def __init__(self, client: 'MemoryRedis', transaction: bool = True) -> None:
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return command
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __enter__(self) -> 'MemoryPipeline':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.commands = []
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        commands, self.commands = self.commands, []
+        client = self.client._clone(record=False)
+        results = []
+        record_round_trip()
+
+        with client.store.lock:
+            for name, args, kwargs in commands:
+                try:
+                    results.append(getattr(client, name)(*args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+
+        return results
+
+
+class MemoryRedis:
+    """
+    An in-process stand-in for redis.Redis covering the commands used by
+    the cache layer: strings, hashes, sets, sorted sets, TTLs, INCR, scans, pub/sub and
+    pipelines. Every command and pipeline counts as one round trip.
+
+    Lua scripts are not interpreted: EVAL(SHA) runs the python version that
+    was registered for the script (see common.cache.scripts.LuaScript).
+    """
+
+    def __init__(
+        self,
+        store: MemoryStore,
+        broker: MemoryBroker,
+        decode_responses: bool = True,
+        record: bool = True,
+    ) -> None:
+        self.store = store
+        self.broker = broker
+        self.decode_responses = decode_responses
+        self.record = record
+
+    def _clone(self, **options) -> 'MemoryRedis':
+        options = {
+            'decode_responses': self.decode_responses,
+            'record': self.record,
+            **options,
+        }
+        return MemoryRedis(self.store, self.broker, **options)
+
+    def _result(self, value: Any) -> Any:
+        return decode(value) if self.decode_responses else value
+
+    def _get(self, key, kind: type, create: bool = False) -> Any:
+        key = encode(key)
+
+        if not self.store.alive(key):
+            if not create:
+                return None
+            self.store.data[key] = kind()
+
+        value = self.store.data[key]
+        if not isinstance(value, kind):
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _set_expiry(self, key: bytes, seconds: Optional[float]) -> None:
+        if seconds is None:
+            self.store.expires.pop(key, None)
+        else:
+            self.store.expires[key] = time.monotonic() + seconds
+
+    def _locked(self, function, *args, **kwargs) -> Any:
+        record_round_trip() if self.record else None
+        with self.store.lock:
+            return function(*args, **kwargs)
+
+    def execute_command(self, *args, **options) -> Any:
+        client = self
+        if NEVER_DECODE in options:
+            client = self._clone(decode_responses=False)
+        return getattr(client, str(args[0]).lower())(*args[1:])
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> MemoryPipeline:
+        return MemoryPipeline(self, transaction)
+
+    def ping(self) -> bool:
+        return True
+
+    # strings
+
+    def get(self, key) -> Any:
+        return self._locked(lambda: self._result(self._get(key, bytes)))
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+        def command():
+            name = encode(key)
+            exists = self.store.alive(name)
+
+            if (nx and exists) or (xx and not exists):
+                return None
+
+            self.store.data[name] = encode(value)
+            if not keepttl:
+                seconds = px / 1000 if px is not None else ex
+                self._set_expiry(name, seconds)
+            return True
+
+        return self._locked(command)
+
+    def incrby(self, key, amount: int = 1) -> int:
+        def command():
+            current = self._get(key, bytes)
+            try:
+                value = int(current or 0) + amount
+            except ValueError:
+                raise ResponseError('value is not an integer or out of range')
+            self.store.data[encode(key)] = encode(value)
+            return value
+
+        return self._locked(command)
+
+    incr = incrby
+
+    def decrby(self, key, amount: int = 1) -> int:
+        return self.incrby(key, -amount)
+
+    decr = decrby
+
+    # keys
+
+    def exists(self, *keys) -> int:
+        return self._locked(lambda: sum(self.store.alive(encode(key)) for key in keys))
+
+    def delete(self, *keys) -> int:
+        def command():
+            removed = 0
+            for key in map(encode, keys):
+                if self.store.alive(key):
+                    del self.store.data[key]
+                    self.store.expires.pop(key, None)
+                    removed += 1
+            return removed
+
+        return self._locked(command)
+
+    unlink = delete
+
+    def expire(self, key, time) -> bool:
+        def command():
+            name = encode(key)
+            if not self.store.alive(name):
+                return False
+            self._set_expiry(name, time)
+            return True
+
+        return self._locked(command)
+
+    def pexpire(self, key, time) -> bool:
+        return self.expire(key, time / 1000)
+
+    def persist(self, key) -> bool:
+        def command():
+            name = encode(key)
+            return self.store.alive(name) and bool(self.store.expires.pop(name, None))
+
+        return self._locked(command)
+
+    def pttl(self, key) -> int:
+        def command():
+            name = encode(key)
+            if not self.store.alive(name):
+                return -2
+            if (expires_at := self.store.expires.get(name)) is None:
+                return -1
+            return int((expires_at - time.monotonic()) * 1000)
+
+        return self._locked(command)
+
+    def ttl(self, key) -> int:
+        result = self.pttl(key)
+        return result if result < 0 else round(result / 1000)
+
+    def keys(self, pattern='*') -> list:
+        def command():
+            pattern_ = encode(pattern).decode()
+            return [
+                key
+                for key in list(self.store.data)
+                if self.store.alive(key)
+                and fnmatch.fnmatchcase(key.decode(errors='replace'), pattern_)
+            ]
+
+        return self._result(self._locked(command))
+
+    def scan_iter(self, match=None, count=None, _type=None):
+        yield from self.keys(match or '*')
+
+    def dbsize(self) -> int:
+        return len(self.keys())
+
+    def flushdb(self, asynchronous: bool = False) -> bool:
+        self._locked(self.store.clear)
+        return True
+
+    def flushall(self, asynchronous: bool = False) -> bool:
+        for store in list(databases.values()):
+            with store.lock:
+                store.clear()
+        return True
+
+    # sets
+
+    def sadd(self, key, *values) -> int:
+        def command():
+            members = self._get(key, set, create=True)
+            size = len(members)
+            members.update(map(encode, values))
+            return len(members) - size
+
+        return self._locked(command)
+
+    def srem(self, key, *values) -> int:
+        def command():
+            members = self._get(key, set) or set()
+            removed = members & set(map(encode, values))
+            members -= removed
+            if not members:
+                self.store.data.pop(encode(key), None)
+            return len(removed)
+
+        return self._locked(command)
+
+    def smembers(self, key) -> set:
+        return self._locked(lambda: self._result(set(self._get(key, set) or ())))
+
+    def sismember(self, key, value) -> bool:
+        return self._locked(lambda: encode(value) in (self._get(key, set) or ()))
+
+    def scard(self, key) -> int:
+        return self._locked(lambda: len(self._get(key, set) or ()))
+
+    # sorted sets (a dict of member -> score)
+
+    def zrem(self, key, *values) -> int:
+        def command():
+            members = self._get(key, dict) or {}
+            removed = sum(
+                members.pop(encode(value), None) is not None for value in values
+            )
+            if not members:
+                self.store.data.pop(encode(key), None)
+            return removed
+
+        return self._locked(command)
+
+    def zrange(self, key, start: int, end: int) -> list:
+        def command():
+            members = self._get(key, dict) or {}
+            ordered = sorted(members, key=lambda member: (members[member], member))
+            stop = None if end == -1 else end + 1
+            return ordered[start:stop]
+
+        return self._locked(lambda: self._result(command()))
+
+    # hashes
+
+    def hset(self, name, key=None, value=None, mapping=None, items=None) -> int:
+        pairs = list(items or ())
+        pairs += [(key, value)] if key is not None else []
+        pairs += list((mapping or {}).items())
+
+        def command():
+            fields = self._get(name, dict, create=True)
+            size = len(fields)
+            fields.update((encode(field), encode(item)) for field, item in pairs)
+            return len(fields) - size
+
+        return self._locked(command)
+
+    def hsetnx(self, name, key, value) -> bool:
+        def command():
+            fields = self._get(name, dict, create=True)
+            if encode(key) in fields:
+                return False
+            fields[encode(key)] = encode(value)
+            return True
+
+        return self._locked(command)
+
+    def hget(self, name, key) -> Any:
+        def command():
+            return (self._get(name, dict) or {}).get(encode(key))
+
+        return self._result(self._locked(command))
+
+    def hmget(self, name, keys, *args) -> list:
+        def command():
+            fields = self._get(name, dict) or {}
+            names = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+            return [fields.get(encode(key)) for key in [*names, *args]]
+
+        return self._result(self._locked(command))
+
+    def hgetall(self, name) -> dict:
+        return self._result(self._locked(lambda: dict(self._get(name, dict) or {})))
+
+    def hexists(self, name, key) -> bool:
+        return self._locked(lambda: encode(key) in (self._get(name, dict) or {}))
+
+    def hlen(self, name) -> int:
+        return self._locked(lambda: len(self._get(name, dict) or {}))
+
+    def hdel(self, name, *keys) -> int:
+        def command():
+            fields = self._get(name, dict) or {}
+            removed = sum(fields.pop(encode(key), None) is not None for key in keys)
+            if not fields:
+                self.store.data.pop(encode(name), None)
+            return removed
+
+        return self._locked(command)
+
+    def hincrby(self, name, key, amount: int = 1) -> int:
+        def command():
+            fields = self._get(name, dict, create=True)
+            value = int(fields.get(encode(key), 0)) + amount
+            fields[encode(key)] = encode(value)
+            return value
+
+        return self._locked(command)
+
+    # scripts
+
+    def script_load(self, script) -> str:
+        sha = hashlib.sha1(encode(script)).hexdigest()
+        if sha not in scripts:
+            raise ResponseError('ERR the memory backend only runs registered scripts')
+        return sha
+
+    def evalsha(self, sha, numkeys: int, *keys_and_args) -> Any:
+        if (function := scripts.get(sha)) is None:
+            raise NoScriptError('NOSCRIPT No matching script.')
+
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        client = self._clone(record=False)
+        return self._locked(function, client, list(keys), list(args))
+
+    def eval(self, script, numkeys: int, *keys_and_args) -> Any:
+        sha = hashlib.sha1(encode(script)).hexdigest()
+        if sha not in scripts:
+            raise ResponseError('ERR the memory backend only runs registered scripts')
+        return self.evalsha(sha, numkeys, *keys_and_args)
+
+    # pub/sub
+
+    def publish(self, channel, message) -> int:
+        record_round_trip() if self.record else None
+        return self.broker.publish(encode(channel), encode(message))
+
+    def pubsub(self, **kwargs) -> MemoryPubSub:
+        return MemoryPubSub(self.broker, self.decode_responses)
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def execute(self, raise_on_error: bool = True) -> list:
+        return super().execute(raise_on_error)
+
+
+class AsyncMemoryRedis:
+    """
+    The asyncio version of MemoryRedis, sharing the data of the process
+    """
+
+    def __init__(self, client: MemoryRedis) -> None:
+        self.client = client
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.client, name)
+
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        async def command(*args, **kwargs):
+            return attribute(*args, **kwargs)
+
+        return command
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return AsyncMemoryPipeline(self.client, transaction)
+
+    async def scan_iter(self, match=None, count=None, _type=None):
+        for key in self.client.keys(match or '*'):
+            yield key
+
+
+# python versions of the Lua scripts by SHA1
+scripts = {}
+
+# data of the process by database number
+databases = defaultdict(MemoryStore)
+broker = MemoryBroker()
@@ -0,0 +1,163 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from common.metrics import registry
+from django.conf import settings
+from redis import RedisError
+
+redis_round_trips = registry.counter(
+    'redis_round_trips_total',
+    'Commands or pipelines sent to Redis',
+)
+
+request_redis_round_trips = registry.histogram(
+    'redis_round_trips_per_request',
+    'Round trips to Redis made by one request',
+    labels=('route',),
+    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21),
+)
+
+pool_acquire_seconds = registry.histogram(
+    'redis_pool_acquire_seconds',
+    'Time spent getting a connection from a Redis pool',
+    labels=('db',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+
+pool_exhausted = registry.counter(
+    'redis_pool_exhausted_total',
+    'Callers that timed out waiting for a free Redis connection',
+    labels=('db',),
+)
+
+local_cache_requests = registry.counter(
+    'redis_local_cache_requests_total',
+    'Reads of the per-process local cache by result (hit or miss)',
+    labels=('db', 'result'),
+)
+
+local_cache_invalidations = registry.counter(
+    'redis_local_cache_invalidations_total',
+    'Invalidations of the local cache by source (local, pubsub or tracking)',
+    labels=('db', 'source'),
+)
+
+redis_command_duration = registry.histogram(
+    'redis_command_duration_seconds',
+    'Latency of Redis commands and pipelines (sampled)',
+    labels=('command',),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1),
+)
+
+redis_command_errors = registry.counter(
+    'redis_command_errors_total',
+    'Failed Redis commands and pipelines by error type',
+    labels=('command', 'error'),
+)
+
+deferred_write_errors = registry.counter(
+    'redis_deferred_write_errors_total',
+    'Batched (deferred) commands that failed when their batch was flushed',
+    labels=('error',),
+)
+
+queue_jobs = registry.counter(
+    'redis_queue_jobs_total',
+    'Jobs of the task queues by state (queued, retrying, done, dead or expired)',
+    labels=('queue', 'state'),
+)
+
+queue_job_duration = registry.histogram(
+    'redis_queue_job_seconds',
+    'Run time of the jobs of the task queues',
+    labels=('queue', 'task'),
+)
+
+redis_value_bytes = registry.histogram(
+    'redis_value_bytes',
+    'Size of the encoded values written and read by CacheManagement',
+    labels=('operation',),
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+
+circuit_transitions = registry.counter(
+    'redis_circuit_transitions_total',
+    'State changes of the Redis circuit breakers by node and new state',
+    labels=('node', 'state'),
+)
+
+circuit_rejected = registry.counter(
+    'redis_circuit_rejected_total',
+    'Commands rejected without a round trip because the circuit is open',
+    labels=('node',),
+)
+
+api_cache_requests = registry.counter(
+    'api_cache_requests_total',
+    'ApiCache lookups by identifier and result '
+    '(hit, stale, wait, miss, not_modified, bypass, error)',
+    labels=('identifier', 'result'),
+)
+
+rate_limit_requests = registry.counter(
+    'rate_limit_requests_total',
+    'Rate limited requests by result '
+    '(allowed, denied, shed locally or failed_open when Redis fails)',
+    labels=('result',),
+)
+
+lookup_cache_requests = registry.counter(
+    'lookup_cache_requests_total',
+    'Cached get_object lookups by model and result '
+    '(hit, negative_hit, miss or bypass when Redis fails)',
+    labels=('model', 'result'),
+)
+
+api_cache_payload_bytes = registry.histogram(
+    'api_cache_payload_bytes',
+    'Size of the stored (compressed) ApiCache bodies',
+    labels=('identifier',),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+
+# round trips of the current request (set by CacheBatchMiddleware)
+request_round_trips: ContextVar[Optional[list]] = ContextVar(
+    'request_round_trips', default=None
+)
+
+
+def sampled() -> bool:
+    """
+    Whether to time this command (REDIS_METRICS_SAMPLE_RATE of them)
+    """
+    rate = settings.REDIS_METRICS_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+@contextmanager
+def observe_command(command: str):
+    """
+    Record latency (when sampled) and errors of a command
+    """
+    started = time.perf_counter() if sampled() else None
+
+    try:
+        yield
+    except RedisError as e:
+        redis_command_errors.inc(command=command, error=type(e).__name__)
+        raise
+    finally:
+        if started is not None:
+            redis_command_duration.observe(
+                time.perf_counter() - started, command=command
+            )
+
+
+def record_round_trip() -> None:
+    redis_round_trips.inc()
+
+    if (counter := request_round_trips.get()) is not None:
+        counter[0] += 1
@@ -0,0 +1,126 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+from redis import RedisError
+
+from .batch import BatchScope, current_scope
+from .metrics import (
+    deferred_write_errors,
+    request_redis_round_trips,
+    request_round_trips,
+)
+from .rate_limit import RateLimit
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBatchMiddleware:
+    """
+    Open a deferred batch for the request: Redis writes of CacheManagement
+    are queued and sent together with the next read, or in one pipeline at
+    the end of the request. The number of round trips of every request is
+    recorded per route.
+
+    The response is already made when the last writes are flushed, so a
+    Redis error then is logged and counted instead of turning it into a
+    500.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        scope = BatchScope(deferred=True, parent=current_scope.get())
+        scope_token = current_scope.set(scope)
+        counter_token = request_round_trips.set(counter := [0])
+
+        try:
+            return self.get_response(request)
+
+        finally:
+            try:
+                scope.flush()
+            except RedisError as e:
+                logger.warning(f'Deferred cache writes were lost: {e}')
+                deferred_write_errors.inc(error=type(e).__name__)
+            finally:
+                current_scope.reset(scope_token)
+                request_round_trips.reset(counter_token)
+
+                match = getattr(request, 'resolver_match', None)
+                route = match.route if match else 'unmatched'
+                request_redis_round_trips.observe(counter[0], route=route)
+
+
+@dataclass
+class RouteRateLimit(RateLimit):
+    """
+    A RateLimit of a route of the RATELIMIT_ROUTES table, its keys use the
+    name of the route instead of the requested path
+    """
+
+    name: str = ''
+    path: str = ''
+    methods: tuple = ()
+
+    def __post_init__(self):
+        super().__post_init__()
+        self._path = re.compile(self.path)
+        self._methods = {method.upper() for method in self.methods}
+
+    def matches(self, request) -> bool:
+        if self._methods and request.method not in self._methods:
+            return False
+        return bool(self._path.match(request.path_info))
+
+    def _get_requested_route(self, request) -> str:
+        return self.name
+
+
+class RateLimitMiddleware:
+    """
+    Apply the limits of RATELIMIT_ROUTES before authentication, body parsing
+    and the view, so abusive requests are rejected at the cost of a local
+    check or a single script call. It uses the same counters and response
+    as the RateLimit decorator. CORS preflight (OPTIONS) requests are not
+    limited, it runs after CorsMiddleware which answers them.
+    """
+
+    def __init__(self, get_response):
+        if not settings.RATELIMIT_MIDDLEWARE_ENABLED or not settings.RATELIMIT_ROUTES:
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+        self.routes = [
+            RouteRateLimit(name=name, **options)
+            for name, options in settings.RATELIMIT_ROUTES.items()
+        ]
+
+    def _route(self, request) -> Optional[RouteRateLimit]:
+        if request.method == 'OPTIONS':
+            return None
+        return next((route for route in self.routes if route.matches(request)), None)
+
+    def __call__(self, request):
+        if (route := self._route(request)) is None:
+            return self.get_response(request)
+
+        try:
+            result = route.check(request)
+        except RateLimit.RateLimitException as error:
+            response = JsonResponse({'detail': error.detail}, status=error.status_code)
+            for name, value in error.headers.items():
+                response[name] = value
+            return response
+
+        response = self.get_response(request)
+        # the headers of a decorated view are more specific
+        if route.headers and result.limit:
+            for name, value in result.headers().items():
+                response.setdefault(name, value)
+        return response
@@ -0,0 +1,394 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid as uuid_lib
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from django.conf import settings
+from redis import RedisError
+
+from .metrics import queue_job_duration, queue_jobs
+from .redis_cache import CacheManagement
+from .scripts import LuaScript
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RETRYING, DONE, DEAD, EXPIRED = 'queued', 'retrying', 'done', 'dead', 'expired'
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _enqueue(client, keys: list, args: list) -> int:
+    job_id = _text(args[0])
+    client.hset(keys[1], job_id, args[1])
+    client._get(keys[0], list, create=True).append(job_id)
+    client.set(keys[2], QUEUED, ex=int(args[2]))
+    return 1
+
+
+def _claim(client, keys: list, args: list) -> Optional[list]:
+    now = _now()
+    ready = client._get(keys[0], list, create=True)
+    scheduled = client._get(keys[1], dict, create=True)
+
+    for job_id in sorted(
+        [job_id for job_id, at in scheduled.items() if at <= now],
+        key=scheduled.get,
+    )[:100]:
+        del scheduled[job_id]
+        ready.append(job_id)
+
+    while ready:
+        job_id = ready.pop(0)
+        if (job := client.hget(keys[2], job_id)) is not None:
+            scheduled[job_id] = now + int(args[0])
+            return [job_id, job, client.hincrby(keys[3], job_id, 1)]
+
+    return None
+
+
+def _retry(client, keys: list, args: list) -> int:
+    client._get(keys[0], dict, create=True)[_text(args[0])] = _now() + int(args[1])
+    client.set(keys[1], RETRYING, ex=int(args[2]))
+    return 1
+
+
+def _finish(client, keys: list, args: list) -> int:
+    job_id = _text(args[0])
+    client._get(keys[0], dict, create=True).pop(job_id, None)
+    client.hdel(keys[1], job_id)
+    client.hdel(keys[2], job_id)
+    client.set(keys[3], args[1], ex=int(args[2]))
+
+    if args[3]:
+        client.hset(keys[4], job_id, args[3])
+        client.expire(keys[4], int(args[4]))
+    return 1
+
+
+# KEYS = ready list, jobs hash (id -> payload), status, ARGV = id, payload,
+# status TTL in seconds
+ENQUEUE = LuaScript(
+    '''
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[3], 'queued', 'EX', ARGV[3])
+return 1
+''',
+    _enqueue,
+)
+
+# KEYS = ready list, scheduled zset (id -> due time), jobs hash, attempts
+# hash, ARGV = lease in ms. Jobs whose retry is due or whose lease ran out
+# go back to the ready list, then the first ready job is leased and
+# returned with its attempt number.
+CLAIM = LuaScript(
+    '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)) do
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('RPUSH', KEYS[1], id)
+end
+
+while true do
+  local id = redis.call('LPOP', KEYS[1])
+  if not id then
+    return false
+  end
+
+  local job = redis.call('HGET', KEYS[3], id)
+  if job then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), id)
+    return {id, job, redis.call('HINCRBY', KEYS[4], id, 1)}
+  end
+end
+''',
+    _claim,
+)
+
+# KEYS = scheduled zset, status, ARGV = id, delay in ms, status TTL
+RETRY = LuaScript(
+    '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('SET', KEYS[2], 'retrying', 'EX', ARGV[3])
+return 1
+''',
+    _retry,
+)
+
+# KEYS = scheduled zset, jobs hash, attempts hash, status, dead hash,
+# ARGV = id, state, status TTL, dead letter (empty for none), dead TTL
+FINISH = LuaScript(
+    '''
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('SET', KEYS[4], ARGV[2], 'EX', ARGV[3])
+
+if ARGV[4] ~= '' then
+  redis.call('HSET', KEYS[5], ARGV[1], ARGV[4])
+  redis.call('EXPIRE', KEYS[5], ARGV[5])
+end
+return 1
+''',
+    _finish,
+)
+
+queues = {}
+
+
+class PermanentError(Exception):
+    """
+    Raised by a task when running it again can not help, or could repeat a
+    side effect (e.g. a message that may have been sent), the job is
+    dead-lettered at once
+    """
+
+
+@dataclass
+class TaskQueue:
+    """
+    A job queue in Redis, to run slow work (e.g. calls to an SMS provider)
+    outside of the request, e.g.
+
+        sms_queue = TaskQueue('sms')
+
+        @sms_queue.task(expires=120)
+        def send(phone_number, message):
+            ...
+
+        send.delay('+989123456789', 'hello')
+
+    Jobs are run at least once by `manage.py run_queue sms`, or with
+    `local_worker` by a thread of the process that enqueued them. A job
+    that raises or returns False is retried with a jittered exponential
+    backoff up to `max_attempts` times and then kept as a dead letter (its
+    task, last error and attempts, not its arguments which may hold
+    personal data), one that raises PermanentError is dead-lettered
+    without a retry. A
+    claimed job is leased for `visibility_timeout` milliseconds, so the job
+    of a crashed worker runs again. The state of every job (queued,
+    retrying, done, dead or expired) is kept for REDIS_QUEUE_STATUS_TTL.
+    """
+
+    name: str
+    redis_con: CacheManagement = field(
+        default_factory=lambda: CacheManagement(db=settings.REDIS_CACHE_GENERAL_DB)
+    )
+    max_attempts: int = settings.REDIS_QUEUE_MAX_ATTEMPTS
+    visibility_timeout: int = settings.REDIS_QUEUE_VISIBILITY_TIMEOUT
+    retry_backoff: float = settings.REDIS_QUEUE_RETRY_BACKOFF
+    retry_backoff_max: float = settings.REDIS_QUEUE_RETRY_BACKOFF_MAX
+    local_worker: bool = settings.REDIS_QUEUE_LOCAL_WORKER
+
+    def __post_init__(self):
+        prefix = f'queue:{{{self.name}}}'
+        self.prefix = prefix
+        self.ready, self.scheduled = f'{prefix}:ready', f'{prefix}:scheduled'
+        self.jobs, self.attempts = f'{prefix}:jobs', f'{prefix}:attempts'
+        self.dead = f'{prefix}:dead'
+        self.tasks = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        queues[self.name] = self
+
+    def _status_key(self, job_id: str) -> str:
+        return f'{self.prefix}:status:{job_id}'
+
+    def task(self, expires: Optional[float] = None) -> Callable:
+        """
+        Register a function as a task of the queue, `function.delay(...)`
+        enqueues a call. Jobs not started `expires` seconds after they
+        were enqueued are dropped.
+        """
+
+        def decorator(function: Callable) -> Callable:
+            name = f'{function.__module__}.{function.__qualname__}'
+            self.tasks[name] = function
+            function.delay = lambda *args, **kwargs: self.enqueue(
+                name, args, kwargs, expires=expires
+            )
+            return function
+
+        return decorator
+
+    def enqueue(
+        self,
+        task: str,
+        args: tuple = (),
+        kwargs: Optional[dict] = None,
+        expires: Optional[float] = None,
+    ) -> str:
+        """
+        Add a job to the queue and return its id
+        """
+        job_id = uuid_lib.uuid4().hex
+        payload = {
+            'task': task,
+            'args': list(args),
+            'kwargs': kwargs or {},
+            'expires_at': _now() + int(expires * 1000) if expires else None,
+        }
+
+        self.redis_con.run_script(
+            ENQUEUE,
+            [self.ready, self.jobs, self._status_key(job_id)],
+            [job_id, json.dumps(payload), settings.REDIS_QUEUE_STATUS_TTL],
+        )
+        queue_jobs.inc(queue=self.name, state=QUEUED)
+
+        self._ensure_worker() if self.local_worker else None
+        return job_id
+
+    def status(self, job_id: str) -> Optional[str]:
+        """
+        Return the state of a job, None when it is unknown or too old
+        """
+        return self.redis_con.db.get(self._status_key(job_id))
+
+    def dead_letters(self) -> dict:
+        """
+        Return the dead jobs by id, with their last error and attempts
+        """
+        return {
+            job_id: json.loads(letter)
+            for job_id, letter in self.redis_con.db.hgetall(self.dead).items()
+        }
+
+    def purge(self) -> None:
+        """
+        Drop every job of the queue, including the dead letters
+        """
+        self.redis_con.db.delete(
+            self.ready, self.scheduled, self.jobs, self.attempts, self.dead
+        )
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.retry_backoff_max, self.retry_backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def _finish(self, job_id: str, state: str, letter: Optional[dict] = None) -> None:
+        keys = [
+            self.scheduled,
+            self.jobs,
+            self.attempts,
+            self._status_key(job_id),
+            self.dead,
+        ]
+        args = [
+            job_id,
+            state,
+            settings.REDIS_QUEUE_STATUS_TTL,
+            json.dumps(letter) if letter else '',
+            settings.REDIS_QUEUE_DEAD_LETTER_TTL,
+        ]
+        self.redis_con.run_script(FINISH, keys, args)
+        queue_jobs.inc(queue=self.name, state=state)
+
+    def _run(self, job_id: str, payload: dict, attempts: int) -> None:
+        if payload['expires_at'] and payload['expires_at'] <= _now():
+            self._finish(job_id, EXPIRED)
+            return
+
+        task = payload['task']
+        permanent = False
+        started = time.perf_counter()
+        try:
+            if (function := self.tasks.get(task)) is None:
+                raise LookupError(f'Task {task} is not registered')
+
+            if function(*payload['args'], **payload['kwargs']) is False:
+                raise RuntimeError(f'Task {task} returned False')
+            error = None
+
+        except Exception as e:
+            logger.warning(f'Job {job_id} of queue {self.name} failed: {e!r}')
+            error = repr(e)
+            permanent = isinstance(e, PermanentError)
+
+        finally:
+            duration = time.perf_counter() - started
+            queue_job_duration.observe(duration, queue=self.name, task=task)
+
+        if error is None:
+            self._finish(job_id, DONE)
+
+        elif permanent or attempts >= self.max_attempts:
+            letter = {'task': task, 'error': error, 'attempts': attempts}
+            self._finish(job_id, DEAD, letter)
+
+        else:
+            delay = int(self._retry_delay(attempts) * 1000)
+            self.redis_con.run_script(
+                RETRY,
+                [self.scheduled, self._status_key(job_id)],
+                [job_id, delay, settings.REDIS_QUEUE_STATUS_TTL],
+            )
+            queue_jobs.inc(queue=self.name, state=RETRYING)
+
+    def run_once(self) -> bool:
+        """
+        Run the next ready job, return whether there was one
+        """
+        keys = [self.ready, self.scheduled, self.jobs, self.attempts]
+        claimed = self.redis_con.run_script(CLAIM, keys, [self.visibility_timeout])
+        if not claimed:
+            return False
+
+        job_id, job, attempts = claimed
+        self._run(_text(job_id), json.loads(job), int(attempts))
+        return True
+
+    def work(self, stop: Optional[threading.Event] = None, burst: bool = False) -> None:
+        """
+        Run jobs until `stop` is set, or until the queue is empty with
+        `burst`
+        """
+        stop = stop or threading.Event()
+
+        while not stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+                if burst:
+                    return
+
+            except RedisError as e:
+                logger.warning(f'Worker of queue {self.name} failed: {e}')
+
+            except Exception:
+                logger.exception(f'Worker of queue {self.name} failed')
+
+            stop.wait(settings.REDIS_QUEUE_POLL_INTERVAL)
+
+    def _ensure_worker(self) -> None:
+        """
+        Start the local worker once per process (also after fork)
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self.work,
+                name=f'queue-worker:{self.name}',
+                daemon=True,
+            ).start()
@@ -1,26 +1,137 @@
+import asyncio
 import functools
+import hashlib
+import ipaddress
+from collections.abc import Mapping
+from contextlib import nullcontext, suppress
 from dataclasses import dataclass
+from typing import Callable, Optional
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from redis import RedisError
 from rest_framework.exceptions import APIException
 from rest_framework.request import Request
 
+from .async_redis_cache import AsyncCacheManagement
+from .limiters import (
+    ALGORITHMS,
+    LocalLimiter,
+    Policy,
+    RateLimitResult,
+    async_hit,
+    hit,
+)
+from .metrics import rate_limit_requests
 from .redis_cache import CacheManagement
 
 
+def client_ip(request: Request, server_side: bool = False) -> str:
+    """
+    Return ip of client
+    """
+
+    if server_side:
+        if ip := request.META.get('HTTP_DIR_CLIENTIP'):
+            return ip
+
+    if x_forwarded_for := request.META.get('HTTP_X_FORWARDED_FOR'):
+        return x_forwarded_for.split(',')[0].strip()
+
+    return request.META.get('REMOTE_ADDR')
+
+
+def by_ip(server_side: bool = False) -> Callable:
+    """
+    Key extractor of a Policy: the client IP
+    """
+    return lambda request: client_ip(request, server_side)
+
+
+def by_subnet(prefix: int = 24, prefix_v6: int = 64, server_side: bool = False):
+    """
+    Key extractor of a Policy: the network of the client IP, e.g. its /24
+    """
+
+    def extract(request: Request) -> Optional[str]:
+        try:
+            ip = ipaddress.ip_address(client_ip(request, server_side))
+        except ValueError:
+            return None
+
+        length = prefix if ip.version == 4 else prefix_v6
+        return str(ipaddress.ip_network(f'{ip}/{length}', strict=False))
+
+    return extract
+
+
+def by_field(name: str) -> Callable:
+    """
+    Key extractor of a Policy: a field of the body or the query string, it
+    is hashed so e.g. phone numbers are not stored in the keys. Requests
+    without the field are not counted by the policy.
+    """
+
+    def extract(request: Request) -> Optional[str]:
+        # a plain HttpRequest (in a middleware) has no data, and a JSON body
+        # may be a list
+        data = getattr(request, 'data', None)
+        value = data.get(name) if isinstance(data, Mapping) else None
+        if value in (None, ''):
+            value = request.GET.get(name)
+
+        if value in (None, ''):
+            return None
+        return hashlib.blake2b(str(value).encode(), digest_size=12).hexdigest()
+
+    return extract
+
+
+def by_user(request: Request) -> Optional[str]:
+    """
+    Key extractor of a Policy: the authenticated user
+    """
+    user = getattr(request, 'user', None)
+    return str(user.pk) if user and user.is_authenticated else None
+
+
 @dataclass
 class RateLimit:
     """
     A class representing rate limiting configuration.
 
+    The check and the increment run in one Lua script on the server, so
+    concurrent requests can not pass the limit and every request costs a
+    single round trip. The remaining quota is sent in the X-RateLimit-*
+    headers and a denied request gets Retry-After.
+
+    With `local` a LocalLimiter sheds a flood of requests in the process
+    before they reach Redis.
+
+    With `policies` several limits are evaluated in the same script, e.g.
+    per IP, per phone number and for everyone; a request is counted by none
+    of them unless all allow it, and the denying policy is reported in the
+    X-RateLimit-Policy header. A Policy with no `key` counts the requests
+    of every client. Only the keys of one policy and value share a hash
+    tag, so a route is spread over the nodes of a sharded or cluster cache
+    (where a request is counted one node at a time, see `hit`). `rate`,
+    `window` and `freeze` are only used without policies.
+
     Attributes:
         rate (int): The maximum number of requests allowed within a given window.
         window (int): The time period (in seconds) during which the rate limit applies.
         freeze (int): The time (in seconds) to expand the window time of user riches to the maximum rate.
         request (Request): The request object associated with the rate limit.
-        success_clear (bool): Whether to clear the cache if the operation was successful.
+        success_clear (bool | tuple): Whether to clear the cache if the operation was successful,
+            with policies the names of the policies of the client to clear (never a global one).
+        algorithm (str): fixed_window, sliding_log, sliding_window (counter) or gcra.
+        headers (bool): Whether to add the X-RateLimit-* headers to the response.
+        local (bool): Whether to shed excessive requests in the process first.
+        fail_open (bool): Whether to allow the requests when Redis fails.
+        policies (tuple): Policy objects to evaluate together instead of rate/window.
         key_prefix (str): The key prefix to use in the Redis keys naming.
         redis (CacheManagement): The cache management object to use for Redis operations.
+        async_redis (AsyncCacheManagement): The cache management object to use in async views.
     """
 
     rate: int = 3
@@ -28,28 +139,71 @@ class RateLimit:
     freeze: int = 0
     request: Request = None
     server_side: bool = False
-    success_clear: bool = False
+    success_clear: bool | tuple = False
+    algorithm: str = settings.RATELIMIT_ALGORITHM
+    headers: bool = True
+    local: bool = settings.RATELIMIT_LOCAL_ENABLED
+    fail_open: bool = settings.RATELIMIT_FAIL_OPEN
+    policies: tuple = ()
     key_prefix: str = settings.REDIS_RATELIMIT_CACHE_PREFIX
     redis: CacheManagement = CacheManagement(db=settings.REDIS_CACHE_GENERAL_DB)
+    async_redis: AsyncCacheManagement = AsyncCacheManagement(
+        db=settings.REDIS_CACHE_GENERAL_DB
+    )
 
     class RateLimitException(APIException):
-        def __init__(self, detail=settings.DEFAULT_DETAIL_KEY, status_code=429):
+        def __init__(
+            self,
+            detail=settings.DEFAULT_DETAIL_KEY,
+            status_code=429,
+            result: RateLimitResult = None,
+        ):
             self.status_code = status_code
             self.detail = detail
+            self.headers = result.headers() if result else {}
+
+    def __post_init__(self):
+        self._policies = {policy.name: policy for policy in self.policies} or {
+            '': Policy('', self.rate, self.window, None, self.algorithm, self.freeze)
+        }
+
+        for policy in self._policies.values():
+            if policy.algorithm not in ALGORITHMS:
+                raise ImproperlyConfigured(
+                    f'Unknown rate limit algorithm {policy.algorithm!r}, '
+                    f'use one of {", ".join(ALGORITHMS)}'
+                )
+
+        self._cleared = {''} if self.success_clear else set()
+        if self.policies and self.success_clear:
+            self._cleared = set(
+                () if self.success_clear is True else self.success_clear
+            )
+            policies = [self._policies.get(name) for name in self._cleared]
+
+            # a success of one client must not reset the budget of others
+            if not policies or any(p is None or p.key is None for p in policies):
+                raise ImproperlyConfigured(
+                    'success_clear of a RateLimit with policies must name the '
+                    'policies of the client to clear, not the global ones'
+                )
+
+        self._local = {
+            name: LocalLimiter(
+                policy.rate,
+                policy.window,
+                policy.algorithm,
+                remember_only=policy.freeze > 0,
+            )
+            for name, policy in self._policies.items()
+            if self.local
+        }
 
     def _get_client_ip(self, request: Request) -> str:
         """
         Return ip of client
         """
-
-        if self.server_side:
-            if ip := request.META.get('HTTP_DIR_CLIENTIP'):
-                return ip
-
-        if x_forwarded_for := request.META.get('HTTP_X_FORWARDED_FOR'):
-            return x_forwarded_for.split(',')[0]
-
-        return request.META.get('REMOTE_ADDR')
+        return client_ip(request, self.server_side)
 
     def _get_requested_route(self, request: Request) -> str:
         """
@@ -57,46 +211,197 @@ class RateLimit:
         """
         return request.path
 
+    def _get_key(self, request: Request) -> str:
+        """
+        Return key of the client and route (hash tagged, so the keys of the
+        limit stay on one node)
+        """
+        ip = self._get_client_ip(request)
+        route = self._get_requested_route(request)
+        return f'{self.key_prefix}:{{{ip}{route}}}'
+
+    def _get_checks(self, request: Request) -> list:
+        """
+        Return the (policy, key) pairs the request is counted by
+        """
+        if not self.policies:
+            return [(self._policies[''], self._get_key(request))]
+
+        route = self._get_requested_route(request)
+        checks = []
+
+        for policy in self.policies:
+            value = policy.key(request) if policy.key else '*'
+            if value is not None:
+                key = f'{self.key_prefix}:{{{route}:{policy.name}:{value}}}'
+                checks.append((policy, key))
+
+        return checks
+
+    def _add_headers(self, response, result: RateLimitResult):
+        if self.headers and result.limit and hasattr(response, 'headers'):
+            for name, value in result.headers().items():
+                response[name] = value
+        return response
+
+    def _shed(self, checks: list) -> Optional[RateLimitResult]:
+        """
+        Return the result when a local limiter sheds the request, a token is
+        taken from the buckets only when all of them have one
+        """
+        if not self._local:
+            return None
+
+        for policy, key in checks:
+            if result := self._local[policy.name].check(key, take=False):
+                rate_limit_requests.inc(result='shed')
+                return RateLimitResult(
+                    False, result.limit, 0, result.reset, policy.name or None
+                )
+
+        for policy, key in checks:
+            self._local[policy.name].check(key)
+        return None
+
+    def _count(self, checks: list, result: RateLimitResult) -> None:
+        if self._local and not result.allowed:
+            for policy, key in checks:
+                if policy.name == (result.policy or ''):
+                    self._local[policy.name].update(key, result)
+        rate_limit_requests.inc(result='allowed' if result.allowed else 'denied')
+
+    def _cleared_checks(self, checks: list) -> list:
+        """
+        Return the checks to reset after a successful request
+        """
+        return [(policy, key) for policy, key in checks if policy.name in self._cleared]
+
+    def _clear_local(self, checks: list) -> None:
+        for policy, key in self._cleared_checks(checks) if self._local else ():
+            self._local[policy.name].clear(key)
+
+    def _exception(self, result: RateLimitResult) -> RateLimitException:
+        """
+        Return the exception to raise when the rate is exceeded
+        """
+        freeze = self._policies[result.policy or ''].freeze
+        result = result if self.headers else None
+
+        if freeze == 0:
+            return self.RateLimitException(
+                detail='Too many attempts! Please try again latter', result=result
+            )
+
+        blocked_in_minute = int(freeze / 60)
+
+        blocked_for = (
+            f'{freeze} seconds' if freeze < 60 else f'{blocked_in_minute} minutes'
+        )
+
+        return self.RateLimitException(
+            detail=f'Too many attempts! Please try again in {blocked_for}',
+            result=result,
+        )
+
+    def _failed_open(self, checks: list) -> RateLimitResult:
+        """
+        Return the result of a request while Redis fails: it is allowed,
+        unless the local bucket of a limit with a freeze is empty
+        """
+        rate_limit_requests.inc(result='failed_open')
+
+        for policy, key in checks if self._local else ():
+            local = self._local[policy.name]
+            if local.remember_only and (result := local.check(key, bucket=True)):
+                return RateLimitResult(
+                    False, result.limit, 0, result.reset, policy.name or None
+                )
+
+        return RateLimitResult(True, 0, 0, 0)
+
+    def _check(self, checks: list) -> RateLimitResult:
+        """
+        Count the request, raise RateLimitException when it is denied
+        """
+        if result := self._shed(checks):
+            raise self._exception(result)
+
+        try:
+            result = hit(self.redis, checks)
+            self._count(checks, result)
+        except RedisError:
+            if not self.fail_open:
+                raise
+            result = self._failed_open(checks)
+
+        if not result.allowed:
+            raise self._exception(result)
+        return result
+
+    async def _async_check(self, checks: list) -> RateLimitResult:
+        """
+        The asyncio version of _check
+        """
+        if result := self._shed(checks):
+            raise self._exception(result)
+
+        try:
+            result = await async_hit(self.async_redis, checks)
+            self._count(checks, result)
+        except RedisError:
+            if not self.fail_open:
+                raise
+            result = self._failed_open(checks)
+
+        if not result.allowed:
+            raise self._exception(result)
+        return result
+
+    def check(self, request) -> RateLimitResult:
+        """
+        Count a request outside of a view, e.g. in a middleware
+        """
+        return self._check(self._get_checks(request))
+
     def __call__(self, function):
         """
         Main functionality
         """
 
+        if asyncio.iscoroutinefunction(function):
+            return self._async_call(function)
+
         @functools.wraps(function)
         def decorated_function(*args, **kwargs):
             request = args[1] if self.request is None else self.request
-            ip = self._get_client_ip(request)
-            route = self._get_requested_route(request)
-            key = f'{self.key_prefix}:{ip}{route}'
+            checks = self._get_checks(request)
+            result = self._check(checks)
 
-            data = self.redis.get_key(key)
+            response = function(*args, **kwargs)
+            with suppress(RedisError) if self.fail_open else nullcontext():
+                for _, key in self._cleared_checks(checks):
+                    self.redis.remove_key(key)
+            self._clear_local(checks)
+            return self._add_headers(response, result)
 
-            if data and int(data) == self.rate:
-                if self.freeze == 0:
-                    raise self.RateLimitException(
-                        detail='Too many attempts! Please try again latter'
-                    )
-
-                self.redis.set_expire(key, self.freeze)
-                blocked_in_minute = int(self.freeze / 60)
-
-                blocked_for = (
-                    f'{self.freeze} seconds'
-                    if self.freeze < 60
-                    else f'{blocked_in_minute} minutes'
-                )
+        return decorated_function
 
-                raise self.RateLimitException(
-                    detail=f'Too many attempts! Please try again in {blocked_for}'
-                )
+    def _async_call(self, function):
+        """
+        Main functionality for async views
+        """
 
-            if not data:
-                self.redis.set_key(key, 1, self.window)
-            else:
-                self.redis.incr_key(key, 1)
+        @functools.wraps(function)
+        async def decorated_function(*args, **kwargs):
+            request = args[1] if self.request is None else self.request
+            checks = self._get_checks(request)
+            result = await self._async_check(checks)
 
-            result = function(*args, **kwargs)
-            self.redis.remove_key(key) if self.success_clear else None
-            return result
+            response = await function(*args, **kwargs)
+            with suppress(RedisError) if self.fail_open else nullcontext():
+                for _, key in self._cleared_checks(checks):
+                    await self.async_redis.remove_key(key)
+            self._clear_local(checks)
+            return self._add_headers(response, result)
 
         return decorated_function
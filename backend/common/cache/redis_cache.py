@@ -1,91 +1,436 @@
-import json
-from typing import Any, Optional
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Optional
 
+from common.cache.batch import (
+    BatchScope,
+    CacheBatch,
+    CacheFuture,
+    current_scope,
+    get_batch,
+)
+from common.cache.codecs import ValueSerializer
 from common.cache.connection import redis_connections
+from common.cache.local_cache import MISSING, local_caches
+from common.cache.memory import encode
+from common.cache.metrics import redis_value_bytes
+from common.cache.scripts import LuaScript
 from django.conf import settings
 from django.db.models.base import ModelBase
+from redis.exceptions import NoScriptError
+
+
+def _tag(client, keys: list, args: list) -> int:
+    members = client._get(keys[0], dict, create=True)
+    now = time.time() * 1000
+
+    for member, expires_at in list(members.items()):
+        if expires_at <= now:
+            del members[member]
+
+    ttl = int(args[1])
+    members[encode(args[0])] = now + ttl * 1000 if ttl else math.inf
+    last = max(members.values())
+    client._set_expiry(
+        encode(keys[0]), None if last == math.inf else (last - now) / 1000
+    )
+    return 1
+
+
+# KEYS = tag zset (key -> expiry in ms), ARGV = key, TTL in seconds (0 for
+# none). Expired keys are dropped and the tag expires with its last key.
+TAG = LuaScript(
+    '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local ttl = tonumber(ARGV[2])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZADD', KEYS[1], ttl > 0 and now + ttl * 1000 or '+inf', ARGV[1])
+
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')[2]
+if last == 'inf' then
+  redis.call('PERSIST', KEYS[1])
+else
+  redis.call('PEXPIREAT', KEYS[1], last)
+end
+return 1
+''',
+    _tag,
+)
 
 
 class CacheManagement:
-    """ """
+    """
+    When REDIS_LOCAL_CACHE_ENABLED is set every write publishes the changed
+    keys to the per-process local caches, and instances created with
+    `local_cache=True` serve get_key/hget reads from the local cache.
+
+    Keys can be registered under tags (a string or a django model class),
+    so every key of a tag is invalidated in one call to invalidate_tags. A
+    tag is a sorted set of its keys by expiry, expired keys are dropped
+    when a key is tagged and the set expires with its last key.
+
+    Inside a batch (CacheManagement.batch or CacheBatchMiddleware) commands
+    are queued on a pipeline and sent in one round trip.
+
+    Values of set_key/get_key are encoded with `codec` (json, msgpack or
+    pickle for trusted data) and compressed when they are bigger than
+    `compress_threshold` bytes.
+    """
 
     default_ttl = settings.REDIS_CACHE_LONG_TTL
+    tag_prefix = settings.REDIS_CACHE_TAG_PREFIX
+    batch_size = settings.REDIS_CACHE_DELETE_BATCH_SIZE
+
+    def __init__(
+        self,
+        *,
+        db: int = 0,
+        local_cache: bool = False,
+        codec: str = settings.REDIS_CACHE_CODEC,
+        compress_threshold: Optional[int] = settings.REDIS_CACHE_COMPRESS_THRESHOLD,
+    ):
+        self.serializer = ValueSerializer(
+            codec=codec,
+            compressor=settings.REDIS_CACHE_COMPRESSOR,
+            threshold=compress_threshold,
+        )
+        self.number = db
+        self.local = local_caches[db] if settings.REDIS_LOCAL_CACHE_ENABLED else None
+        self.read_local = local_cache and self.local is not None
 
-    def __init__(self, *, db: int = 0):
-        self.db = redis_connections.con_db(db)
+    @property
+    def db(self):
+        return redis_connections.con_db(self.number)
+
+    def _encode(self, value: Any) -> bytes:
+        data = self.serializer.dumps(value)
+        redis_value_bytes.observe(len(data), operation='set')
+        return data
+
+    def _decode(self, data: Optional[bytes]) -> Any:
+        if not data:
+            return {}
+        redis_value_bytes.observe(len(data), operation='get')
+        return self.serializer.loads(data)
+
+    def _invalidate(self, *keys: str, publish: bool = True) -> None:
+        """
+        Evict changed keys from the local caches of all processes (of this
+        one only when the message was sent with the write)
+        """
+        self.local.invalidate(*keys, publish=publish) if self.local and keys else None
+
+    def _publish_commands(self, keys: tuple) -> list:
+        """
+        Return the command that evicts changed keys from the local caches of
+        the other processes, to send it in the round trip of the write
+        """
+        if not self.local or not keys or not redis_connections.pipelined_publish:
+            return []
+        if message := self.local.message(list(keys)):
+            return [('publish', message, {})]
+        return []
+
+    def _flush(self) -> None:
+        """
+        Send the queued commands before running a command outside the batch
+        """
+        batch = get_batch(self.number, self.db)
+        batch.flush() if batch else None
 
-    def pipeline(self):
-        return self.db.pipeline()
+    def _command(
+        self,
+        name: str,
+        *args,
+        write: bool = False,
+        callback: Optional[Callable] = None,
+        invalidate: tuple = (),
+        **kwargs,
+    ) -> Any:
+        """
+        Run a command, or queue it when a batch is open in this context.
+
+        Queued writes return a CacheFuture. Queued reads flush the deferred
+        batch and return their value, or a CacheFuture in an explicit batch.
+        """
+        return self._command_many(
+            [(name, args, kwargs)],
+            write=write,
+            callback=callback,
+            invalidate=invalidate,
+            transaction=False,
+        )
+
+    def _command_many(
+        self,
+        commands: list,
+        write: bool = False,
+        callback: Optional[Callable] = None,
+        invalidate: tuple = (),
+        transaction: bool = True,
+    ) -> Any:
+        """
+        Send (name, args, kwargs) commands in one round trip and return the
+        result of the first one
+        """
+        publish = self._publish_commands(invalidate)
+        commands = [*commands, *publish]
+
+        def resolve(result):
+            self._invalidate(*invalidate, publish=not publish)
+            return callback(result) if callback else result
+
+        batch = get_batch(self.number, self.db)
+
+        if batch is None:
+            if len(commands) == 1:
+                name, args, kwargs = commands[0]
+                return resolve(getattr(self.db, name)(*args, **kwargs))
+
+            pipe = self.pipeline(transaction)
+            for name, args, kwargs in commands:
+                getattr(pipe, name)(*args, **kwargs)
+            return resolve(pipe.execute()[0])
+
+        (name, args, kwargs), *others = commands
+        future = batch.queue(name, *args, callback=resolve, **kwargs)
+        for name, args, kwargs in others:
+            batch.queue(name, *args, **kwargs)
+
+        if batch.deferred and not write:
+            batch.flush()
+            return future.result()
+
+        return future
+
+    def _read(
+        self, key: str, *command, callback: Optional[Callable] = None, **options
+    ) -> Any:
+        """
+        Run a read command of the key through the local cache when it is enabled
+        """
+        if not self.read_local:
+            return self._command(*command, callback=callback, **options)
+
+        if (value := self.local.get(key)) is not MISSING:
+            value = callback(value) if callback else value
+            batch = get_batch(self.number, self.db)
+            return (
+                CacheFuture.resolved(value) if batch and not batch.deferred else value
+            )
+
+        version = self.local.version
+
+        def store(value):
+            self.local.set(key, value, version) if value else None
+            return callback(value) if callback else value
+
+        return self._command(*command, callback=store, **options)
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue the commands of this database and send them in one round trip
+        when the block exits. Every command returns a CacheFuture, e.g.
+
+            with cache.batch():
+                cache.set_key('a', 1)
+                b = cache.get_key('b')
+            b.result()
+        """
+        self._flush()
+        scope = BatchScope(
+            deferred=False,
+            batches={self.number: CacheBatch(self.db)},
+            parent=current_scope.get(),
+        )
+        token = current_scope.set(scope)
+
+        try:
+            yield scope.batches[self.number]
+        finally:
+            current_scope.reset(token)
+            scope.flush()
+
+    def pipeline(self, transaction: bool = True):
+        self._flush()
+        return self.db.pipeline(
+            transaction=transaction and redis_connections.transactions
+        )
+
+    def tag_name(self, tag: str | ModelBase) -> str:
+        """
+        Return the name of the set that holds the keys of a tag
+        """
+        tag = tag.__name__ if isinstance(tag, ModelBase) else tag
+        return f'{self.tag_prefix}:{tag}'
+
+    def _tag_commands(self, key: str, tags: Iterable, ttl: Optional[int]) -> list:
+        """
+        Return commands that add the key to the sets of its tags
+        """
+        # EVAL, not EVALSHA: the commands may be queued on a pipeline, where
+        # a script missing on the server can not be loaded and retried
+        return [
+            (
+                'execute_command',
+                ('EVAL', TAG.source, 1, self.tag_name(tag), key, ttl or 0),
+                {},
+            )
+            for tag in tags
+        ]
+
+    def _unlink(self, keys: list, tag_name: Optional[str] = None) -> int:
+        """
+        Delete keys in pipelined batches without blocking Redis (and remove
+        them from the set of the tag)
+        """
+        pipe = self.db.pipeline(transaction=False)
+
+        for start in range(0, len(keys), self.batch_size):
+            end = start + self.batch_size
+            for batch in redis_connections.group_keys(keys[start:end]):
+                pipe.unlink(*batch)
+                pipe.zrem(tag_name, *batch) if tag_name else None
+
+        size = len(pipe)
+        for name, args, kwargs in (publish := self._publish_commands(tuple(keys))):
+            getattr(pipe, name)(*args, **kwargs)
+
+        result = pipe.execute()[:size]
+        self._invalidate(*keys, publish=not publish)
+        return sum(result[::2] if tag_name else result)
+
+    def tag_keys(self, key: str, *tags: str | ModelBase, ttl: Optional[int] = None):
+        """
+        Register an existing key under the given tags
+        """
+        commands = self._tag_commands(key, tags, ttl)
+        return self._command_many(commands, write=True) if commands else None
+
+    def invalidate_tags(self, *tags: str | ModelBase) -> int:
+        """
+        Delete every key registered under the given tags
+        """
+        self._flush()
+        removed = 0
+
+        for tag in tags:
+            tag_name = self.tag_name(tag)
+
+            if not (keys := self.db.zrange(tag_name, 0, -1)):
+                continue
+
+            # only the deleted members are removed, keys tagged meanwhile stay
+            removed += self._unlink(keys, tag_name)
+
+        return removed
 
     def set_expire(self, key: str, ttl: int) -> bool:
-        return self.db.expire(key, ttl)
+        return self._command('expire', key, ttl, write=True)
 
     def is_exists(self, key):
         """
         Check if the key exists in the cache or not
         """
-        return bool(self.db.exists(key))
+        return self._command('exists', key, callback=bool)
 
-    def set_key(self, key: str, value: Any, ttl: Optional[int] = default_ttl) -> bool:
+    def set_key(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[int] = default_ttl,
+        tags: Iterable = (),
+    ) -> bool:
         """
         Set the key:value data as a string in Redis and provide a custom TTL value
         if one is specified. If no TTL value is provided, set it to 'None'."
         """
-        value = json.dumps(value)
-        result = self.db.set(key, str(value))
-        self.set_expire(key, ttl) if ttl else None  # type: ignore
-        return result
+        value = self._encode(value)
+        commands = [
+            ('set', (key, value), {'ex': ttl or None}),
+            *self._tag_commands(key, tags, ttl),
+        ]
+        return self._command_many(commands, write=True, invalidate=(key,))
 
     def setnx_key(self, key: str, value: Any, ttl: Optional[int] = default_ttl) -> bool:
         """
         Set the key:value data as a string in Redis and provide a custom TTL value
         if one is specified. If no TTL value is provided, set it to 'None'."
         """
-        value = json.dumps(value)
-        result = self.db.setnx(key, value)
-        self.set_expire(key, ttl) if ttl else None  # type: ignore
-        return result
+        value = self._encode(value)
+        return self._command(
+            'set', key, value, nx=True, ex=ttl or None, callback=bool, invalidate=(key,)
+        )
 
     def get_key(self, key: str) -> bytes | None:
         """
         Return data of a key
         """
-        data = self.db.get(key)
-        return json.loads(data) if data else {}
+        return self._read(
+            key,
+            'execute_command',
+            'GET',
+            key,
+            callback=self._decode,
+            NEVER_DECODE=True,
+        )
 
     def incr_key(self, key: str, value: int = 1) -> int:
         """
         Increase value of a key by given number
         """
-        return self.db.incr(key, value)
+        return self._command('incr', key, value, invalidate=(key,))
 
     def get_all_keys(self) -> list:
         """
         Return list of all keys that stored in specific database
         """
-        return self.db.keys()
+        self._flush()
+        return list(self.db.scan_iter(count=self.batch_size))
 
     def remove_key(self, key: str | ModelBase) -> int:
         """
         Delete a key from cache (it can be str or django model class)
+
+        For a model class the `{Model}:all` key and every key tagged with
+        the model are deleted.
         """
-        key = f'{key.__name__}:all' if isinstance(key, ModelBase) else key
-        return self.db.delete(key)
+        if isinstance(key, ModelBase):
+            self._flush()
+            return self._unlink([f'{key.__name__}:all']) + self.invalidate_tags(key)
+
+        return self._command('unlink', key, write=True, invalidate=(key,))
 
     def remove_pattern_key(self, pattern: str) -> None:
         """
         Delete keys from cache follow with a pattern
-        """
-        keys = self.db.keys(pattern)
 
-        for key in keys:
-            self.db.delete(key)
+        It scans the whole keyspace, prefer tags and invalidate_tags.
+        """
+        self._flush()
+        keys = list(self.db.scan_iter(match=pattern, count=self.batch_size))
+        self._unlink(keys) if keys else None
 
-    def hset(self, hash_name: str, mapping: dict) -> bool:
+    def hset(
+        self,
+        hash_name: str,
+        mapping: dict,
+        ttl: Optional[int] = None,
+        tags: Iterable = (),
+    ) -> bool:
         """
         Storing data as HashMap structure
         """
-        return self.db.hset(hash_name, mapping=mapping)
+        commands = [
+            ('hset', (hash_name,), {'mapping': mapping}),
+            *([('expire', (hash_name, ttl), {})] if ttl else []),
+            *self._tag_commands(hash_name, tags, ttl),
+        ]
+        return self._command_many(commands, write=True, invalidate=(hash_name,))
 
     def hset_key(
         self, hash_name: str, key: str, value: str, ttl: Optional[int] = None
@@ -93,8 +438,11 @@ class CacheManagement:
         """
         Storing a field in HashMap structure
         """
-        result = self.db.hset(hash_name, key, value)
-        return self.set_expire(hash_name, ttl) if ttl else result  # type: ignore
+        commands = [
+            ('hset', (hash_name, key, value), {}),
+            *([('expire', (hash_name, ttl), {})] if ttl else []),
+        ]
+        return self._command_many(commands, write=True, invalidate=(hash_name,))
 
     def hsetnx_key(
         self, hash_name: str, key: str, value: str, ttl: Optional[int] = None
@@ -102,47 +450,107 @@ class CacheManagement:
         """
         Storing a field in HashMap structure if not exists
         """
-        result = self.db.hsetnx(hash_name, key, value)
-        return self.set_expire(hash_name, ttl) if ttl else result  # type: ignore
+        commands = [
+            ('hsetnx', (hash_name, key, value), {}),
+            *([('expire', (hash_name, ttl), {})] if ttl else []),
+        ]
+        return self._command_many(commands, invalidate=(hash_name,))
 
-    def hget(self, hash_name: str) -> dict[bytes, bytes]:
-        """
-        Reading data of HashMap structure
-        """
-        return self.db.hgetall(hash_name)
+    def hget(self, hash_name: str, raw: bool = False) -> dict[bytes, bytes]:
+        """
+        Reading data of HashMap structure (`raw` keeps the values as bytes)
+        """
+        if raw:
+            return self._read(
+                hash_name,
+                'execute_command',
+                'HGETALL',
+                hash_name,
+                callback=lambda data: {key.decode(): data[key] for key in data},
+                NEVER_DECODE=True,
+            )
+
+        return self._read(hash_name, 'hgetall', hash_name, callback=dict)
 
     def hget_key(self, hash_name: str, key: str) -> bytes | None:
         """
         Reading a field of HashMap structure
         """
-        return self.db.hget(hash_name, key)
+        if self.read_local:
+            return self._read(
+                hash_name, 'hgetall', hash_name, callback=lambda data: data.get(key)
+            )
+
+        return self._command('hget', hash_name, key)
+
+    def hget_keys(self, hash_name: str, *keys: str) -> list:
+        """
+        Reading some fields of HashMap structure
+        """
+        return self._command('hmget', hash_name, keys)
 
     def hdel(self, hash_name: str) -> int:
         """
         Delete a HashMap data
         """
-        return self.db.delete(hash_name)
+        return self._command('delete', hash_name, write=True, invalidate=(hash_name,))
 
     def hdel_key(self, hash_name: str, key: str) -> int:
         """
         Delete a field of HashMap structure
         """
-        return self.db.hdel(hash_name, key)
+        return self._command(
+            'hdel', hash_name, key, write=True, invalidate=(hash_name,)
+        )
 
     def hincr_key(self, hash_name: str, key: str, amount: int = 1) -> int:
         """
         Increase value of a key in HashMap structure
         """
-        return self.db.hincrby(hash_name, key, amount)
+        return self._command('hincrby', hash_name, key, amount, invalidate=(hash_name,))
 
     def flush_db(self) -> bool:
         """
         Delete all data that stored in selected redis db
         """
-        return self.db.flushdb()
+        self._flush()
+        result = self.db.flushdb()
+        self.local.clear(publish=True) if self.local else None
+        return result
 
     def flush_all(self) -> bool:
         """
         Delete all data that stored in entire redis
         """
-        return self.db.flushall()
+        self._flush()
+        result = self.db.flushall()
+        if self.local:
+            for local in local_caches.values():
+                local.clear(publish=True)
+
+        return result
+
+    def run_script(self, script, keys: list, args: list) -> Any:
+        """
+        Run a LuaScript atomically on the server, it is loaded when the
+        server does not have it yet. The keys must share a `{tag}` to run on
+        a sharded or cluster cache.
+
+        It returns the result of the script at once, also in an explicit
+        batch (the commands queued before it are sent first).
+        """
+        command = (script.sha, len(keys), *keys, *args)
+
+        def run():
+            batch = get_batch(self.number, self.db)
+            if batch is None or batch.deferred:
+                return self._command('evalsha', *command)
+
+            batch.flush()
+            return self.db.evalsha(*command)
+
+        try:
+            return run()
+        except NoScriptError:
+            self.db.script_load(script.source)
+            return run()
@@ -1,20 +1,77 @@
+import asyncio
 import functools
+import hashlib
 import json
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import ClassVar, Optional
+from typing import Callable, ClassVar, Optional
 
 from django.conf import settings
+from django.db.models.base import ModelBase
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.utils.translation import get_language_from_request
+from redis import RedisError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.serializers import SerializerMetaclass
 
+from .async_redis_cache import AsyncCacheManagement
+from .metrics import api_cache_payload_bytes, api_cache_requests
 from .redis_cache import CacheManagement
+from .redis_lock import AsyncCacheLock, CacheLock
 
 
 @dataclass
 class ApiCache:
     """
     A class to use as decorator for caching API endpoints.
+
+    The final rendered body is stored with its content-type and status in a
+    HashMap, so a cache hit is returned as a raw HttpResponse without running
+    the DRF renderer again. Bodies bigger than REDIS_CACHE_COMPRESS_THRESHOLD
+    are stored compressed.
+
+    Regeneration of an expired entry is single-flight: one worker takes a
+    CacheLock and calls the API while the others serve the stale copy or
+    wait up to `lock_wait` seconds for the fresh one. With `soft_ttl` an
+    entry becomes stale after `soft_ttl` seconds and is refreshed before
+    its hard `ttl` expires. With `local_cache` hits are served from the
+    per-process local cache when REDIS_LOCAL_CACHE_ENABLED is set.
+
+    Entries are tagged with `API:{identifier}` and the given `tags`, which
+    are model classes or strings formatted with the view kwargs and
+    `user_id`, e.g. `tags=(Deck, 'deck:{pk}', 'user:{user_id}')`. They are
+    invalidated with CacheManagement.invalidate_tags.
+
+    The key holds the identifier, `attr_key` and `static_key` as they are
+    and a short hash of the filter params, path, format and the vary values.
+    `vary_on_user` keeps one entry per authenticated user (anonymous users
+    share one), `vary_on_language` one per language of Accept-Language,
+    `vary_on_version` one per client app version and `vary_on_headers` one
+    per value of the given request headers, e.g.
+
+        @ApiCache(identifier='dashboard', ttl=60, vary_on_user=True)
+
+    With `warmup`, a callable that returns the URLs of the endpoint (or
+    (url, headers) pairs), the entries are filled by `manage.py warm_cache`,
+    e.g. after a deploy:
+
+        @ApiCache(identifier='decks', ttl=3600, warmup=standard_deck_urls)
+
+    Every entry stores a hash of its body, which is sent as the ETag. A
+    request whose If-None-Match holds the hash of a fresh entry is answered
+    with 304 after reading only the hash, the body is not loaded. The
+    Cache-Control header gets `cache_control` with max-age from the TTL.
+
+    With `fail_open` a Redis error (e.g. an open circuit breaker) bypasses
+    the cache: the view is called and its response is returned uncached.
+
+    Async views are decorated with the same options and use
+    AsyncCacheManagement (without the local cache).
     """
 
     identifier: Optional[str] = None
@@ -23,11 +80,38 @@ class ApiCache:
     filters: Optional[SerializerMetaclass] = None
     ttl: Optional[int] = None
     allowed_status: int = 200
+    soft_ttl: Optional[int] = None
+    single_flight: bool = True
+    lock_timeout: int = settings.REDIS_API_CACHE_LOCK_TIMEOUT
+    lock_wait: float = settings.REDIS_API_CACHE_LOCK_WAIT
+    local_cache: bool = False
+    tags: tuple = ()
+    vary_on_user: bool = False
+    vary_on_language: bool = False
+    vary_on_version: bool = False
+    vary_on_headers: tuple = ()
+    etag: bool = True
+    cache_control: Optional[str] = settings.REDIS_API_CACHE_CONTROL
+    warmup: Optional[Callable] = None
+    fail_open: bool = settings.REDIS_API_CACHE_FAIL_OPEN
 
     _key_prefix: ClassVar[str] = settings.REDIS_API_CACHE_PREFIX
     _redis: CacheManagement = CacheManagement(
         db=settings.REDIS_CACHE_GENERAL_DB,
     )
+    _local_redis: ClassVar[CacheManagement] = CacheManagement(
+        db=settings.REDIS_CACHE_GENERAL_DB,
+        local_cache=True,
+    )
+    _async_redis: ClassVar[AsyncCacheManagement] = AsyncCacheManagement(
+        db=settings.REDIS_CACHE_GENERAL_DB,
+    )
+    # decorated endpoints that can be warmed up
+    _endpoints: ClassVar[list] = []
+
+    @property
+    def _cache(self) -> CacheManagement:
+        return self._local_redis if self.local_cache else self._redis
 
     def _get_request(self, *args) -> str:
         """
@@ -50,57 +134,406 @@ class ApiCache:
         if self.filters:
             filters_serializer = self.filters(data=request.query_params)
             filters_serializer.is_valid(raise_exception=True)
-            return json.dumps(filters_serializer.validated_data)
+            return json.dumps(
+                filters_serializer.validated_data, sort_keys=True, default=str
+            )
         return ''
 
+    def _get_renderer(self, request):
+        """
+        Return the negotiated renderer and media type of the request
+        """
+        renderer = getattr(request, 'accepted_renderer', None) or JSONRenderer()
+        media_type = getattr(request, 'accepted_media_type', None)
+        return renderer, media_type or renderer.media_type
+
+    @staticmethod
+    def _user_id(request) -> str:
+        return getattr(getattr(request, 'user', None), 'pk', None) or ''
+
+    @property
+    def _vary_headers(self) -> list:
+        """
+        Return the request headers that select the entry
+        """
+        headers = ['Accept-Language'] if self.vary_on_language else []
+        if self.vary_on_version:
+            headers.append(settings.REDIS_API_CACHE_VERSION_HEADER)
+        return headers + list(self.vary_on_headers)
+
+    def _vary_values(self, request) -> list:
+        """
+        Return the values of the request the entry varies on
+        """
+        values = [self._user_id(request)] if self.vary_on_user else []
+        if self.vary_on_language:
+            values.append(get_language_from_request(request))
+        if self.vary_on_version:
+            values.append(
+                request.headers.get(settings.REDIS_API_CACHE_VERSION_HEADER, '')
+            )
+        values.extend(
+            request.headers.get(header, '') for header in self.vary_on_headers
+        )
+        return values
+
+    @staticmethod
+    def _digest(*values) -> str:
+        """
+        Return a compact hash of the key parts
+        """
+        data = '\x1f'.join(str(value) for value in values).encode()
+        return hashlib.blake2b(data, digest_size=12).hexdigest()
+
     def _generate_hash_name(self, request, params, **kwargs) -> str:
         """
         Return hash_name to be use as storing name
         """
-        route = request.path
         attr_key = kwargs.get(self.attr_key, '')
-        return f'{self._key_prefix}:{self.identifier}:{attr_key}{self.static_key}:{params}:{route}'
+        renderer, _ = self._get_renderer(request)
+        digest = self._digest(
+            params, request.path, renderer.format, *self._vary_values(request)
+        )
+        return (
+            f'{self._key_prefix}:{self.identifier}:{attr_key}{self.static_key}:{digest}'
+        )
+
+    def _get_tags(self, request, **kwargs) -> list:
+        """
+        Return tags of the entry
+        """
+        user_id = self._user_id(request)
+        tags = [f'{self._key_prefix}:{self.identifier}']
+
+        for tag in self.tags:
+            if not isinstance(tag, ModelBase):
+                tag = tag.format(user_id=user_id, **kwargs)
+            tags.append(tag)
+
+        return tags
+
+    def _render(self, result: Response, request, *args) -> bytes:
+        """
+        Render the response once with the negotiated renderer
+        """
+        view = args[0] if len(args) > 1 else None
+        renderer, media_type = self._get_renderer(request)
+
+        result.accepted_renderer = renderer
+        result.accepted_media_type = media_type
+        result.renderer_context = (
+            view.get_renderer_context()
+            if hasattr(view, 'get_renderer_context')
+            else {'request': request, 'view': view}
+        )
+        result.render()
+        return result.content
+
+    def _etag_matches(self, request, etag: Optional[bytes | str]) -> bool:
+        """
+        Check the If-None-Match header of the request against an entry hash
+        """
+        header = request.META.get('HTTP_IF_NONE_MATCH')
+        if not self.etag or not header or not etag:
+            return False
+
+        etag = etag.decode() if isinstance(etag, bytes) else etag
+        etags = [tag.removeprefix('W/') for tag in parse_etags(header)]
+        return '*' in etags or f'"{etag}"' in etags
+
+    def _set_headers(self, response, etag, fresh_until=None):
+        """
+        Add the validator and freshness headers of a cached entry
+        """
+        if self.etag and etag:
+            etag = etag.decode() if isinstance(etag, bytes) else etag
+            response['ETag'] = f'"{etag}"'
+
+        if self.cache_control:
+            max_age = self.ttl
+            if self.soft_ttl and fresh_until:
+                max_age = max(int(float(fresh_until) - time.time()), 0)
+
+            freshness = 'no-cache' if max_age is None else f'max-age={max_age}'
+            response['Cache-Control'] = f'{self.cache_control}, {freshness}'
+
+        if headers := self._vary_headers:
+            patch_vary_headers(response, headers)
+
+        return response
+
+    def _not_modified(self, etag, fresh_until=None) -> HttpResponseNotModified:
+        api_cache_requests.inc(identifier=self.identifier, result='not_modified')
+        return self._set_headers(HttpResponseNotModified(), etag, fresh_until)
+
+    def _is_conditional(self, request) -> bool:
+        """
+        Check if the request can be answered from the stored hash only
+        """
+        return (
+            self.etag and not self.local_cache and 'HTTP_IF_NONE_MATCH' in request.META
+        )
+
+    def _revalidate(self, request, etag, fresh_until) -> Optional[HttpResponse]:
+        """
+        Return 304 when the client already has the fresh entry
+        """
+        data = {'fresh_until': fresh_until} if fresh_until else {}
+        if self._etag_matches(request, etag) and not self._is_stale(data):
+            return self._not_modified(etag, fresh_until)
+        return None
+
+    def _cached_response(
+        self, data: dict, request, result: str = 'hit'
+    ) -> HttpResponse:
+        """
+        Build a raw response from a stored entry
+        """
+        etag, fresh_until = data.get('etag'), data.get('fresh_until')
+        if self._etag_matches(request, etag):
+            return self._not_modified(etag, fresh_until)
+
+        api_cache_requests.inc(identifier=self.identifier, result=result)
+        response = HttpResponse(
+            self._cache.serializer.decompress(data['body']),
+            status=int(data['status']),
+            content_type=data['content_type'].decode(),
+        )
+        return self._set_headers(response, etag, fresh_until)
+
+    def _is_stale(self, data: dict) -> bool:
+        """
+        Check if a stored entry passed its soft TTL
+        """
+        if not self.soft_ttl:
+            return False
+        return float(data.get('fresh_until', 0)) <= time.time()
+
+    def _wait_for(self, hash_name: str, lock: CacheLock) -> dict:
+        """
+        Wait for the lock holder to store the entry and return it
+        """
+        lock.wait(self.lock_wait)
+        return self._cache.hget(hash_name, raw=True)
+
+    def _entry(self, result: Response, request, *args) -> Optional[dict]:
+        """
+        Render a cacheable response once and return the entry to store
+        """
+        # prevent null data or unwanted situations caching
+        if not result.data or result.status_code != self.allowed_status:
+            return None
+
+        self._render(result, request, *args)
+
+        entry = {
+            'body': self._cache.serializer.compress(result.content),
+            'content_type': result['Content-Type'],
+            'status': result.status_code,
+            'etag': hashlib.blake2b(result.content, digest_size=16).hexdigest(),
+        }
+
+        if self.soft_ttl:
+            entry['fresh_until'] = time.time() + self.soft_ttl
+
+        api_cache_payload_bytes.observe(len(entry['body']), identifier=self.identifier)
+        return entry
+
+    @contextmanager
+    def _keep_response(self):
+        """
+        Keep the response of the view when Redis fails after it was called
+        """
+        try:
+            yield
+        except RedisError:
+            if not self.fail_open:
+                raise
+            api_cache_requests.inc(identifier=self.identifier, result='error')
+
+    def _call(self, hash_name: str, request, function, *args, **kwargs):
+        """
+        Call the API and cache its rendered response
+        """
+        result = function(*args, **kwargs)
+
+        if not isinstance(result, Response):
+            return Response(
+                {'error': 'Response is not JSON-serializable'},
+                status=500,
+            )
+
+        if entry := self._entry(result, request, *args):
+            with self._keep_response():
+                tags = self._get_tags(request, **kwargs)
+                self._cache.hset(hash_name, entry, self.ttl, tags)
+            self._set_headers(result, entry['etag'], entry.get('fresh_until'))
+
+        return result
 
     def __call__(self, function):
         """
         Main functionality
         """
 
+        if self.warmup:
+            self._endpoints.append(self)
+
+        if asyncio.iscoroutinefunction(function):
+            return self._async_decorate(function)
+
         @functools.wraps(function)
         def decorated_function(*args, **kwargs):
             request = self._get_request(*args)
+
+            # only the cache is read here, the view is called once below
+            try:
+                response, hash_name, lock = lookup(request, **kwargs)
+            except RedisError:
+                if not self.fail_open:
+                    api_cache_requests.inc(identifier=self.identifier, result='error')
+                    raise
+
+                api_cache_requests.inc(identifier=self.identifier, result='bypass')
+                return function(*args, **kwargs)
+
+            if response is not None:
+                return response
+
+            api_cache_requests.inc(identifier=self.identifier, result='miss')
+            try:
+                return self._call(hash_name, request, function, *args, **kwargs)
+            finally:
+                with self._keep_response():
+                    lock.release() if lock else None
+
+        def lookup(request, **kwargs):
+            """
+            Return the cached response, or the key and the single flight
+            lock (when it was taken) to regenerate the entry with
+            """
             params = self._extract_params(request)
             hash_name = self._generate_hash_name(request, params, **kwargs)
 
+            # answer a conditional request from the stored hash only
+            if self._is_conditional(request):
+                fields = self._cache.hget_keys(hash_name, 'etag', 'fresh_until')
+                if response := self._revalidate(request, *fields):
+                    return response, hash_name, None
+
             # return previous cached data
-            if data := self._redis.get_key(hash_name):
-                json_data = json.loads(data)
+            data = self._cache.hget(hash_name, raw=True)
+            if data and not self._is_stale(data):
+                return self._cached_response(data, request), hash_name, None
 
-                return Response(
-                    json_data,
-                    status=self.allowed_status,
-                )
+            lock = CacheLock(self._redis, hash_name, self.lock_timeout)
+            locked = lock.accrue() if self.single_flight else False
 
-            # call the API
-            result = function(*args, **kwargs)
+            if self.single_flight and not locked:
+                # another worker is regenerating the entry
+                if data:
+                    response = self._cached_response(data, request, 'stale')
+                    return response, hash_name, None
+                if data := self._wait_for(hash_name, lock):
+                    response = self._cached_response(data, request, 'wait')
+                    return response, hash_name, None
 
-            if not isinstance(result, Response):
-                return Response(
-                    {'error': 'Response is not JSON-serializable'},
-                    status=500,
-                )
+            return None, hash_name, lock if locked else None
+
+        return decorated_function
 
-            # prevent null data or unwanted situations caching
-            if not result.data or result.status_code != self.allowed_status:
-                return result
+    async def _async_wait_for(self, hash_name: str, lock: AsyncCacheLock) -> dict:
+        """
+        Wait for the lock holder to store the entry and return it
+        """
+        await lock.wait(self.lock_wait)
+        return await self._async_redis.hget(hash_name, raw=True)
 
-            # cache the result
-            data_json = json.dumps(result.data)
-            self._redis.set_key(hash_name, data_json, self.ttl)
+    async def _async_call(self, hash_name: str, request, function, *args, **kwargs):
+        """
+        Call the async API and cache its rendered response
+        """
+        result = await function(*args, **kwargs)
 
+        if not isinstance(result, Response):
             return Response(
-                result.data,
-                status=self.allowed_status,
+                {'error': 'Response is not JSON-serializable'},
+                status=500,
             )
 
+        if entry := self._entry(result, request, *args):
+            with self._keep_response():
+                tags = self._get_tags(request, **kwargs)
+                await self._async_redis.hset(hash_name, entry, self.ttl, tags)
+            self._set_headers(result, entry['etag'], entry.get('fresh_until'))
+
+        return result
+
+    def _async_decorate(self, function):
+        """
+        Main functionality for async views
+        """
+
+        @functools.wraps(function)
+        async def decorated_function(*args, **kwargs):
+            request = self._get_request(*args)
+
+            # only the cache is read here, the view is called once below
+            try:
+                response, hash_name, lock = await lookup(request, **kwargs)
+            except RedisError:
+                if not self.fail_open:
+                    api_cache_requests.inc(identifier=self.identifier, result='error')
+                    raise
+
+                api_cache_requests.inc(identifier=self.identifier, result='bypass')
+                return await function(*args, **kwargs)
+
+            if response is not None:
+                return response
+
+            api_cache_requests.inc(identifier=self.identifier, result='miss')
+            try:
+                return await self._async_call(
+                    hash_name, request, function, *args, **kwargs
+                )
+            finally:
+                with self._keep_response():
+                    await lock.release() if lock else None
+
+        async def lookup(request, **kwargs):
+            """
+            Return the cached response, or the key and the single flight
+            lock (when it was taken) to regenerate the entry with
+            """
+            params = self._extract_params(request)
+            hash_name = self._generate_hash_name(request, params, **kwargs)
+
+            # answer a conditional request from the stored hash only
+            if self._is_conditional(request):
+                fields = await self._async_redis.hget_keys(
+                    hash_name, 'etag', 'fresh_until'
+                )
+                if response := self._revalidate(request, *fields):
+                    return response, hash_name, None
+
+            # return previous cached data
+            data = await self._async_redis.hget(hash_name, raw=True)
+            if data and not self._is_stale(data):
+                return self._cached_response(data, request), hash_name, None
+
+            lock = AsyncCacheLock(self._async_redis, hash_name, self.lock_timeout)
+            locked = await lock.accrue() if self.single_flight else False
+
+            if self.single_flight and not locked:
+                # another worker is regenerating the entry
+                if data:
+                    response = self._cached_response(data, request, 'stale')
+                    return response, hash_name, None
+                if data := await self._async_wait_for(hash_name, lock):
+                    response = self._cached_response(data, request, 'wait')
+                    return response, hash_name, None
+
+            return None, hash_name, lock if locked else None
+
         return decorated_function
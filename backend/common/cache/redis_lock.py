@@ -1,42 +1,342 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid as uuid_lib
 from dataclasses import dataclass
 from typing import Optional
 
-from common.cache import CacheManagement
+from django.conf import settings
 from redis import RedisError
 
+from .redis_cache import CacheManagement
+from .scripts import LuaScript
+
+logger = logging.getLogger(__name__)
+
+
+def _text(value) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _release(client, keys: list, args: list) -> int:
+    if _text(client.get(keys[0])) != _text(args[0]):
+        return 0
+    return client.delete(keys[0])
+
+
+def _extend(client, keys: list, args: list) -> int:
+    if _text(client.get(keys[0])) != _text(args[0]):
+        return 0
+    return int(client.pexpire(keys[0], int(args[1])))
+
+
+# delete / extend the lock only when it still holds the token of the owner
+RELEASE = LuaScript(
+    '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+''',
+    _release,
+)
+
+EXTEND = LuaScript(
+    '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+''',
+    _extend,
+)
+
+
+class LockTimeout(Exception):
+    """
+    The lock was not acquired in time
+    """
+
+
+def backoff(attempt: int) -> float:
+    """
+    Return the jittered exponential delay before the next attempt
+    """
+    delay = min(
+        settings.REDIS_LOCK_BACKOFF_MAX,
+        settings.REDIS_LOCK_BACKOFF_MIN * 2**attempt,
+    )
+    return delay * random.uniform(0.5, 1)
+
 
 @dataclass
 class CacheLock:
+    """
+    A distributed lock on the `lock_{uuid}` key.
+
+    The key holds a random token of the owner, so release and extend only
+    touch a lock that is still ours (compare-and-delete in one script). It
+    expires after `expire` milliseconds unless the owner releases it, or
+    with `renew` a watchdog thread extends it every `expire / 3` until it
+    is released. `acquire` and `wait` block with a jittered exponential
+    backoff up to `timeout` seconds (None waits forever), e.g.
+
+        with CacheLock(cache, 'reports', expire=10000, timeout=5, renew=True):
+            build_reports()
+
+    Redis errors are raised, so a caller does not wait on a lock it can
+    not take; callers that may go on without the lock catch them.
+    """
 
     redis_con: CacheManagement
     uuid: str
-    expire: Optional[int] = 1
+    expire: Optional[int] = settings.REDIS_LOCK_TIMEOUT
+    timeout: Optional[float] = None
+    renew: bool = False
 
     def __post_init__(self):
+        if self.renew and not self.expire:
+            raise ValueError('A renewed lock needs an expire')
+
         self.uuid = f"lock_{self.uuid}"
+        self.token = None
+        self._watchdog = None
 
     def accrue(self) -> bool:
         """
         Try to use given uuid as lock
         """
+        token = uuid_lib.uuid4().hex
 
-        try:
-            pipe = self.redis_con.pipeline()
-            pipe.incr(self.uuid)
-            pipe.pexpire(self.uuid, self.expire)
-            result = pipe.execute()
+        if not self.redis_con.db.set(self.uuid, token, nx=True, px=self.expire):
+            return False
+
+        self.token = token
+        self._start_watchdog() if self.renew else None
+        return True
+
+    def acquire(self, blocking: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Take the lock, waiting up to `timeout` (or self.timeout) seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 0
 
-            if result[0] > 1:
+        while not self.accrue():
+            if not blocking or (deadline and time.monotonic() >= deadline):
                 return False
 
-        except RedisError:
+            delay = backoff(attempt)
+            if deadline:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+            attempt += 1
+
+        return True
+
+    def extend(self, expire: Optional[int] = None) -> bool:
+        """
+        Reset the expiry of an owned lock to `expire` milliseconds
+        """
+        if self.token is None:
+            return False
+
+        args = [self.token, expire or self.expire]
+        return bool(self.redis_con.run_script(EXTEND, [self.uuid], args))
+
+    def release(self) -> bool:
+        """
+        Delete the lock if it is still owned, return whether it was
+        """
+        self._stop_watchdog()
+        token, self.token = self.token, None
+
+        if token is None:
             return False
+        return bool(self.redis_con.run_script(RELEASE, [self.uuid], [token]))
+
+    def is_ready(self) -> bool:
+        """
+        Whether nobody holds the lock, read on the client so that an open
+        batch does not queue it
+        """
+        return not self.redis_con.db.exists(self.uuid)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until nobody holds the lock, without taking it
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 0
+
+        while not self.is_ready():
+            if deadline and time.monotonic() >= deadline:
+                return False
+
+            delay = backoff(attempt)
+            if deadline:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+            attempt += 1
 
         return True
 
-    def release(self) -> True:
-        self.redis_con.remove_key(self.uuid)
+    def _start_watchdog(self) -> None:
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._watch,
+            args=(stop,),
+            name=f'lock-watchdog:{self.uuid}',
+            daemon=True,
+        )
+        self._watchdog = stop
+        thread.start()
+
+    def _stop_watchdog(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.set()
+            self._watchdog = None
+
+    def _watch(self, stop: threading.Event) -> None:
+        """
+        Extend the lock every third of its expiry until it is released
+        """
+        while not stop.wait(self.expire / 3000):
+            try:
+                if not self.extend() and not stop.is_set():
+                    logger.warning(f'Lock {self.uuid} was lost before its release')
+                    return
+            except RedisError as e:
+                logger.warning(f'Lock {self.uuid} was not extended: {e}')
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout(f'{self.uuid} was not acquired in {self.timeout}s')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+@dataclass
+class AsyncCacheLock(CacheLock):
+    """
+    The asyncio version of CacheLock (redis_con is an AsyncCacheManagement),
+    its watchdog is a task of the running loop
+    """
+
+    async def accrue(self) -> bool:
+        """
+        Try to use given uuid as lock
+        """
+        token = uuid_lib.uuid4().hex
+
+        if not await self.redis_con.db.set(self.uuid, token, nx=True, px=self.expire):
+            return False
+
+        self.token = token
+        self._start_watchdog() if self.renew else None
+        return True
+
+    async def acquire(
+        self, blocking: bool = True, timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Take the lock, waiting up to `timeout` (or self.timeout) seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 0
+
+        while not await self.accrue():
+            if not blocking or (deadline and time.monotonic() >= deadline):
+                return False
+
+            delay = backoff(attempt)
+            if deadline:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        return True
+
+    async def extend(self, expire: Optional[int] = None) -> bool:
+        """
+        Reset the expiry of an owned lock to `expire` milliseconds
+        """
+        if self.token is None:
+            return False
+
+        args = [self.token, expire or self.expire]
+        return bool(await self.redis_con.run_script(EXTEND, [self.uuid], args))
+
+    async def release(self) -> bool:
+        """
+        Delete the lock if it is still owned, return whether it was
+        """
+        self._stop_watchdog()
+        token, self.token = self.token, None
+
+        if token is None:
+            return False
+        return bool(await self.redis_con.run_script(RELEASE, [self.uuid], [token]))
+
+    async def is_ready(self) -> bool:
+        """
+        Whether nobody holds the lock
+        """
+        return not await self.redis_con.db.exists(self.uuid)
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until nobody holds the lock, without taking it
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        attempt = 0
+
+        while not await self.is_ready():
+            if deadline and time.monotonic() >= deadline:
+                return False
+
+            delay = backoff(attempt)
+            if deadline:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            await asyncio.sleep(delay)
+            attempt += 1
+
         return True
 
-    def is_ready(self):
-        return not self.redis_con.is_exists(self.uuid)
+    def _start_watchdog(self) -> None:
+        self._watchdog = asyncio.get_running_loop().create_task(self._watch())
+
+    def _stop_watchdog(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    async def _watch(self) -> None:
+        """
+        Extend the lock every third of its expiry until it is released
+        """
+        while True:
+            await asyncio.sleep(self.expire / 3000)
+            try:
+                if not await self.extend():
+                    logger.warning(f'Lock {self.uuid} was lost before its release')
+                    return
+            except RedisError as e:
+                logger.warning(f'Lock {self.uuid} was not extended: {e}')
+
+    def __enter__(self):
+        raise TypeError('Use "async with" with AsyncCacheLock')
+
+    async def __aenter__(self):
+        if not await self.acquire():
+            raise LockTimeout(f'{self.uuid} was not acquired in {self.timeout}s')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
@@ -0,0 +1,332 @@
+import time
+import uuid as uuid_lib
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+
+from .memory import encode
+from .redis_lock import AsyncCacheLock, CacheLock
+from .redis_cache import CacheManagement
+from .scripts import LuaScript
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+def _token(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _expire_at_least(client, key, ms: int) -> None:
+    if client.pttl(key) < ms:
+        client._set_expiry(encode(key), ms / 1000)
+
+
+def _holders(client, key) -> dict:
+    holders = client._get(key, dict, create=True)
+    now = _now()
+    for token in [token for token, deadline in holders.items() if deadline <= now]:
+        del holders[token]
+    return holders
+
+
+def _acquire(client, keys: list, args: list) -> int:
+    token, limit = _token(args[0]), int(args[1])
+    lease, queue_ttl = int(args[2]), int(args[3])
+    now = _now()
+
+    holders = _holders(client, keys[0])
+    queue = client._get(keys[1], dict, create=True)
+    seen = client._get(keys[2], dict, create=True)
+    for waiter in [waiter for waiter, at in seen.items() if at <= now - queue_ttl]:
+        queue.pop(waiter, None)
+        del seen[waiter]
+
+    if token not in queue:
+        queue[token] = client.incrby(keys[3], 1)
+    seen[token] = now
+
+    for key in keys:
+        _expire_at_least(client, key, lease + queue_ttl)
+
+    rank = sorted(queue.values()).index(queue[token])
+    if rank >= limit - len(holders):
+        return 0
+
+    del queue[token], seen[token]
+    holders[token] = now + lease
+    return 1
+
+
+def _extend(client, keys: list, args: list) -> int:
+    holders = _holders(client, keys[0])
+    token = _token(args[0])
+    if token not in holders:
+        return 0
+
+    holders[token] = _now() + int(args[1])
+    _expire_at_least(client, keys[0], int(args[1]))
+    return 1
+
+
+def _release(client, keys: list, args: list) -> int:
+    token = _token(args[0])
+    for key in keys[1:3]:
+        client._get(key, dict, create=True).pop(token, None)
+    return int(client._get(keys[0], dict, create=True).pop(token, None) is not None)
+
+
+def _available(client, keys: list, args: list) -> int:
+    return int(args[0]) - len(_holders(client, keys[0]))
+
+
+# KEYS = holders (token -> lease deadline), queue (token -> ticket), seen
+# (token -> last attempt) and the ticket counter. ARGV = token, limit,
+# lease and queue TTL in ms. A caller takes a ticket on its first attempt
+# and becomes a holder when its rank in the queue is below the free slots,
+# so slots are given first come, first served. Expired leases and waiters
+# that stopped trying are dropped.
+ACQUIRE = LuaScript(
+    '''
+local holders, queue, seen, counter = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local token, limit = ARGV[1], tonumber(ARGV[2])
+local lease, queue_ttl = tonumber(ARGV[3]), tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+for _, waiter in ipairs(redis.call('ZRANGEBYSCORE', seen, '-inf', now - queue_ttl)) do
+  redis.call('ZREM', queue, waiter)
+  redis.call('ZREM', seen, waiter)
+end
+
+if not redis.call('ZSCORE', queue, token) then
+  redis.call('ZADD', queue, redis.call('INCR', counter), token)
+end
+redis.call('ZADD', seen, now, token)
+
+local expire = lease + queue_ttl
+for _, key in ipairs(KEYS) do
+  if redis.call('PTTL', key) < expire then
+    redis.call('PEXPIRE', key, expire)
+  end
+end
+
+if redis.call('ZRANK', queue, token) >= limit - redis.call('ZCARD', holders) then
+  return 0
+end
+
+redis.call('ZREM', queue, token)
+redis.call('ZREM', seen, token)
+redis.call('ZADD', holders, now + lease, token)
+return 1
+''',
+    _acquire,
+)
+
+# KEYS = holders, ARGV = token, lease in ms
+EXTEND = LuaScript(
+    '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+''',
+    _extend,
+)
+
+# KEYS = holders, queue, seen, ARGV = token
+RELEASE = LuaScript(
+    '''
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return redis.call('ZREM', KEYS[1], ARGV[1])
+''',
+    _release,
+)
+
+# KEYS = holders, ARGV = limit; returns the number of free slots
+AVAILABLE = LuaScript(
+    '''
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+return tonumber(ARGV[1]) - redis.call('ZCARD', KEYS[1])
+''',
+    _available,
+)
+
+
+@dataclass
+class CacheSemaphore(CacheLock):
+    """
+    A distributed counting semaphore that lets `limit` holders in at once,
+    e.g. to bound the concurrent calls to an external provider from all
+    workers.
+
+    Every holder has a lease of `expire` milliseconds, so the slot of a
+    crashed worker is freed; with `renew` a watchdog extends it. Waiters
+    are served in the order of their first attempt and give up after
+    `timeout` seconds (LockTimeout in the context manager), e.g.
+
+        with CacheSemaphore(cache, 'kavenegar', limit=4, timeout=5):
+            send()
+
+    Redis errors are raised, a semaphore does not fail open.
+    """
+
+    limit: int = 1
+    queue_ttl: int = settings.REDIS_SEMAPHORE_QUEUE_TTL
+
+    def __post_init__(self):
+        name = f'semaphore:{{{self.uuid}}}'
+        super().__post_init__()
+        self.keys = [f'{name}:{part}' for part in ('holders', 'queue', 'seen', 'id')]
+        self.ticket = None
+
+    def _acquire_args(self) -> list:
+        self.ticket = self.ticket or uuid_lib.uuid4().hex
+        return [self.ticket, self.limit, self.expire, self.queue_ttl]
+
+    def _acquired(self) -> bool:
+        self.token, self.ticket = self.ticket, None
+        self._start_watchdog() if self.renew else None
+        return True
+
+    def accrue(self) -> bool:
+        """
+        Try to take a slot, the first attempt takes a place in the queue
+        """
+        args = self._acquire_args()
+        if not self.redis_con.run_script(ACQUIRE, self.keys, args):
+            return False
+        return self._acquired()
+
+    def acquire(self, blocking: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Take a slot, waiting up to `timeout` (or self.timeout) seconds
+        """
+        if super().acquire(blocking, timeout):
+            return True
+
+        # leave the queue, so the next waiters are not held up
+        self._leave()
+        return False
+
+    def _leave(self) -> None:
+        ticket, self.ticket = self.ticket, None
+        self.redis_con.run_script(RELEASE, self.keys, [ticket]) if ticket else None
+
+    def extend(self, expire: Optional[int] = None) -> bool:
+        """
+        Renew the lease of the held slot for `expire` milliseconds
+        """
+        if self.token is None:
+            return False
+
+        args = [self.token, expire or self.expire]
+        return bool(self.redis_con.run_script(EXTEND, self.keys[:1], args))
+
+    def release(self) -> bool:
+        """
+        Free the held slot, return whether it was still held
+        """
+        self._stop_watchdog()
+        token, self.token = self.token, None
+
+        if token is None:
+            return False
+        return bool(self.redis_con.run_script(RELEASE, self.keys[:3], [token]))
+
+    def available(self) -> int:
+        """
+        Return the number of free slots
+        """
+        return self.redis_con.run_script(AVAILABLE, self.keys[:1], [self.limit])
+
+    def is_ready(self) -> bool:
+        return self.available() > 0
+
+
+@dataclass
+class AsyncCacheSemaphore(CacheSemaphore, AsyncCacheLock):
+    """
+    The asyncio version of CacheSemaphore (redis_con is an
+    AsyncCacheManagement)
+    """
+
+    async def accrue(self) -> bool:
+        """
+        Try to take a slot, the first attempt takes a place in the queue
+        """
+        args = self._acquire_args()
+        if not await self.redis_con.run_script(ACQUIRE, self.keys, args):
+            return False
+        return self._acquired()
+
+    async def acquire(
+        self, blocking: bool = True, timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Take a slot, waiting up to `timeout` (or self.timeout) seconds
+        """
+        if await AsyncCacheLock.acquire(self, blocking, timeout):
+            return True
+
+        ticket, self.ticket = self.ticket, None
+        if ticket:
+            await self.redis_con.run_script(RELEASE, self.keys, [ticket])
+        return False
+
+    async def extend(self, expire: Optional[int] = None) -> bool:
+        """
+        Renew the lease of the held slot for `expire` milliseconds
+        """
+        if self.token is None:
+            return False
+
+        args = [self.token, expire or self.expire]
+        return bool(await self.redis_con.run_script(EXTEND, self.keys[:1], args))
+
+    async def release(self) -> bool:
+        """
+        Free the held slot, return whether it was still held
+        """
+        self._stop_watchdog()
+        token, self.token = self.token, None
+
+        if token is None:
+            return False
+        return bool(await self.redis_con.run_script(RELEASE, self.keys[:3], [token]))
+
+    async def available(self) -> int:
+        """
+        Return the number of free slots
+        """
+        return await self.redis_con.run_script(AVAILABLE, self.keys[:1], [self.limit])
+
+    async def is_ready(self) -> bool:
+        return await self.available() > 0
+
+
+_providers = CacheManagement(db=settings.REDIS_CACHE_GENERAL_DB)
+
+
+def provider_semaphore(name: str, **options) -> CacheSemaphore:
+    """
+    Return the semaphore of an external provider configured in
+    REDIS_PROVIDER_CONCURRENCY, e.g.
+
+        with provider_semaphore('kavenegar'):
+            requests.post(...)
+    """
+    options = {**settings.REDIS_PROVIDER_CONCURRENCY.get(name, {}), **options}
+    return CacheSemaphore(_providers, f'provider:{name}', **options)
@@ -0,0 +1,19 @@
+import hashlib
+from typing import Callable
+
+from . import memory
+
+
+class LuaScript:
+    """
+    A Lua script that is run by its SHA1 with EVALSHA.
+
+    `function(client, keys, args)` is the python version of the script,
+    which the in-memory backend runs under its lock instead of the Lua
+    code, so both must behave the same.
+    """
+
+    def __init__(self, source: str, function: Callable) -> None:
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+        memory.scripts[self.sha] = function
@@ -0,0 +1,287 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from collections import defaultdict
+from typing import Any, Iterable
+
+
+def hash_tag(key: str | bytes) -> bytes:
+    """
+    Return the part of the key that is hashed. Like Redis Cluster, only the
+    text between the first `{` and the next `}` is used when it is not
+    empty, so `user:{42}:cart` and `user:{42}:likes` live on the same node.
+    """
+    key = key if isinstance(key, bytes) else str(key).encode()
+
+    if (start := key.find(b'{')) > -1:
+        start += 1
+        end = key.find(b'}', start)
+        if end > start:
+            return key[start:end]
+
+    return key
+
+
+def command_key(args: tuple) -> str | bytes:
+    """
+    Return the key that routes a raw command, the first key of a script
+    """
+    if str(args[0]).upper() in ('EVAL', 'EVALSHA'):
+        return args[3]
+    return args[1]
+
+
+class HashRing:
+    """
+    Consistent hashing of keys over nodes. Every node is placed `replicas`
+    times on the ring, so adding or removing a node moves only about
+    1/len(nodes) of the keys.
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 160) -> None:
+        ring = sorted(
+            (self._hash(f'{node}-{replica}'.encode()), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(data: bytes) -> int:
+        return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+    def get_node(self, key: str | bytes) -> int:
+        """
+        Return index of the node that owns the key
+        """
+        index = bisect(self._hashes, self._hash(hash_tag(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+# commands that take several keys, they are split per node and the results
+# are added up
+MULTI_KEY_COMMANDS = {'delete', 'unlink', 'exists', 'touch'}
+
+
+class ShardedPipeline:
+    """
+    One pipeline per node. Results are returned in the order the commands
+    were queued. With `transaction` each node runs its part in MULTI/EXEC,
+    which is atomic per node only.
+    """
+
+    def __init__(self, client: 'ShardedRedis', transaction: bool = True) -> None:
+        self.client = client
+        self.transaction = transaction
+        self.pipes = {}
+        # (node, position) parts of every queued command
+        self.commands = []
+
+    def _pipe(self, node: int):
+        if (pipe := self.pipes.get(node)) is None:
+            pipe = self.pipes[node] = self.client.clients[node].pipeline(
+                transaction=self.transaction
+            )
+        return pipe
+
+    def _queue(self, node: int, name: str, *args, **kwargs) -> tuple:
+        pipe = self._pipe(node)
+        getattr(pipe, name)(*args, **kwargs)
+        return node, len(pipe) - 1
+
+    def execute_command(self, *args, **options) -> 'ShardedPipeline':
+        node = self.client.ring.get_node(command_key(args))
+        self.commands.append([self._queue(node, 'execute_command', *args, **options)])
+        return self
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name in MULTI_KEY_COMMANDS:
+                parts = [
+                    self._queue(node, name, *keys, **kwargs)
+                    for node, keys in self.client.split(args).items()
+                ]
+            else:
+                node = self.client.ring.get_node(args[0])
+                parts = [self._queue(node, name, *args, **kwargs)]
+
+            self.commands.append(parts)
+            return self
+
+        return command
+
+    def evalsha(self, sha, numkeys: int, *keys_and_args) -> 'ShardedPipeline':
+        # routed by the first key, the keys of a script must share a node
+        node = self.client.ring.get_node(keys_and_args[0])
+        parts = [self._queue(node, 'evalsha', sha, numkeys, *keys_and_args)]
+        self.commands.append(parts)
+        return self
+
+    def publish(self, channel, message) -> 'ShardedPipeline':
+        # on the first node, like ShardedRedis.publish
+        self.commands.append([self._queue(0, 'publish', channel, message)])
+        return self
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def _collect(self, results: dict) -> list:
+        collected = []
+
+        for parts in self.commands:
+            values = [results[node][position] for node, position in parts]
+            errors = [value for value in values if isinstance(value, Exception)]
+            collected.append(
+                errors[0] if errors else values[0] if len(values) == 1 else sum(values)
+            )
+
+        self.pipes, self.commands = {}, []
+        return collected
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        results = {
+            node: pipe.execute(raise_on_error=raise_on_error)
+            for node, pipe in self.pipes.items()
+        }
+        return self._collect(results)
+
+
+class ShardedRedis:
+    """
+    A client that spreads keys over standalone Redis servers by consistent
+    hashing. Single-key commands are sent to the owner of the key,
+    multi-key deletes are split per node and server-wide commands (keys,
+    scan, flush) run on every node. Pub/sub uses the first node.
+    """
+
+    pipeline_class = ShardedPipeline
+
+    def __init__(self, clients: list, names: list, replicas: int = 160) -> None:
+        self.clients = clients
+        self.ring = HashRing(names, replicas)
+
+    def get_client(self, key: str | bytes):
+        return self.clients[self.ring.get_node(key)]
+
+    def split(self, keys: Iterable) -> dict:
+        nodes = defaultdict(list)
+        for key in keys:
+            nodes[self.ring.get_node(key)].append(key)
+        return nodes
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.get_client(key), name)(key, *args, **kwargs)
+
+        return command
+
+    def execute_command(self, *args, **options) -> Any:
+        return self.get_client(command_key(args)).execute_command(*args, **options)
+
+    def _multi_key(self, name: str, *keys) -> int:
+        return sum(
+            getattr(self.clients[node], name)(*keys)
+            for node, keys in self.split(keys).items()
+        )
+
+    def delete(self, *keys) -> int:
+        return self._multi_key('delete', *keys)
+
+    def unlink(self, *keys) -> int:
+        return self._multi_key('unlink', *keys)
+
+    def exists(self, *keys) -> int:
+        return self._multi_key('exists', *keys)
+
+    def keys(self, pattern: str = '*') -> list:
+        return [key for client in self.clients for key in client.keys(pattern)]
+
+    def scan_iter(self, *args, **kwargs):
+        for client in self.clients:
+            yield from client.scan_iter(*args, **kwargs)
+
+    def flushdb(self) -> bool:
+        return all([client.flushdb() for client in self.clients])
+
+    def flushall(self) -> bool:
+        return all([client.flushall() for client in self.clients])
+
+    def ping(self) -> bool:
+        return all([client.ping() for client in self.clients])
+
+    def evalsha(self, sha, numkeys: int, *keys_and_args) -> Any:
+        client = self.get_client(keys_and_args[0])
+        return client.evalsha(sha, numkeys, *keys_and_args)
+
+    def script_load(self, script: str) -> str:
+        return [client.script_load(script) for client in self.clients][0]
+
+    def publish(self, channel: str, message: str) -> int:
+        return self.clients[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.clients[0].pubsub(**kwargs)
+
+    def pipeline(self, transaction: bool = True) -> ShardedPipeline:
+        return self.pipeline_class(self, transaction)
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+    async def execute(self, raise_on_error: bool = True) -> list:
+        nodes = list(self.pipes)
+        results = await asyncio.gather(
+            *(self.pipes[node].execute(raise_on_error=raise_on_error) for node in nodes)
+        )
+        return self._collect(dict(zip(nodes, results)))
+
+
+class AsyncShardedRedis(ShardedRedis):
+    """
+    The asyncio version of ShardedRedis
+    """
+
+    pipeline_class = AsyncShardedPipeline
+
+    async def _multi_key(self, name: str, *keys) -> int:
+        results = await asyncio.gather(
+            *(
+                getattr(self.clients[node], name)(*keys)
+                for node, keys in self.split(keys).items()
+            )
+        )
+        return sum(results)
+
+    async def _all(self, name: str, *args) -> list:
+        return await asyncio.gather(
+            *(getattr(client, name)(*args) for client in self.clients)
+        )
+
+    async def keys(self, pattern: str = '*') -> list:
+        return [key for keys in await self._all('keys', pattern) for key in keys]
+
+    async def scan_iter(self, *args, **kwargs):
+        for client in self.clients:
+            async for key in client.scan_iter(*args, **kwargs):
+                yield key
+
+    async def flushdb(self) -> bool:
+        return all(await self._all('flushdb'))
+
+    async def flushall(self) -> bool:
+        return all(await self._all('flushall'))
+
+    async def ping(self) -> bool:
+        return all(await self._all('ping'))
+
+    async def script_load(self, script: str) -> str:
+        return (await self._all('script_load', script))[0]
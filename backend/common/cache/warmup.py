@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from importlib import import_module
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.test import RequestFactory
+from django.urls import resolve
+
+from .redis_decorator import ApiCache
+
+
+class Pacer:
+    """
+    Spread calls of several threads evenly at `rate` calls per second
+    """
+
+    def __init__(self, rate: Optional[float]) -> None:
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_call, now)
+            self.next_call = slot + self.interval
+
+        time.sleep(max(slot - now, 0))
+
+
+@dataclass
+class WarmupTask:
+    endpoint: ApiCache
+    url: str
+    headers: dict
+
+
+def endpoints(identifiers: Iterable[str] = ()) -> list[ApiCache]:
+    """
+    Return the ApiCache endpoints that have a `warmup` (importing the
+    URLconf registers every view)
+    """
+    import_module(settings.ROOT_URLCONF)
+    identifiers = set(identifiers)
+    return [
+        endpoint
+        for endpoint in ApiCache._endpoints
+        if not identifiers or endpoint.identifier in identifiers
+    ]
+
+
+def tasks(endpoints: Iterable[ApiCache]) -> list[WarmupTask]:
+    """
+    Expand the parameter spaces of the endpoints to requests
+    """
+    result = []
+
+    for endpoint in endpoints:
+        for item in endpoint.warmup():
+            url, headers = item if isinstance(item, tuple) else (item, {})
+            result.append(WarmupTask(endpoint, url, headers))
+
+    return result
+
+
+def fetch(task: WarmupTask) -> int:
+    """
+    Call the view of the URL like an anonymous client and return the status
+    """
+    factory = RequestFactory()
+    headers = {'Accept': 'application/json', **task.headers}
+
+    try:
+        request = factory.get(task.url, headers=headers)
+        match = resolve(urlsplit(task.url).path)
+        response = match.func(request, *match.args, **match.kwargs)
+
+        if asyncio.iscoroutine(response):
+            response = asyncio.run(response)
+
+        return response.status_code
+    finally:
+        connections.close_all()
+
+
+def warm_up(
+    identifiers: Iterable[str] = (),
+    workers: int = settings.REDIS_CACHE_WARMUP_WORKERS,
+    rate: Optional[float] = settings.REDIS_CACHE_WARMUP_RATE,
+    force: bool = False,
+    log=None,
+) -> Counter:
+    """
+    Fill the ApiCache entries of the registered endpoints with a bounded
+    thread pool, at most `rate` requests per second. With `force` the
+    entries are invalidated first, so they are regenerated. Return the
+    number of responses by status (`error` for exceptions).
+    """
+    selected = endpoints(identifiers)
+
+    if force:
+        for endpoint in selected:
+            endpoint._redis.invalidate_tags(
+                f'{endpoint._key_prefix}:{endpoint.identifier}'
+            )
+
+    pacer = Pacer(rate)
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def run(task: WarmupTask) -> None:
+        pacer.wait()
+        try:
+            status = fetch(task)
+        except Exception as error:
+            status = 'error'
+            log(f'{task.url}: {error!r}') if log else None
+
+        with lock:
+            statuses[status] += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, tasks(selected)))
+
+    return statuses
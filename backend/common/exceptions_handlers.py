@@ -1,7 +1,9 @@
+import math
 import socket
 
 from django.core.exceptions import PermissionDenied
 from django.core.exceptions import ValidationError as DjangoValidationError
+from redis import RedisError
 from rest_framework import exceptions, status
 from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.serializers import as_serializer_error
@@ -16,6 +18,18 @@ class CustomSocketError(APIException):
     default_code = "socket_error"
 
 
+class CacheUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The service is temporarily unavailable, please try again later."
+    default_code = "cache_unavailable"
+
+    def __init__(self, retry_after=None):
+        super().__init__()
+        self.headers = (
+            {'Retry-After': str(math.ceil(retry_after))} if retry_after else {}
+        )
+
+
 def custom_exception_handler(exc, ctx):
     if isinstance(exc, DjangoValidationError):
         exc = exceptions.ValidationError(as_serializer_error(exc))
@@ -23,12 +37,19 @@ def custom_exception_handler(exc, ctx):
     if isinstance(exc, PermissionDenied):
         exc = exceptions.PermissionDenied()
 
+    # Redis failures the feature does not degrade, e.g. storing an OTP
+    if isinstance(exc, RedisError):
+        exc = CacheUnavailable(getattr(exc, 'retry_after', None))
+
     if isinstance(exc, socket.error):
         exc = CustomSocketError()
 
     response = exception_handler(exc, ctx)
 
     if response is not None:
+        for header, value in getattr(exc, 'headers', {}).items():
+            response[header] = value
+
         if isinstance(exc, ValidationError) and hasattr(response.data, "items"):
             for field, errors in response.data.items():
                 obj = "".join(list(field)).title()
@@ -0,0 +1,73 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.sms import SMSClient
+from common.sms.fake import FakeSMSProvider
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Serve a fake Kavenegar API (point SMS_PROVIDER_URL at it), or '
+        'benchmark the SMS client against it with --benchmark'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8025)
+        parser.add_argument(
+            '--latency', type=float, default=0, help='seconds per request'
+        )
+        parser.add_argument(
+            '--failure-rate', type=float, default=0, help='share of 503 replies'
+        )
+        parser.add_argument(
+            '--benchmark',
+            type=int,
+            default=0,
+            help='send this many messages through SMSClient and exit',
+        )
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        provider = FakeSMSProvider(
+            port=options['port'],
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+        )
+
+        if options['benchmark']:
+            with provider:
+                self.benchmark(provider, options['benchmark'], options['workers'])
+            return
+
+        self.stdout.write(f'Fake SMS provider on {provider.url}')
+        try:
+            provider.server.serve_forever()
+        except KeyboardInterrupt:
+            provider.server.server_close()
+
+    def benchmark(self, provider, count, workers):
+        client = SMSClient(url=provider.url, api_key='benchmark')
+
+        def send(index):
+            started = time.perf_counter()
+            sent = client.send(f'+98912{index:07d}', 'benchmark')
+            return sent, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(send, range(count)))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for _, latency in results)
+        p50, p99 = (latencies[int(len(latencies) * q)] for q in (0.5, 0.99))
+        sent = sum(ok for ok, _ in results)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Sent {sent}/{count} in {elapsed:.2f}s '
+                f'({count / elapsed:.0f}/s) over {provider.connections} '
+                f'connections, mean {statistics.mean(latencies) * 1000:.1f}ms, '
+                f'p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms'
+            )
+        )
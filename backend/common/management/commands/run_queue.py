@@ -0,0 +1,44 @@
+import threading
+
+from common.cache.queue import queues
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import autodiscover_modules
+
+
+class Command(BaseCommand):
+    help = 'Run the jobs of TaskQueues (the tasks modules of the apps are loaded)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='+', help='TaskQueue names')
+        parser.add_argument(
+            '--burst', action='store_true', help='stop when the queues are empty'
+        )
+
+    def handle(self, *args, **options):
+        autodiscover_modules('tasks')
+
+        if unknown := set(options['queues']) - set(queues):
+            raise CommandError(f'Unknown queues: {", ".join(sorted(unknown))}')
+
+        stop = threading.Event()
+        workers = [
+            threading.Thread(
+                target=queues[name].work,
+                args=(stop, options['burst']),
+                name=f'queue-worker:{name}',
+            )
+            for name in options['queues']
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1)
+        except KeyboardInterrupt:
+            stop.set()
+            self.stderr.write('Stopping after the running jobs')
+            for worker in workers:
+                worker.join()
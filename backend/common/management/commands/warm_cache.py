@@ -0,0 +1,44 @@
+from common.cache.warmup import endpoints, warm_up
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Fill the ApiCache entries of the endpoints that define a warmup'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'identifiers', nargs='*', help='ApiCache identifiers (default: all)'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.REDIS_CACHE_WARMUP_WORKERS
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=settings.REDIS_CACHE_WARMUP_RATE,
+            help='requests per second, 0 for no limit',
+        )
+        parser.add_argument(
+            '--force', action='store_true', help='regenerate the existing entries'
+        )
+        parser.add_argument(
+            '--list', action='store_true', help='only print the endpoints'
+        )
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for endpoint in endpoints(options['identifiers']):
+                self.stdout.write(endpoint.identifier)
+            return
+
+        statuses = warm_up(
+            options['identifiers'],
+            workers=options['workers'],
+            rate=options['rate'],
+            force=options['force'],
+            log=self.stderr.write,
+        )
+
+        summary = ', '.join(f'{status}: {count}' for status, count in statuses.items())
+        self.stdout.write(self.style.SUCCESS(f'Warmed up {summary or "nothing"}'))
@@ -0,0 +1,160 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+    Base of the in-process metrics, rendered in Prometheus text format.
+    Values are kept per process (per gunicorn worker).
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key: tuple, **extra) -> str:
+        pairs = [*zip(self.labels, key), *extra.items()]
+        if not pairs:
+            return ''
+        labels = ','.join(f'{name}="{value}"' for name, value in pairs)
+        return f'{{{labels}}}'
+
+    def samples(self) -> list:
+        with self._lock:
+            return [
+                f'{self.name}{self._format_labels(key)} {value}'
+                for key, value in self._values.items()
+            ]
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(),
+        ]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {} if self.labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With `collect` the values are read when
+    the metric is rendered, it returns a list of (labels, value).
+    """
+
+    type = 'gauge'
+
+    def __init__(self, *args, collect: Optional[Callable] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list:
+        if self.collect:
+            values = {self._key(labels): value for labels, value in self.collect()}
+            with self._lock:
+                self._values = values
+
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Iterable = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            index = bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> list:
+        lines = []
+
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = self._format_labels(key, le=bucket)
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+                labels = self._format_labels(key, le='+Inf')
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Keep the metrics of the process by name
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: Iterable = ()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable = (), **kwargs):
+        return self.register(Gauge(name, documentation, labels, **kwargs))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable = (), **kwargs):
+        return self.register(Histogram(name, documentation, labels, **kwargs))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
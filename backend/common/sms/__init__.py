@@ -0,0 +1 @@
+from common.sms.client import RetryBudget, SMSClient, SMSError, sms_client  # noqa
@@ -0,0 +1,257 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import requests
+from common.cache import LockTimeout, provider_semaphore
+from common.metrics import registry
+from django.conf import settings
+from redis import RedisError
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+sms_request_duration = registry.histogram(
+    'sms_request_seconds',
+    'Latency of the calls to the SMS provider by result (ok, error or retry)',
+    labels=('result',),
+)
+
+sms_retries = registry.counter(
+    'sms_retries_total',
+    'Calls to the SMS provider sent again after a transient error',
+)
+
+sms_retry_budget_exhausted = registry.counter(
+    'sms_retry_budget_exhausted_total',
+    'Transient errors that were not retried because the retry budget was spent',
+)
+
+
+class SMSError(Exception):
+    """
+    The provider did not accept a message, `transient` errors (connection
+    errors, 429 and 5xx) may succeed when retried. The others are
+    rejections, or ambiguous like a read timeout after which the message
+    may have been sent.
+    """
+
+    def __init__(self, message: str, transient: bool = False):
+        super().__init__(message)
+        self.transient = transient
+
+
+class RetryBudget:
+    """
+    Allow retries for at most `ratio` of the calls of the last `window`
+    seconds, plus `minimum` retries for the quiet times. When the provider
+    is down the calls fail fast instead of being sent `attempts` times.
+    """
+
+    def __init__(
+        self,
+        ratio: float = settings.SMS_RETRY_BUDGET_RATIO,
+        minimum: int = settings.SMS_RETRY_BUDGET_MIN,
+        window: float = settings.SMS_RETRY_BUDGET_WINDOW,
+    ) -> None:
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.calls = deque()
+        self.retries = deque()
+        self.lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        for times in (self.calls, self.retries):
+            while times and times[0] <= now - self.window:
+                times.popleft()
+
+    def record_call(self) -> None:
+        with self.lock:
+            self.calls.append(time.monotonic())
+
+    def can_retry(self) -> bool:
+        """
+        Whether a retry is in the budget, it is spent when it is
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            self._prune(now)
+            if len(self.retries) >= self.minimum + self.ratio * len(self.calls):
+                return False
+
+            self.retries.append(now)
+            return True
+
+
+class SMSClient:
+    """
+    Client of the Kavenegar REST API (https://kavenegar.com/rest.html)
+    for every SMS of the project.
+
+    Calls share one keep-alive session per process, so they reuse pooled
+    TLS connections instead of a new handshake per message. Every attempt
+    runs in the `kavenegar` provider semaphore and transient errors are
+    retried with a jittered exponential backoff, within the RetryBudget.
+    Read timeouts are not retried, the message may have been sent.
+    """
+
+    def __init__(
+        self,
+        url: str = settings.SMS_PROVIDER_URL,
+        api_key: str = settings.KAVEH_NEGAR_API_KEY,
+        sender: str = settings.SMS_SENDER,
+        pool_size: int = settings.SMS_POOL_SIZE,
+        timeout: tuple = (settings.SMS_CONNECT_TIMEOUT, settings.SMS_READ_TIMEOUT),
+        attempts: int = settings.SMS_RETRY_ATTEMPTS,
+        budget: Optional[RetryBudget] = None,
+    ) -> None:
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.sender = sender
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.attempts = attempts
+        self.budget = budget or RetryBudget()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        The pooled session of this process (a new one after fork)
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session, self._pid = session, os.getpid()
+
+        return self._session
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = self._pid = None
+
+    def _post(self, method: str, data: dict) -> dict:
+        """
+        Send one request, the reply of the API is checked
+        """
+        url = f'{self.url}/{self.api_key}/{method}.json'
+
+        try:
+            with provider_semaphore('kavenegar'):
+                response = self.session.post(url, data=data, timeout=self.timeout)
+        except requests.ConnectionError as e:
+            raise SMSError(f'Connection failed: {e}', transient=True) from e
+        except requests.RequestException as e:
+            raise SMSError(f'Request failed: {e}') from e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise SMSError(f'HTTP {response.status_code}', transient=True)
+
+        try:
+            reply = response.json()
+        except ValueError:
+            raise SMSError(f'Invalid JSON reply (HTTP {response.status_code})')
+
+        status = reply.get('return', {})
+        if status.get('status') != 200:
+            message = status.get('message', 'Unknown error')
+            raise SMSError(f'{status.get("status")}: {message}')
+
+        return reply
+
+    def call(self, method: str, data: dict) -> dict:
+        """
+        Call an API method (e.g. 'sms/send'), retrying transient errors
+        """
+        self.budget.record_call()
+        attempt = 1
+
+        while True:
+            started = time.perf_counter()
+            try:
+                reply = self._post(method, data)
+            except SMSError as e:
+                retry = e.transient and attempt < self.attempts
+                if retry and not self.budget.can_retry():
+                    sms_retry_budget_exhausted.inc()
+                    retry = False
+
+                result = 'retry' if retry else 'error'
+                sms_request_duration.observe(
+                    time.perf_counter() - started, result=result
+                )
+                if not retry:
+                    raise
+
+                logger.warning(f'SMS provider call failed, retrying: {e}')
+                sms_retries.inc()
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            sms_request_duration.observe(time.perf_counter() - started, result='ok')
+            return reply
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        delay = min(
+            settings.SMS_RETRY_BACKOFF_MAX,
+            settings.SMS_RETRY_BACKOFF * 2 ** (attempt - 1),
+        )
+        return delay * random.uniform(0.5, 1)
+
+    def deliver(self, receptor: str, message: str) -> dict:
+        """
+        Send an SMS, raise SMSError when the provider did not accept it.
+        Only `transient` errors are safe to try again: a rejected message
+        fails again and a timed out one may have been sent.
+        """
+        if not self.api_key:
+            raise SMSError('SMS provider API key not configured')
+
+        if not receptor or not message:
+            raise SMSError('Missing phone number or message')
+
+        data = {'receptor': receptor, 'message': message, 'sender': self.sender}
+
+        try:
+            reply = self.call('sms/send', data)
+        except (LockTimeout, RedisError) as e:
+            # nothing was sent
+            raise SMSError(
+                f'SMS provider concurrency slot not acquired: {e}', transient=True
+            ) from e
+
+        logger.info(f"SMS sent to {receptor}")
+        return reply
+
+    def send(self, receptor: str, message: str) -> bool:
+        """
+        Send an SMS, return whether the provider accepted it
+        """
+        try:
+            self.deliver(receptor, message)
+        except SMSError as e:
+            logger.error(f"SMS to {receptor} failed: {e}")
+            return False
+
+        return True
+
+
+sms_client = SMSClient()
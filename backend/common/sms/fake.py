@@ -0,0 +1,146 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs
+
+
+class FakeSMSHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real API
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.provider.connected()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code: int, status: int, message: str, entries=None) -> None:
+        body = json.dumps(
+            {'return': {'status': status, 'message': message}, 'entries': entries}
+        ).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = {
+            name: values[0]
+            for name, values in parse_qs(self.rfile.read(length).decode()).items()
+        }
+        provider = self.server.provider
+
+        if provider.latency:
+            time.sleep(provider.latency)
+
+        if (code := provider.failure()) is not None:
+            self._reply(code, code, 'Fake failure')
+            return
+
+        if not self.path.endswith('/sms/send.json'):
+            self._reply(404, 404, 'Unknown method')
+            return
+
+        if not data.get('receptor') or not data.get('message'):
+            self._reply(400, 411, 'Invalid receptor or message')
+            return
+
+        entry = provider.accept(data)
+        self._reply(200, 200, 'Approved', [entry])
+
+
+class FakeSMSProvider:
+    """
+    A local HTTP server that answers like the Kavenegar sms/send API, for
+    tests and benchmarks without sending real messages, e.g.
+
+        with FakeSMSProvider(latency=0.05) as provider:
+            SMSClient(url=provider.url).send('+989123456789', 'hello')
+            provider.messages  # [{'receptor': ..., 'message': ..., ...}]
+
+    `fail(503, 503)` answers the next requests with these statuses and
+    `failure_rate` fails a share of the requests with 503. `connections`
+    counts the TCP connections that were opened.
+    """
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        latency: float = 0,
+        failure_rate: float = 0,
+    ) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.messages = []
+        self.connections = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), FakeSMSHandler)
+        self.server.daemon_threads = True
+        self.server.provider = self
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def connected(self) -> None:
+        with self.lock:
+            self.connections += 1
+
+    def fail(self, *statuses: int) -> None:
+        with self.lock:
+            self.failures.extend(statuses)
+
+    def failure(self) -> Optional[int]:
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+        if self.failure_rate and random.random() < self.failure_rate:
+            return 503
+        return None
+
+    def accept(self, data: dict) -> dict:
+        with self.lock:
+            self.messages.append(data)
+            message_id = len(self.messages)
+
+        return {
+            'messageid': message_id,
+            'message': data['message'],
+            'status': 1,
+            'statustext': 'Queued',
+            'sender': data.get('sender'),
+            'receptor': data['receptor'],
+            'date': int(time.time()),
+            'cost': 0,
+        }
+
+    def start(self) -> 'FakeSMSProvider':
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            args=(0.05,),
+            name='fake-sms-provider',
+            daemon=True,
+        )
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
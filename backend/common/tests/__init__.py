@@ -0,0 +1,5 @@
+from unittest import skipIf
+
+from django.conf import settings
+
+requires_redis = skipIf(settings.REDIS_CACHE_MODE == 'memory', 'needs a Redis server')
@@ -0,0 +1,44 @@
+import asyncio
+
+from common.cache import ApiCache, AsyncCacheManagement, CacheManagement
+from django.test import TestCase
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+
+
+class AsyncCacheTests(TestCase):
+    """
+    AsyncCacheManagement shares keys and encoding with CacheManagement
+    """
+
+    def test_values_are_shared(self):
+        async def run():
+            cache = AsyncCacheManagement()
+            await cache.set_key('tests:async:value', {'a': 1}, 60)
+            await cache.hset('tests:async:hash', {'a': '1'}, 60)
+            return await cache.get_key('tests:async:value')
+
+        self.assertEqual(asyncio.run(run()), {'a': 1})
+        self.assertEqual(CacheManagement().get_key('tests:async:value'), {'a': 1})
+        self.assertEqual(CacheManagement().hget('tests:async:hash'), {'a': '1'})
+
+    def test_async_view_is_cached(self):
+        calls = []
+
+        @ApiCache(identifier='tests', static_key='async', ttl=60)
+        async def view(request):
+            calls.append(request)
+            return Response({'ok': True})
+
+        async def run():
+            await ApiCache._async_redis.invalidate_tags('API:tests')
+            factory = APIRequestFactory()
+            first = await view(Request(factory.get('/tests/async/')))
+            second = await view(Request(factory.get('/tests/async/')))
+            await ApiCache._async_redis.invalidate_tags('API:tests')
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.content, first.content)
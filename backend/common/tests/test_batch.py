@@ -0,0 +1,71 @@
+import redis
+from common.cache import CacheLock, CacheManagement
+from common.cache.batch import CacheFuture
+from common.cache.metrics import request_round_trips
+from common.cache.middleware import CacheBatchMiddleware
+from common.metrics import registry
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+
+class CacheBatchTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement()
+        self.round_trips = [0]
+        self.token = request_round_trips.set(self.round_trips)
+
+    def tearDown(self):
+        request_round_trips.reset(self.token)
+        self.cache.remove_pattern_key('tests:batch:*')
+
+    def test_batch_returns_futures(self):
+        self.cache.set_key('tests:batch:b', 'b', 60)
+        self.round_trips[0] = 0
+
+        with self.cache.batch():
+            written = self.cache.set_key('tests:batch:a', 'a', 60)
+            read = self.cache.get_key('tests:batch:b')
+            self.assertIsInstance(read, CacheFuture)
+            self.assertFalse(read.done)
+
+        self.assertTrue(written.result())
+        self.assertEqual(read.result(), 'b')
+        self.assertEqual(self.round_trips[0], 1)
+        self.assertEqual(self.cache.db.ttl('tests:batch:a'), 60)
+
+    def test_command_errors_are_counted(self):
+        self.cache.set_key('tests:batch:a', 'a', 60)
+
+        with self.cache.batch():
+            failed = self.cache.hset_key('tests:batch:a', 'field', 'value')
+
+        with self.assertRaises(redis.ResponseError):
+            failed.result()
+        self.assertIn(
+            'redis_deferred_write_errors_total{error="ResponseError"}',
+            registry.render(),
+        )
+
+    def test_scripts_run_in_an_explicit_batch(self):
+        lock = CacheLock(self.cache, 'tests:batch', expire=1000)
+        self.assertTrue(lock.accrue())
+
+        with self.cache.batch():
+            written = self.cache.set_key('tests:batch:a', 'a', 60)
+            self.assertIs(lock.release(), True)
+            self.assertTrue(written.done)
+
+    def test_middleware_defers_writes(self):
+        round_trips = []
+
+        def view(request):
+            round_trips.append(request_round_trips.get())
+            self.cache.set_key('tests:batch:a', 'a', 60)
+            self.assertEqual(self.cache.incr_key('tests:batch:counter'), 1)
+            self.cache.set_key('tests:batch:b', 'b', 60)
+            return HttpResponse()
+
+        CacheBatchMiddleware(view)(RequestFactory().get('/'))
+
+        self.assertEqual(round_trips[0], [2])
+        self.assertEqual(self.cache.get_key('tests:batch:b'), 'b')
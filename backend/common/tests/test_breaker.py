@@ -0,0 +1,178 @@
+import time
+from unittest import skipIf
+from unittest.mock import patch
+
+import redis
+from common.cache import ApiCache, CacheLock, CacheManagement
+from common.cache.batch import CacheBatch
+from common.cache.breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    PoolExhaustedError,
+    breaker_for,
+    breakers,
+    guard,
+)
+from common.cache.connection import (
+    InstrumentedRedis,
+    InstrumentedRedisCluster,
+    RedisDBPool,
+)
+from common.cache.lookup import LookupCache
+from common.cache.middleware import CacheBatchMiddleware
+from common.metrics import registry
+from common.tests import requires_redis
+from common.tests.views import CachedView, LimitedView
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+from user.models import User
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+
+    def tearDown(self):
+        CacheManagement().remove_pattern_key('RATELIMIT:*')
+
+    def test_opens_after_failures_and_probes(self):
+        breaker = CircuitBreaker('tests', failures=2, reset_timeout=0.05)
+        for _ in range(2):
+            with self.assertRaises(redis.ConnectionError):
+                with breaker.guard():
+                    raise redis.ConnectionError
+
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            with breaker.guard():
+                self.fail('the command must not be sent')
+
+        time.sleep(0.06)
+        with breaker.guard():
+            # only the probe is let through
+            self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_error_replies_do_not_open(self):
+        breaker = CircuitBreaker('tests', failures=1)
+        with self.assertRaises(redis.ResponseError):
+            with breaker.guard():
+                raise redis.ResponseError
+
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_dead_server_fails_fast(self):
+        pool = RedisDBPool(1).pool(0, host='127.0.0.1', port=1)
+        client = InstrumentedRedis(connection_pool=pool)
+
+        for _ in range(settings.REDIS_BREAKER_FAILURES):
+            with self.assertRaises(redis.ConnectionError):
+                client.get('tests:breaker')
+        with self.assertRaises(CircuitOpenError):
+            client.get('tests:breaker')
+
+        self.assertIn('redis_circuit_state{node="127.0.0.1:1"} 2', registry.render())
+        breakers.pop('127.0.0.1:1')
+
+    @requires_redis
+    @override_settings(REDIS_POOL_MAX_CONNECTIONS=1, REDIS_POOL_TIMEOUT=0.01)
+    def test_pool_timeouts_do_not_open(self):
+        pool = RedisDBPool(1).pool(0)
+        connection = pool.get_connection()
+
+        for _ in range(settings.REDIS_BREAKER_FAILURES):
+            with self.assertRaises(PoolExhaustedError), guard(pool):
+                pool.get_connection()
+
+        pool.release(connection)
+        self.assertEqual(breaker_for(pool).state, 'closed')
+
+    @skipIf(settings.REDIS_CACHE_MODE != 'cluster', 'needs a Redis Cluster')
+    def test_cluster_nodes_have_breakers(self):
+        client = CacheManagement().db
+        self.assertIsInstance(client, InstrumentedRedisCluster)
+
+        client.set('tests:breaker', 'text')
+        with self.assertRaises(redis.ResponseError):
+            client.incr('tests:breaker')
+        client.delete('tests:breaker')
+
+        node = client.get_node_from_key('tests:breaker').name
+        self.assertEqual(breakers[node].state, 'closed')
+        self.assertIn(
+            'redis_command_errors_total{command="INCRBY",error="ResponseError"}',
+            registry.render(),
+        )
+
+    def test_rate_limit_fails_open(self):
+        with patch('common.cache.rate_limit.hit', side_effect=CircuitOpenError('')):
+            response = LimitedView.as_view()(self.factory.get('/limited/'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-RateLimit-Limit', response)
+
+    def test_api_cache_bypasses_redis(self):
+        CachedView.calls = 0
+        with patch.object(
+            CacheManagement, 'hget', side_effect=CircuitOpenError('open', 3)
+        ):
+            responses = [CachedView.as_view()(self.factory.get('/c/')) for _ in '12']
+
+        self.assertEqual([r.data['calls'] for r in responses], [1, 2])
+
+    def test_api_cache_single_flight_fails_open(self):
+        CachedView.calls = 0
+        with patch.object(CacheLock, 'accrue', side_effect=CircuitOpenError('')):
+            response = CachedView.as_view()(self.factory.get('/single/'))
+
+        self.assertEqual(response.data['calls'], 1)
+
+    def test_view_is_not_called_again_on_its_redis_error(self):
+        calls = []
+
+        class FailingView(APIView):
+            @ApiCache(identifier='tests', ttl=60)
+            def get(self, request):
+                calls.append(request)
+                raise redis.ConnectionError('raised by the view')
+
+        response = FailingView.as_view()(self.factory.get('/failing/'))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(calls), 1)
+
+    def test_deferred_writes_fail_open(self):
+        def view(request):
+            CacheManagement().set_key('tests:batch:a', 'a', 60)
+            return HttpResponse('made')
+
+        with patch.object(CacheBatch, 'flush', side_effect=CircuitOpenError('')):
+            response = CacheBatchMiddleware(view)(RequestFactory().get('/'))
+
+        self.assertEqual(response.content, b'made')
+        self.assertIn('redis_deferred_write_errors_total', registry.render())
+
+    def test_lookup_cache_bypasses_redis(self):
+        lookups = LookupCache(labels=['user.User'])
+        user = User.objects.create(phone_number='09120000003')
+
+        with patch.object(lookups.cache, 'get_key', side_effect=CircuitOpenError('')):
+            found = lookups.get(User, lambda model, **kwargs: user, pk=user.pk)
+
+        self.assertEqual(found, user)
+
+    def test_otp_fails_fast(self):
+        with patch(
+            'authentication.views.cache_otp', side_effect=CircuitOpenError('', 4.2)
+        ):
+            response = self.client.post(
+                '/api/v1/auth/request-otp/',
+                {'phone_number': '+989120000009'},
+                REMOTE_ADDR='10.9.9.9',
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
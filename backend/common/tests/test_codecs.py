@@ -0,0 +1,40 @@
+from common.cache import CacheManagement
+from common.cache.codecs import MAGIC, ValueSerializer
+from django.test import TestCase
+
+
+class CodecTests(TestCase):
+    def tearDown(self):
+        CacheManagement().remove_pattern_key('tests:codec:*')
+
+    def test_small_json_values_stay_plain(self):
+        cache = CacheManagement()
+        cache.set_key('tests:codec:plain', {'a': 1}, 60)
+
+        self.assertEqual(cache.db.get('tests:codec:plain'), '{"a":1}')
+        self.assertEqual(cache.get_key('tests:codec:plain'), {'a': 1})
+
+    def test_big_values_are_compressed(self):
+        cache = CacheManagement(compress_threshold=100)
+        value = {'words': ['flashcard'] * 100}
+        cache.set_key('tests:codec:big', value, 60)
+
+        stored = cache.db.execute_command('GET', 'tests:codec:big', NEVER_DECODE=True)
+        self.assertTrue(stored.startswith(MAGIC))
+        self.assertLess(len(stored), 100)
+        self.assertEqual(CacheManagement().get_key('tests:codec:big'), value)
+
+    def test_pickle_codec(self):
+        cache = CacheManagement(codec='pickle')
+        cache.set_key('tests:codec:pickle', {1, 2}, 60)
+
+        self.assertEqual(cache.get_key('tests:codec:pickle'), {1, 2})
+        with self.assertRaises(ValueError):
+            CacheManagement().get_key('tests:codec:pickle')
+
+    def test_raw_bytes_are_framed_when_needed(self):
+        serializer = ValueSerializer(threshold=None)
+        data = MAGIC + b'binary'
+
+        self.assertEqual(serializer.compress(b'text'), b'text')
+        self.assertEqual(serializer.decompress(serializer.compress(data)), data)
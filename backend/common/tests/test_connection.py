@@ -0,0 +1,38 @@
+from common.cache import CacheManagement
+from common.cache.breaker import PoolExhaustedError
+from common.cache.connection import RedisDBPool
+from common.metrics import registry
+from common.tests import requires_redis
+from django.test import TestCase, override_settings
+
+
+@requires_redis
+class RedisPoolTests(TestCase):
+    def test_pools_are_created_on_first_use(self):
+        pools = RedisDBPool(2)
+        self.assertEqual(pools.stats(), [])
+
+        pools.con_db(1).ping()
+        self.assertEqual(pools.stats(), [(1, {'in_use': 0, 'idle': 1, 'created': 1})])
+        self.assertIs(pools.con_db(1), pools.con_db(1))
+
+        with self.assertRaises(ValueError):
+            pools.con_db(2)
+
+    @override_settings(REDIS_POOL_MAX_CONNECTIONS=1, REDIS_POOL_TIMEOUT=0.01)
+    def test_full_pool_waits_for_a_connection(self):
+        pool = RedisDBPool(1).con_db(0).connection_pool
+        connection = pool.get_connection()
+
+        with self.assertRaises(PoolExhaustedError):
+            pool.get_connection()
+
+        pool.release(connection)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_gauges_are_rendered(self):
+        CacheManagement().db.ping()
+        metrics = registry.render()
+
+        self.assertIn('redis_pool_connections_idle{db="0",client="sync"}', metrics)
+        self.assertIn('redis_pool_acquire_seconds_count{db="0"}', metrics)
@@ -0,0 +1,127 @@
+import json
+import time
+
+from common.cache import CacheManagement
+from common.cache.local_cache import MISSING, LocalCache
+from common.cache.metrics import request_round_trips
+from common.metrics import registry
+from common.tests import requires_redis
+from django.test import TestCase, override_settings
+from user.models import User
+
+
+@override_settings(REDIS_LOCAL_CACHE_ENABLED=True)
+class LocalCacheTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement(local_cache=True)
+        self.writer = CacheManagement()
+        self.cache.local.clear()
+
+    def tearDown(self):
+        self.writer.remove_key('tests:local')
+
+    def test_reads_are_served_locally(self):
+        self.writer.set_key('tests:local', 'first', 60)
+        self.assertEqual(self.cache.get_key('tests:local'), 'first')
+
+        # change the value behind the cache management back
+        self.writer.db.set('tests:local', '"second"')
+        self.assertEqual(self.cache.get_key('tests:local'), 'first')
+
+    def test_writes_invalidate_local_copy(self):
+        self.writer.set_key('tests:local', 'first', 60)
+        self.cache.get_key('tests:local')
+
+        self.writer.set_key('tests:local', 'second', 60)
+        self.assertEqual(self.cache.get_key('tests:local'), 'second')
+
+    def test_invalidation_is_sent_with_the_write(self):
+        pubsub = self.writer.db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.writer.local.channel)
+        self.writer.is_exists('tests:local')  # connect first
+        round_trips = [0]
+        token = request_round_trips.set(round_trips)
+
+        try:
+            self.writer.set_key('tests:local', 'first', 60)
+        finally:
+            request_round_trips.reset(token)
+
+        self.assertEqual(round_trips, [1])
+        deadline = time.monotonic() + 2
+        while (message := pubsub.get_message(timeout=0.1)) is None:
+            self.assertLess(time.monotonic(), deadline)
+
+        self.assertEqual(json.loads(message['data'])[1], ['tests:local'])
+        pubsub.close()
+
+    def test_model_removal_invalidates_its_list(self):
+        self.writer.set_key('User:all', ['users'], 60)
+        self.assertEqual(self.cache.get_key('User:all'), ['users'])
+        pubsub = self.writer.db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.writer.local.channel)
+
+        self.writer.remove_key(User)
+
+        self.assertEqual(self.cache.get_key('User:all'), {})
+        deadline = time.monotonic() + 2
+        while (message := pubsub.get_message(timeout=0.1)) is None:
+            self.assertLess(time.monotonic(), deadline)
+
+        self.assertIn('User:all', json.loads(message['data'])[1])
+        pubsub.close()
+
+    def test_remote_invalidation(self):
+        local = LocalCache(db=0, max_size=2, ttl=60, channel='TESTS')
+        local.set('tests:local', 'value', local.version)
+
+        remote = LocalCache(db=0, max_size=2, ttl=60, channel='TESTS')
+        remote.invalidate('tests:local')
+
+        deadline = time.monotonic() + 2
+        while local.get('tests:local') is not MISSING:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    @requires_redis
+    def test_tracking_invalidation(self):
+        local = LocalCache(
+            db=0,
+            max_size=2,
+            ttl=60,
+            channel='TESTS',
+            tracking=True,
+            prefixes=['tests:'],
+        )
+        local.get('tests:local')
+        time.sleep(0.2)  # let the listener enable tracking
+        local.set('tests:local', 'value', local.version)
+
+        # a write that does not go through CacheManagement
+        self.writer.db.set('tests:local', 'other')
+
+        deadline = time.monotonic() + 2
+        while local.get('tests:local') is not MISSING:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        self.assertIsNone(local.invalidation(['tests:local']))
+
+    def test_hits_are_counted(self):
+        local = LocalCache(db=1, max_size=2, ttl=60, channel='TESTS')
+        local.get('tests:missing')
+        time.sleep(0.2)  # let the listener subscribe (and clear) first
+        local.set('tests:local', 'value', local.version)
+        local.get('tests:local')
+
+        metrics = registry.render()
+        self.assertIn('redis_local_cache_requests_total{db="1",result="hit"}', metrics)
+        self.assertIn('redis_local_cache_requests_total{db="1",result="miss"}', metrics)
+
+    def test_lru_eviction(self):
+        local = LocalCache(db=0, max_size=2, ttl=60, channel='TESTS')
+        for key in ('a', 'b', 'c'):
+            local.set(key, key, local.version)
+
+        self.assertIs(local.get('a'), MISSING)
+        self.assertEqual(local.get('c'), 'c')
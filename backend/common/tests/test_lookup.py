@@ -0,0 +1,77 @@
+from unittest.mock import patch
+
+from common.cache.lookup import LookupCache, lookup_cache
+from common.utils import get_object
+from django.db.models.signals import post_delete, post_save
+from django.test import TestCase
+from user.models import User
+
+
+class LookupCacheTests(TestCase):
+    def setUp(self):
+        self.lookups = LookupCache(labels=['user.User'])
+        self.lookups.connect()
+        self.user = User.objects.create(phone_number='09120000001')
+        self.queries = 0
+
+    def tearDown(self):
+        post_save.disconnect(sender=User, dispatch_uid='lookup_cache:user.user')
+        post_delete.disconnect(sender=User, dispatch_uid='lookup_cache:user.user')
+        self.lookups.cache.remove_pattern_key('LOOKUP:user.user:*')
+        self.lookups.cache.remove_pattern_key('TAG:LOOKUP:user.user:*')
+
+    def get(self, **kwargs):
+        def fetch(model, **kwargs):
+            self.queries += 1
+            return model.objects.filter(**kwargs).first()
+
+        return self.lookups.get(User, fetch, **kwargs)
+
+    def test_found_and_missing_objects_are_cached(self):
+        self.assertEqual(self.get(pk=self.user.pk), self.user)
+        self.assertEqual(self.get(pk=self.user.pk), self.user)
+        self.assertIsNone(self.get(phone_number='09129999999'))
+        self.assertIsNone(self.get(phone_number='09129999999'))
+        self.assertEqual(self.queries, 2)
+
+    def test_tags_live_as_long_as_the_entries(self):
+        self.get(pk=self.user.pk)
+        self.get(phone_number='09129999999')
+
+        db = self.lookups.cache.db
+        tag = self.lookups.cache.tag_name
+        missing = db.ttl(tag(self.lookups._tag(User, 'missing')))
+        found = db.ttl(tag(self.lookups._tag(User, self.user.pk)))
+        self.assertTrue(0 < missing <= self.lookups.negative_ttl)
+        self.assertTrue(0 < found <= self.lookups.ttl)
+
+    def test_save_invalidates_lookups(self):
+        self.get(pk=self.user.pk)
+        self.get(phone_number='09120000002')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create(phone_number='09120000002')
+        self.assertIsNotNone(self.get(phone_number='09120000002'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertFalse(self.get(pk=self.user.pk).is_active)
+        self.assertEqual(self.queries, 4)
+
+    def test_delete_invalidates_lookups(self):
+        pk = self.user.pk
+        self.get(pk=pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertIsNone(self.get(pk=pk))
+
+    def test_get_object_uses_registered_models(self):
+        with patch.object(lookup_cache, 'labels', {'user.user'}):
+            self.assertEqual(get_object(User, pk=self.user.pk), self.user)
+            with self.assertNumQueries(0):
+                self.assertEqual(get_object(User, pk=self.user.pk), self.user)
+
+        with self.assertNumQueries(1):
+            get_object(User, pk=self.user.pk)
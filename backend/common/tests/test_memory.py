@@ -0,0 +1,49 @@
+import time
+
+import redis
+from common.cache.memory import MemoryBroker, MemoryRedis, MemoryStore
+from django.test import TestCase
+
+
+class MemoryRedisTests(TestCase):
+    def setUp(self):
+        self.client = MemoryRedis(MemoryStore(), MemoryBroker())
+
+    def test_strings_and_ttl(self):
+        self.assertTrue(self.client.set('key', 1, ex=60))
+        self.assertIsNone(self.client.set('key', 2, nx=True))
+        self.assertEqual(self.client.incr('key', 2), 3)
+        self.assertEqual(self.client.get('key'), '3')
+        self.assertGreater(self.client.ttl('key'), 0)
+
+        self.client.set('key', 'value', px=1)
+        time.sleep(0.01)
+        self.assertIsNone(self.client.get('key'))
+        self.assertEqual(self.client.exists('key'), 0)
+
+    def test_hashes_and_sets(self):
+        self.client.hset('hash', mapping={'a': 1, 'b': b'\xfe'})
+        self.assertEqual(self.client.hincrby('hash', 'a', 2), 3)
+        self.assertEqual(
+            self.client.execute_command('HGETALL', 'hash', NEVER_DECODE=True),
+            {b'a': b'3', b'b': b'\xfe'},
+        )
+        self.assertEqual(self.client.sadd('set', 'a', 'b'), 2)
+        self.assertEqual(self.client.smembers('set'), {'a', 'b'})
+
+        with self.assertRaises(redis.ResponseError):
+            self.client.hget('set', 'a')
+
+    def test_pipeline(self):
+        pipe = self.client.pipeline()
+        pipe.set('a', 1).incr('a').hset('hash', 'a', 1).unlink('a', 'hash')
+
+        self.assertEqual(pipe.execute(), [True, 2, 1, 2])
+        self.assertEqual(self.client.keys(), [])
+
+    def test_pubsub(self):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe('channel')
+        self.client.publish('channel', 'message')
+
+        self.assertEqual(pubsub.get_message(timeout=1)['data'], 'message')
@@ -0,0 +1,116 @@
+import threading
+import time
+from unittest.mock import patch
+
+from common.cache import PermanentError, TaskQueue
+from common.cache.queue import CLAIM
+from django.test import TestCase, override_settings
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.queue = TaskQueue('tests', retry_backoff=0)
+
+        @self.queue.task()
+        def record(value, fail=False):
+            self.calls.append(value)
+            if fail:
+                raise ValueError(value)
+
+        self.record = record
+
+    def tearDown(self):
+        self.queue.purge()
+
+    def test_job_runs_once(self):
+        job = self.record.delay('first')
+        self.assertEqual(self.queue.status(job), 'queued')
+        self.assertEqual(self.calls, [])
+
+        self.assertTrue(self.queue.run_once())
+        self.assertFalse(self.queue.run_once())
+        self.assertEqual(self.calls, ['first'])
+        self.assertEqual(self.queue.status(job), 'done')
+
+    def test_failed_job_is_retried_then_dead(self):
+        self.queue.max_attempts = 2
+        job = self.record.delay('failing', fail=True)
+
+        self.queue.run_once()
+        self.assertEqual(self.queue.status(job), 'retrying')
+        self.queue.work(burst=True)
+
+        self.assertEqual(self.calls, ['failing', 'failing'])
+        self.assertEqual(self.queue.status(job), 'dead')
+        letter = self.queue.dead_letters()[job]
+        self.assertEqual(letter['attempts'], 2)
+        self.assertEqual(letter['error'], "ValueError('failing')")
+        # the arguments may be personal data
+        self.assertNotIn('args', letter)
+
+    def test_permanent_error_is_not_retried(self):
+        @self.queue.task()
+        def reject():
+            raise PermanentError('rejected')
+
+        job = reject.delay()
+        self.queue.work(burst=True)
+
+        self.assertEqual(self.queue.status(job), 'dead')
+        self.assertEqual(self.queue.dead_letters()[job]['attempts'], 1)
+
+    def test_worker_survives_errors(self):
+        stop = threading.Event()
+        runs = []
+
+        def run_once():
+            runs.append(None)
+            if len(runs) == 1:
+                raise ValueError('not a Redis error')
+            stop.set()
+            return False
+
+        with patch.object(self.queue, 'run_once', run_once), self.assertLogs(
+            'common.cache.queue', 'ERROR'
+        ), override_settings(REDIS_QUEUE_POLL_INTERVAL=0):
+            self.queue.work(stop)
+
+        self.assertEqual(len(runs), 2)
+
+    def test_expired_job_is_dropped(self):
+        job = self.queue.enqueue('tests.record', ('late',), expires=0.01)
+        time.sleep(0.02)
+
+        self.assertTrue(self.queue.run_once())
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.queue.status(job), 'expired')
+
+    def test_job_of_a_lost_worker_runs_again(self):
+        self.queue.visibility_timeout = 50
+        job = self.record.delay('lost')
+        # a worker claims the job and dies
+        keys = [self.queue.ready, self.queue.scheduled, self.queue.jobs]
+        self.queue.redis_con.run_script(CLAIM, [*keys, self.queue.attempts], [50])
+
+        self.assertFalse(self.queue.run_once())
+        time.sleep(0.06)
+        self.assertTrue(self.queue.run_once())
+        self.assertEqual(self.calls, ['lost'])
+        self.assertEqual(self.queue.status(job), 'done')
+
+    def test_local_worker(self):
+        # its own queue, the worker thread lives as long as the process
+        queue = TaskQueue('tests-local', local_worker=True)
+
+        @queue.task()
+        def record(value):
+            self.calls.append(value)
+
+        job = record.delay('local')
+
+        deadline = time.monotonic() + 2
+        while queue.status(job) != 'done':
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(self.calls, ['local'])
@@ -0,0 +1,306 @@
+import time
+from unittest.mock import patch
+
+from common.cache import CacheManagement, RateLimit, by_field, by_ip
+from common.cache.connection import redis_connections
+from common.cache.limiters import ALGORITHMS, LocalLimiter, Policy, RateLimitResult, hit
+from common.cache.metrics import request_round_trips
+from common.cache.middleware import RateLimitMiddleware
+from common.cache.sharding import hash_tag
+from common.tests.views import FloodedView, LimitedView, OTPView, counted_view
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement()
+
+    def tearDown(self):
+        self.cache.remove_pattern_key('RATELIMIT:*')
+        self.cache.remove_pattern_key('tests:limit:*')
+
+    def hit(self, algorithm, key, rate, window, freeze=0):
+        policy = Policy('', rate, window, algorithm=algorithm, freeze=freeze)
+        return hit(self.cache, [(policy, key)])
+
+    def test_algorithms(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm):
+                key = f'tests:limit:{{{algorithm}}}'
+                results = [self.hit(algorithm, key, 3, 60) for _ in range(4)]
+
+                self.assertEqual([r.allowed for r in results], [1, 1, 1, 0])
+                self.assertEqual([r.remaining for r in results], [2, 1, 0, 0])
+                self.assertTrue(all(0 < r.reset <= 60 for r in results))
+
+    def test_freeze_blocks_the_key(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm):
+                key = f'tests:limit:{{freeze-{algorithm}}}'
+                for _ in range(2):
+                    self.hit(algorithm, key, 1, 60, freeze=300)
+
+                self.assertGreater(self.cache.db.pttl(f'{key}:block'), 290000)
+                result = self.hit(algorithm, key, 1, 60, freeze=300)
+                self.assertEqual(result.reset, 300)
+
+    def test_gcra_spaces_requests(self):
+        results = [self.hit('gcra', 'tests:limit:{g}', 2, 60) for _ in range(3)]
+        self.assertFalse(results[2].allowed)
+        self.assertAlmostEqual(results[2].reset, 30, delta=0.01)
+
+    def test_one_round_trip(self):
+        self.hit('sliding_window', 'tests:limit:{rt}', 5, 60)
+        round_trips = [0]
+        token = request_round_trips.set(round_trips)
+        try:
+            self.hit('sliding_window', 'tests:limit:{rt}', 5, 60)
+        finally:
+            request_round_trips.reset(token)
+        self.assertEqual(round_trips, [1])
+
+    def test_decorator_headers(self):
+        factory = APIRequestFactory()
+        responses = [LimitedView.as_view()(factory.get('/limited/')) for _ in range(3)]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertEqual(responses[0]['X-RateLimit-Limit'], '2')
+        self.assertEqual(responses[1]['X-RateLimit-Remaining'], '0')
+        self.assertEqual(responses[2]['Retry-After'], '120')
+        self.assertIn('2 minutes', responses[2].data['detail'])
+
+    def test_flood_is_shed_locally(self):
+        factory = APIRequestFactory()
+        round_trips = [0]
+        token = request_round_trips.set(round_trips)
+        try:
+            statuses = [
+                FloodedView.as_view()(factory.get('/flooded/')).status_code
+                for _ in range(20)
+            ]
+        finally:
+            request_round_trips.reset(token)
+
+        self.assertEqual(statuses, [200, 200] + [429] * 18)
+        # the script is loaded on the first call, then one round trip each
+        self.assertLessEqual(round_trips[0], 4)
+
+    def test_local_bucket_refills(self):
+        local = LocalLimiter(rate=2, window=0.1, algorithm='gcra')
+
+        self.assertIsNone(local.check('a'))
+        self.assertIsNone(local.check('a'))
+        self.assertFalse(local.check('a').allowed)
+        self.assertIsNone(local.check('b'))
+
+        time.sleep(0.06)
+        self.assertIsNone(local.check('a'))
+
+    def test_local_bucket_holds_the_burst_of_a_fixed_window(self):
+        local = LocalLimiter(rate=2, window=60, algorithm='fixed_window')
+
+        # Redis allows a full window at its end and another right after
+        self.assertEqual([local.check('a') for _ in range(4)], [None] * 4)
+        self.assertFalse(local.check('a').allowed)
+
+    def test_local_bucket_remembers_denials(self):
+        local = LocalLimiter(rate=5, window=60, max_keys=1)
+        local.check('a')
+        local.update('a', RateLimitResult(False, 5, 0, 30))
+
+        self.assertAlmostEqual(local.check('a').reset, 30, delta=0.1)
+        local.check('b')
+        self.assertIsNone(local.check('a'))
+
+    def test_policies_report_the_denying_one(self):
+        checks = [
+            (Policy('wide', 5, 60), 'tests:limit:{p}:wide'),
+            (Policy('narrow', 2, 60, algorithm='gcra'), 'tests:limit:{p}:narrow'),
+        ]
+        results = [hit(self.cache, checks) for _ in range(3)]
+
+        self.assertEqual([r.allowed for r in results], [True, True, False])
+        self.assertEqual([r.policy for r in results], ['narrow'] * 3)
+        self.assertEqual(results[1].remaining, 0)
+        # the denied request was not counted by the other policy
+        self.assertEqual(self.cache.get_key('tests:limit:{p}:wide'), 2)
+
+    def test_policies_on_several_nodes(self):
+        checks = [
+            (Policy('wide', 5, 60), 'tests:limit:{wide}'),
+            (Policy('narrow', 2, 60, algorithm='gcra'), 'tests:limit:{narrow}'),
+        ]
+        # every key on its own node, like a sharded or cluster cache
+        with patch.object(
+            redis_connections, 'group_keys', lambda keys: [[key] for key in keys]
+        ):
+            results = [hit(self.cache, checks) for _ in range(3)]
+
+        self.assertEqual([r.allowed for r in results], [True, True, False])
+        self.assertEqual([r.policy for r in results], ['narrow'] * 3)
+        self.assertEqual(results[1].remaining, 0)
+        # the denied request was not counted by the other node
+        self.assertEqual(self.cache.get_key('tests:limit:{wide}'), 2)
+
+    def test_keys_of_a_route_are_spread(self):
+        limit = RateLimit(
+            policies=(Policy('ip', 3, 60, by_ip()), Policy('global', 300, 60))
+        )
+        requests = [
+            APIRequestFactory().post('/otp/', REMOTE_ADDR=ip)
+            for ip in ('10.0.0.1', '10.0.0.2')
+        ]
+        tags = {
+            hash_tag(key)
+            for request in requests
+            for _, key in limit._get_checks(request)
+        }
+
+        self.assertEqual(len(tags), 3)
+
+    def test_policies_are_one_round_trip(self):
+        checks = [
+            (Policy(algorithm, 5, 60, algorithm=algorithm), f'tests:limit:{{m}}:{i}')
+            for i, algorithm in enumerate(ALGORITHMS)
+        ]
+        hit(self.cache, checks)
+        round_trips = [0]
+        token = request_round_trips.set(round_trips)
+        try:
+            result = hit(self.cache, checks)
+        finally:
+            request_round_trips.reset(token)
+
+        self.assertEqual(round_trips, [1])
+        self.assertEqual(result.remaining, 3)
+
+    def test_decorator_policies(self):
+        factory = APIRequestFactory()
+
+        def post(phone_number, ip):
+            request = factory.post(
+                '/otp/', {'phone_number': phone_number}, REMOTE_ADDR=ip
+            )
+            return OTPView.as_view()(request)
+
+        responses = [post('+989120000001', '10.0.0.1') for _ in range(3)]
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertEqual(responses[2]['X-RateLimit-Policy'], 'phone_number')
+        self.assertEqual(responses[2]['Retry-After'], '120')
+
+        self.assertEqual(post('+989120000002', '10.0.0.1').status_code, 200)
+        response = post('+989120000003', '10.0.0.1')
+        self.assertEqual(response['X-RateLimit-Policy'], 'ip')
+
+        self.assertEqual(post('+989120000004', '10.0.0.2').status_code, 200)
+        response = post('+989120000005', '10.0.0.3')
+        self.assertEqual(response['X-RateLimit-Policy'], 'subnet')
+
+    def test_field_of_a_body_that_is_not_an_object(self):
+        request = APIRequestFactory().post(
+            '/otp/', [1, 2], format='json', REMOTE_ADDR='10.0.1.1'
+        )
+        self.assertEqual(OTPView.as_view()(request).status_code, 200)
+
+        # a middleware sees a plain HttpRequest
+        extract = by_field('phone_number')
+        self.assertIsNone(extract(RequestFactory().post('/otp/')))
+        self.assertIsNotNone(extract(RequestFactory().get('/?phone_number=1')))
+
+    def test_success_clear_keeps_the_global_budget(self):
+        VerifyView = counted_view(
+            RateLimit(
+                policies=(
+                    Policy('phone_number', 2, 60, by_field('phone_number')),
+                    Policy('global', 3, 60),
+                ),
+                success_clear=('phone_number',),
+                local=False,
+            ),
+            method='post',
+        )
+
+        factory = APIRequestFactory()
+        statuses = [
+            VerifyView.as_view()(
+                factory.post('/verify/', {'phone_number': '+989120000001'})
+            ).status_code
+            for _ in range(4)
+        ]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+
+        for success_clear in (True, ('global',)):
+            with self.assertRaises(ImproperlyConfigured):
+                RateLimit(
+                    policies=(Policy('global', 3, 60),), success_clear=success_clear
+                )
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RateLimit(algorithm='leaky')
+
+
+@override_settings(
+    RATELIMIT_ROUTES={
+        'login': {'path': r'^/login/', 'methods': ['POST'], 'rate': 2, 'freeze': 60},
+        'api': {'path': r'^/api/', 'rate': 5, 'local': False},
+    }
+)
+class RateLimitMiddlewareTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.middleware = RateLimitMiddleware(self.view)
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        CacheManagement().remove_pattern_key('RATELIMIT:*')
+
+    def view(self, request):
+        self.calls.append(request.path)
+        return HttpResponse()
+
+    def test_requests_are_rejected_before_the_view(self):
+        responses = [
+            self.middleware(self.factory.post('/login/', 'not json', 'text/plain'))
+            for _ in range(3)
+        ]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(responses[1]['X-RateLimit-Remaining'], '0')
+        self.assertEqual(responses[2]['Retry-After'], '60')
+        self.assertIn('1 minutes', responses[2].content.decode())
+
+    def test_first_matching_route_is_applied(self):
+        for _ in range(3):
+            self.middleware(self.factory.get('/login/'))
+            self.middleware(self.factory.get('/other/'))
+        response = self.middleware(self.factory.get('/api/items/'))
+
+        self.assertEqual(len(self.calls), 7)
+        self.assertEqual(response['X-RateLimit-Limit'], '5')
+        self.assertNotIn('X-RateLimit-Limit', self.middleware(self.factory.get('/')))
+
+    def test_view_headers_are_kept(self):
+        def view(request):
+            return HttpResponse(headers={'X-RateLimit-Limit': '1'})
+
+        response = RateLimitMiddleware(view)(self.factory.get('/api/'))
+        self.assertEqual(response['X-RateLimit-Limit'], '1')
+
+    def test_preflight_requests_are_not_limited(self):
+        responses = [self.middleware(self.factory.options('/api/')) for _ in range(6)]
+        self.assertEqual({r.status_code for r in responses}, {200})
+        self.assertNotIn('X-RateLimit-Limit', responses[0])
+
+    @override_settings(RATELIMIT_MIDDLEWARE_ENABLED=False)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            RateLimitMiddleware(self.view)
+
+        with self.settings(RATELIMIT_MIDDLEWARE_ENABLED=True, RATELIMIT_ROUTES={}):
+            with self.assertRaises(MiddlewareNotUsed):
+                RateLimitMiddleware(self.view)
@@ -0,0 +1,194 @@
+import time
+
+from common.cache import CacheLock, CacheManagement
+from common.metrics import registry
+from common.tests import requires_redis
+from common.tests.views import CachedView, SoftCachedView, VaryCachedView
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from user.models import User
+
+
+class ApiCacheTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.cache = CacheManagement()
+        self.cache.invalidate_tags('API:tests')
+        CachedView.calls = 0
+        SoftCachedView.calls = 0
+        VaryCachedView.calls = 0
+
+    def tearDown(self):
+        self.cache.invalidate_tags('API:tests')
+
+    def test_miss_stores_rendered_body(self):
+        response = CachedView.as_view()(self.factory.get('/cached/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'{"calls":1}')
+
+        keys = list(self.cache.db.scan_iter('API:tests:*'))
+        self.assertEqual(len(keys), 1)
+        stored = self.cache.hget(keys[0])
+        self.assertEqual(stored['body'], '{"calls":1}')
+        self.assertEqual(stored['status'], '200')
+        self.assertEqual(stored['content_type'], 'application/json')
+
+    def test_hit_returns_raw_response(self):
+        CachedView.as_view()(self.factory.get('/cached/'))
+        response = CachedView.as_view()(self.factory.get('/cached/'))
+
+        self.assertEqual(CachedView.calls, 1)
+        self.assertIs(type(response), HttpResponse)
+        self.assertEqual(response.content, b'{"calls":1}')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_etag_and_cache_control(self):
+        response = CachedView.as_view()(self.factory.get('/cached/'))
+        etag = response['ETag']
+
+        self.assertEqual(etag, f'"{self.cache.hget(self._hash_name())["etag"]}"')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=60')
+
+        response = CachedView.as_view()(self.factory.get('/cached/'))
+        self.assertEqual(response['ETag'], etag)
+
+    def test_matching_etag_returns_not_modified(self):
+        etag = CachedView.as_view()(self.factory.get('/cached/'))['ETag']
+
+        response = CachedView.as_view()(
+            self.factory.get('/cached/', HTTP_IF_NONE_MATCH=f'W/{etag}')
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+        response = CachedView.as_view()(
+            self.factory.get('/cached/', HTTP_IF_NONE_MATCH='"other"')
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CachedView.calls, 1)
+
+    def test_stale_etag_is_not_revalidated(self):
+        etag = SoftCachedView.as_view()(self.factory.get('/soft/'))['ETag']
+        self.cache.db.hset(self._hash_name(), 'fresh_until', time.time() - 1)
+
+        response = SoftCachedView.as_view()(
+            self.factory.get('/soft/', HTTP_IF_NONE_MATCH=etag)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SoftCachedView.calls, 2)
+
+    def test_entries_vary_on_user_and_headers(self):
+        first = User.objects.create(phone_number='09120000001')
+        second = User.objects.create(phone_number='09120000002')
+
+        def get(user=None, **headers):
+            request = self.factory.get('/vary/', **headers)
+            force_authenticate(request, user)
+            return VaryCachedView.as_view()(request).content
+
+        self.assertEqual(get(first), b'{"calls":1}')
+        self.assertEqual(get(first), b'{"calls":1}')
+        self.assertEqual(get(second), b'{"calls":2}')
+        self.assertEqual(get(first, HTTP_ACCEPT_LANGUAGE='fa'), b'{"calls":3}')
+        self.assertEqual(get(first, HTTP_X_PLATFORM='ios'), b'{"calls":4}')
+        self.assertEqual(get(first, HTTP_X_PLATFORM='ios'), b'{"calls":4}')
+
+        response = VaryCachedView.as_view()(self.factory.get('/vary/'))
+        self.assertIn('Accept-Language, X-Platform', response['Vary'])
+
+    def test_key_is_hashed(self):
+        CachedView.as_view()(self.factory.get('/cached/?page=1'))
+        name = self._hash_name()
+        self.assertRegex(name, r'^API:tests::[0-9a-f]{24}$')
+
+    def _hash_name(self):
+        return list(self.cache.db.scan_iter('API:tests:*'))[0]
+
+    def test_stale_entry_is_refreshed(self):
+        SoftCachedView.as_view()(self.factory.get('/soft/'))
+        self.cache.db.hset(self._hash_name(), 'fresh_until', time.time() - 1)
+
+        response = SoftCachedView.as_view()(self.factory.get('/soft/'))
+        self.assertEqual(response.content, b'{"calls":2}')
+        self.assertEqual(SoftCachedView.calls, 2)
+
+    def test_stale_entry_is_served_while_locked(self):
+        SoftCachedView.as_view()(self.factory.get('/soft/'))
+        hash_name = self._hash_name()
+        self.cache.db.hset(hash_name, 'fresh_until', time.time() - 1)
+
+        lock = CacheLock(self.cache, hash_name, 1000)
+        self.assertTrue(lock.accrue())
+        try:
+            response = SoftCachedView.as_view()(self.factory.get('/soft/'))
+        finally:
+            lock.release()
+
+        self.assertEqual(response.content, b'{"calls":1}')
+        self.assertEqual(SoftCachedView.calls, 1)
+
+    def test_results_are_counted(self):
+        CachedView.as_view()(self.factory.get('/tests/'))
+        CachedView.as_view()(self.factory.get('/tests/'))
+
+        metrics = registry.render()
+        for result in ('hit', 'miss'):
+            self.assertIn(
+                f'api_cache_requests_total{{identifier="tests",result="{result}"}}',
+                metrics,
+            )
+        self.assertIn('api_cache_payload_bytes_count{identifier="tests"}', metrics)
+
+    @requires_redis
+    def test_command_latency_is_recorded(self):
+        CachedView.as_view()(self.factory.get('/tests/'))
+
+        metrics = registry.render()
+        self.assertIn(
+            'redis_command_duration_seconds_count{command="HGETALL"}', metrics
+        )
+        self.assertIn('redis_command_duration_seconds_count{command="MULTI"}', metrics)
+
+    @override_settings(REDIS_METRICS_SAMPLE_RATE=0)
+    def test_command_sampling(self):
+        before = registry.render().count('command="EXISTS"')
+        self.cache.is_exists('tests:sampled')
+        self.assertEqual(registry.render().count('command="EXISTS"'), before)
+
+    def test_tag_invalidation(self):
+        CachedView.as_view()(self.factory.get('/cached/'))
+        CachedView.as_view()(self.factory.get('/cached/other/'))
+
+        self.assertEqual(self.cache.invalidate_tags('API:tests'), 2)
+        self.assertEqual(list(self.cache.db.scan_iter('API:tests:*')), [])
+        self.assertEqual(self.cache.db.zrange('TAG:API:tests', 0, -1), [])
+
+    def test_tags_expire_with_their_keys(self):
+        self.cache.set_key('API:tests:short', 1, ttl=1, tags=('API:tests',))
+        self.cache.set_key('API:tests:long', 1, ttl=60, tags=('API:tests',))
+        self.cache.set_key('API:tests:other', 1, ttl=5, tags=('API:tests',))
+        self.assertTrue(55 <= self.cache.db.ttl('TAG:API:tests') <= 60)
+
+        time.sleep(1.1)
+        self.cache.set_key('API:tests:new', 1, ttl=5, tags=('API:tests',))
+        self.assertNotIn(
+            'API:tests:short', self.cache.db.zrange('TAG:API:tests', 0, -1)
+        )
+
+        self.cache.hset('API:tests:forever', {'a': 1}, tags=('API:tests',))
+        self.assertEqual(self.cache.db.ttl('TAG:API:tests'), -1)
+
+    def test_remove_pattern_key(self):
+        CachedView.as_view()(self.factory.get('/cached/'))
+        self.cache.remove_pattern_key('API:tests:*')
+        self.assertEqual(list(self.cache.db.scan_iter('API:tests:*')), [])
+
+    def test_remove_model_key(self):
+        CachedView.as_view()(self.factory.get('/cached/'))
+        self.cache.set_key('User:all', [1, 2], 60)
+
+        self.assertEqual(self.cache.remove_key(User), 2)
+        self.assertFalse(self.cache.is_exists('User:all'))
+        self.assertEqual(list(self.cache.db.scan_iter('API:tests:*')), [])
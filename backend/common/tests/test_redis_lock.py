@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import redis
+from common.cache import (
+    AsyncCacheLock,
+    AsyncCacheManagement,
+    CacheLock,
+    CacheManagement,
+    LockTimeout,
+)
+from django.test import TestCase
+
+
+class CacheLockTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement()
+
+    def tearDown(self):
+        self.cache.remove_pattern_key('lock_tests:*')
+
+    def test_only_the_owner_releases(self):
+        lock = CacheLock(self.cache, 'tests:owner', expire=1000)
+        other = CacheLock(self.cache, 'tests:owner', expire=1000)
+
+        self.assertTrue(lock.accrue())
+        self.assertFalse(other.accrue())
+        self.assertFalse(other.release())
+        self.assertFalse(lock.is_ready())
+
+        self.assertTrue(lock.release())
+        self.assertTrue(lock.is_ready())
+
+    def test_wait_in_a_batch(self):
+        lock = CacheLock(self.cache, 'tests:batch', expire=1000)
+        lock.accrue()
+
+        with self.cache.batch():
+            self.assertFalse(lock.is_ready())
+            self.assertFalse(lock.wait(timeout=0.05))
+
+        lock.release()
+        with self.cache.batch():
+            self.assertTrue(lock.is_ready())
+            self.assertTrue(lock.wait(timeout=0.05))
+
+    def test_expired_lock_is_not_released_by_the_old_owner(self):
+        lock = CacheLock(self.cache, 'tests:expired', expire=20)
+        lock.accrue()
+        time.sleep(0.05)
+
+        other = CacheLock(self.cache, 'tests:expired', expire=1000)
+        self.assertTrue(other.accrue())
+        self.assertFalse(lock.release())
+        self.assertFalse(other.is_ready())
+
+    def test_blocking_acquire(self):
+        lock = CacheLock(self.cache, 'tests:blocking', expire=1000)
+        lock.accrue()
+        threading.Timer(0.05, lock.release).start()
+
+        other = CacheLock(self.cache, 'tests:blocking', timeout=1)
+        started = time.monotonic()
+        self.assertTrue(other.acquire())
+        self.assertLess(time.monotonic() - started, 0.5)
+        other.release()
+
+    def test_acquire_timeout(self):
+        CacheLock(self.cache, 'tests:timeout', expire=1000).accrue()
+
+        with self.assertRaises(LockTimeout):
+            with CacheLock(self.cache, 'tests:timeout', timeout=0.05):
+                self.fail('the lock is held')
+
+    def test_redis_errors_are_raised(self):
+        lock = CacheLock(self.cache, 'tests:down')
+        with patch.object(
+            type(self.cache.db), 'set', side_effect=redis.ConnectionError('down')
+        ):
+            with self.assertRaises(redis.ConnectionError):
+                lock.acquire()
+
+        with self.assertRaises(ValueError):
+            CacheLock(self.cache, 'tests:renew', expire=None, renew=True)
+
+    def test_watchdog_renews_the_lease(self):
+        with CacheLock(self.cache, 'tests:renew', expire=90, renew=True) as lock:
+            time.sleep(0.2)
+            self.assertFalse(lock.is_ready())
+
+        self.assertTrue(lock.is_ready())
+
+    def test_async_lock(self):
+        async def run():
+            cache = AsyncCacheManagement()
+            async with AsyncCacheLock(cache, 'tests:async', expire=90, renew=True):
+                await asyncio.sleep(0.2)
+                held = await AsyncCacheLock(cache, 'tests:async').accrue()
+            return held, await AsyncCacheLock(cache, 'tests:async').is_ready()
+
+        self.assertEqual(asyncio.run(run()), (False, True))
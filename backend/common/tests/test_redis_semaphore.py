@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from common.cache import (
+    AsyncCacheManagement,
+    AsyncCacheSemaphore,
+    CacheManagement,
+    CacheSemaphore,
+    LockTimeout,
+    provider_semaphore,
+)
+from django.test import TestCase
+
+
+class CacheSemaphoreTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement()
+
+    def tearDown(self):
+        self.cache.remove_pattern_key('semaphore:{tests*')
+
+    def semaphore(self, **options):
+        return CacheSemaphore(self.cache, 'tests', **{'limit': 2, **options})
+
+    def test_limit(self):
+        first, second, third = self.semaphore(), self.semaphore(), self.semaphore()
+
+        self.assertTrue(first.accrue())
+        self.assertTrue(second.accrue())
+        self.assertFalse(third.acquire(blocking=False))
+        self.assertEqual(first.available(), 0)
+
+        self.assertTrue(first.release())
+        self.assertFalse(first.release())
+        self.assertTrue(third.accrue())
+
+    def test_waiters_are_served_in_order(self):
+        holders = [self.semaphore(), self.semaphore()]
+        for holder in holders:
+            holder.accrue()
+        early, late = self.semaphore(), self.semaphore()
+        self.assertFalse(early.accrue())
+
+        holders[0].release()
+        # the slot is kept for the waiter that came first
+        self.assertFalse(late.accrue())
+        self.assertTrue(early.accrue())
+
+    def test_expired_lease_frees_the_slot(self):
+        self.semaphore(limit=1, expire=30).accrue()
+        self.assertTrue(self.semaphore(limit=1, timeout=1).acquire())
+
+    def test_timeout_leaves_the_queue(self):
+        holder = self.semaphore(limit=1)
+        holder.accrue()
+
+        with self.assertRaises(LockTimeout):
+            with self.semaphore(limit=1, timeout=0.05):
+                self.fail('the slot is held')
+
+        holder.release()
+        self.assertTrue(self.semaphore(limit=1).accrue())
+
+    def test_watchdog_renews_the_lease(self):
+        with self.semaphore(limit=1, expire=90, renew=True) as semaphore:
+            time.sleep(0.2)
+            self.assertEqual(semaphore.available(), 0)
+
+        self.assertEqual(semaphore.available(), 1)
+
+    def test_async_semaphore(self):
+        async def run():
+            cache = AsyncCacheManagement()
+            async with AsyncCacheSemaphore(cache, 'tests', limit=1) as semaphore:
+                other = AsyncCacheSemaphore(cache, 'tests', limit=1, timeout=0.05)
+                waited = await other.acquire()
+            return waited, await semaphore.available()
+
+        self.assertEqual(asyncio.run(run()), (False, 1))
+
+    def test_provider_semaphore(self):
+        semaphore = provider_semaphore('kavenegar', timeout=1)
+
+        self.assertEqual(semaphore.limit, 4)
+        self.assertEqual(semaphore.timeout, 1)
+        self.assertEqual(semaphore.keys[0], 'semaphore:{provider:kavenegar}:holders')
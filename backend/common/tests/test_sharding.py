@@ -0,0 +1,49 @@
+import redis
+from common.cache.sharding import HashRing, ShardedRedis, hash_tag
+from common.tests import requires_redis
+from django.test import TestCase
+
+
+@requires_redis
+class ShardingTests(TestCase):
+    def setUp(self):
+        self.nodes = [redis.Redis(db=db, decode_responses=True) for db in (2, 3)]
+        self.client = ShardedRedis(self.nodes, ['node-a', 'node-b'])
+
+    def tearDown(self):
+        self.client.flushdb()
+
+    def test_hash_tags(self):
+        self.assertEqual(hash_tag('user:{42}:cart'), b'42')
+        self.assertEqual(hash_tag('user:{}:cart'), b'user:{}:cart')
+
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = {ring.get_node(f'user:{{42}}:{name}') for name in range(20)}
+        self.assertEqual(len(nodes), 1)
+
+    def test_ring_moves_few_keys(self):
+        keys = [f'key:{index}' for index in range(2000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = sum(before.get_node(key) != after.get_node(key) for key in keys)
+        self.assertLess(moved, len(keys) * 0.35)
+
+    def test_keys_are_spread_over_nodes(self):
+        keys = [f'tests:shard:{index}' for index in range(50)]
+        for key in keys:
+            self.client.set(key, key)
+
+        self.assertTrue(all(node.dbsize() for node in self.nodes))
+        self.assertEqual(self.client.get('tests:shard:7'), 'tests:shard:7')
+        self.assertEqual(len(self.client.keys('tests:shard:*')), 50)
+        self.assertEqual(self.client.unlink(*keys), 50)
+
+    def test_pipeline_keeps_order(self):
+        pipe = self.client.pipeline(transaction=False)
+        for index in range(10):
+            pipe.set(f'tests:shard:{index}', index)
+        pipe.unlink(*(f'tests:shard:{index}' for index in range(5)))
+        pipe.get('tests:shard:9')
+
+        self.assertEqual(pipe.execute(), [True] * 10 + [5, '9'])
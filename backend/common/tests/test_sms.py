@@ -0,0 +1,46 @@
+from common.metrics import registry
+from common.sms import RetryBudget, SMSClient
+from common.sms.fake import FakeSMSProvider
+from django.conf import settings
+from django.test import TestCase
+
+
+class SMSClientTests(TestCase):
+    def setUp(self):
+        self.provider = FakeSMSProvider().start()
+        self.client = SMSClient(url=self.provider.url, api_key='tests')
+
+    def tearDown(self):
+        self.client.close()
+        self.provider.stop()
+
+    def test_connections_are_reused(self):
+        for index in range(5):
+            self.assertTrue(self.client.send('+989123456789', f'message {index}'))
+
+        self.assertEqual(len(self.provider.messages), 5)
+        self.assertEqual(self.provider.connections, 1)
+        self.assertEqual(self.provider.messages[0]['sender'], settings.SMS_SENDER)
+
+    def test_transient_errors_are_retried(self):
+        self.provider.fail(503, 429)
+
+        self.assertTrue(self.client.send('+989123456789', 'hello'))
+        self.assertEqual(len(self.provider.messages), 1)
+        self.assertIn('sms_request_seconds_count{result="retry"}', registry.render())
+
+    def test_rejected_messages_are_not_retried(self):
+        self.provider.fail(400)
+
+        self.assertFalse(self.client.send('+989123456789', 'hello'))
+        self.assertTrue(self.client.send('+989123456789', 'hello'))
+        self.assertEqual(len(self.provider.messages), 1)
+
+    def test_retry_budget(self):
+        self.client.budget = RetryBudget(ratio=0.5, minimum=0)
+        self.provider.fail(503, 503)
+
+        # half a retry per call: the first call is retried once, not twice
+        self.assertFalse(self.client.send('+989123456789', 'first'))
+        self.assertTrue(self.client.send('+989123456789', 'second'))
+        self.assertEqual(self.provider.messages[0]['message'], 'second')
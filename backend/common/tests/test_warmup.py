@@ -0,0 +1,50 @@
+import time
+from io import StringIO
+
+from common.cache import CacheManagement
+from common.cache.warmup import warm_up
+from common.tests.views import WarmupView
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+
+@override_settings(ROOT_URLCONF='common.tests.views')
+class WarmupTests(TestCase):
+    def setUp(self):
+        self.cache = CacheManagement()
+        self.cache.invalidate_tags('API:tests')
+        WarmupView.calls = 0
+
+    def tearDown(self):
+        self.cache.invalidate_tags('API:tests')
+
+    def test_endpoints_are_warmed_up(self):
+        statuses = warm_up(['tests'], workers=2, rate=None)
+
+        self.assertEqual(statuses, {200: 4})
+        self.assertEqual(WarmupView.calls, 4)
+        self.assertEqual(len(list(self.cache.db.scan_iter('API:tests:*'))), 4)
+
+        response = WarmupView.as_view()(APIRequestFactory().get('/warmup/1/'), pk=1)
+        self.assertIs(type(response), HttpResponse)
+        self.assertEqual(WarmupView.calls, 4)
+
+    def test_force_regenerates_entries(self):
+        warm_up(['tests'], rate=None)
+        warm_up(['tests'], rate=None)
+        self.assertEqual(WarmupView.calls, 4)
+
+        warm_up(['tests'], rate=None, force=True)
+        self.assertEqual(WarmupView.calls, 8)
+
+    def test_rate_is_limited(self):
+        started = time.monotonic()
+        warm_up(['tests'], workers=4, rate=20)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('warm_cache', 'tests', '--rate', '0', stdout=out)
+        self.assertIn('200: 4', out.getvalue())
@@ -0,0 +1,67 @@
+from common.cache import ApiCache, Policy, RateLimit, by_field, by_ip, by_subnet
+from django.urls import path
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from user.models import User
+
+
+def counted_view(decorator, method: str = 'get') -> type:
+    """
+    Return an APIView whose `method` (wrapped by `decorator`) counts its
+    calls in `View.calls`
+    """
+
+    class View(APIView):
+        calls = 0
+
+    def handler(self, request, **kwargs):
+        View.calls += 1
+        return Response({'calls': View.calls, **kwargs})
+
+    setattr(View, method, decorator(handler))
+    return View
+
+
+CachedView = counted_view(
+    ApiCache(identifier='tests', ttl=60, tags=(User, 'tests:{user_id}'))
+)
+
+SoftCachedView = counted_view(
+    ApiCache(identifier='tests', ttl=60, soft_ttl=1, lock_wait=0)
+)
+
+VaryCachedView = counted_view(
+    ApiCache(
+        identifier='tests',
+        ttl=60,
+        vary_on_user=True,
+        vary_on_language=True,
+        vary_on_headers=('X-Platform',),
+    )
+)
+
+WarmupView = counted_view(
+    ApiCache(
+        identifier='tests',
+        ttl=60,
+        warmup=lambda: [f'/warmup/{pk}/' for pk in range(3)] + ['/warmup/9/?page=2'],
+    )
+)
+
+LimitedView = counted_view(RateLimit(rate=2, window=60, freeze=120, local=False))
+
+FloodedView = counted_view(RateLimit(rate=2, window=60, local=True))
+
+OTPView = counted_view(
+    RateLimit(
+        policies=(
+            Policy('ip', 3, 60, by_ip()),
+            Policy('phone_number', 2, 60, by_field('phone_number'), freeze=120),
+            Policy('subnet', 4, 60, by_subnet()),
+        ),
+        local=False,
+    ),
+    method='post',
+)
+
+urlpatterns = [path('warmup/<int:pk>/', WarmupView.as_view())]
@@ -3,6 +3,7 @@ import logging
 import re
 from uuid import uuid4
 
+from common.cache.lookup import lookup_cache
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -18,16 +19,26 @@ User = get_user_model()
 logger = logging.getLogger(__name__)
 
 
+def _get_object(model_or_queryset, **kwargs):
+    try:
+        return get_object_or_404(model_or_queryset, **kwargs)
+    except Http404:
+        return None
+
+
 def get_object(model_or_queryset, **kwargs):
     """
     Reuse get_object_or_404 since the implementation supports both Model
     && queryset.
     Catch Http404 & return None
+    Lookups of the models in REDIS_LOOKUP_CACHE_MODELS are cached
     """
-    try:
-        return get_object_or_404(model_or_queryset, **kwargs)
-    except Http404:
-        return None
+    if isinstance(model_or_queryset, ModelBase) and lookup_cache.enabled_for(
+        model_or_queryset
+    ):
+        return lookup_cache.get(model_or_queryset, _get_object, **kwargs)
+
+    return _get_object(model_or_queryset, **kwargs)
 
 
 def get_query(model: ModelBase, **kwargs):
@@ -38,6 +38,8 @@ INSTALLED_APPS = [*DJANGO_APPS, *LOCAL_APPS, *THIRD_PARTY_APPS]
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     "corsheaders.middleware.CorsMiddleware",
+    'common.cache.middleware.RateLimitMiddleware',
+    'common.cache.middleware.CacheBatchMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -97,8 +99,6 @@ USE_TZ = True
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-KAVEH_NEGAR_API_KEY = env("KAVEH_NEGAR_API_KEY", default="change_me")
-
 # RestFrameWork Settings
 from core.third.drf import *  # noqa
 
@@ -108,6 +108,9 @@ from core.third.email import *  # noqa
 # Logging Settings
 from core.third.logging import *  # noqa
 
+# Metrics Settings
+from core.third.metrics import *  # noqa
+
 # Rate Limit Settings
 from core.third.rate_limit import *  # noqa
 
@@ -117,6 +120,9 @@ from core.third.redis_cache import *  # noqa
 # JWT Token Settings
 from core.third.simple_jwt import *  # noqa
 
+# SMS Provider Settings
+from core.third.sms import *  # noqa
+
 # Drf Spectacular
 from core.third.spectacular import *  # noqa
 
@@ -0,0 +1,13 @@
+from core.django.base import env
+
+# Expose in-process metrics (Prometheus text format) on /api/v1/metrics/
+METRICS_ENABLED = env.bool('METRICS_ENABLED', default=False)
+
+# Who may read them: a scraper sending "Authorization: Bearer <METRICS_TOKEN>"
+# or a peer (REMOTE_ADDR, not X-Forwarded-For) in one of METRICS_ALLOWED_IPS,
+# e.g. 10.0.0.0/8,127.0.0.1. Nobody when both are empty.
+METRICS_TOKEN = env.str('METRICS_TOKEN', default='')
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=[])
+
+# Share of Redis commands whose latency is recorded (0 to 1)
+REDIS_METRICS_SAMPLE_RATE = env.float('REDIS_METRICS_SAMPLE_RATE', default=1.0)
@@ -1,8 +1,41 @@
+from core.django.base import env
+
 # Rate limit Settings
 
 RATELIMIT_RATE_TWITTER = "3/m"
 RATELIMIT_KEY = "user"
 
+# Algorithm of RateLimit: fixed_window, sliding_log, sliding_window (counter)
+# or gcra
+RATELIMIT_ALGORITHM = "fixed_window"
+
+# In-process token bucket in front of the Redis limit, it sheds the requests
+# of a flooding client without a round trip (per process and decorator)
+RATELIMIT_LOCAL_ENABLED = True
+RATELIMIT_LOCAL_MAX_KEYS = 10000
+
+# Allow the requests when Redis fails (the local limiter still sheds floods)
+RATELIMIT_FAIL_OPEN = True
+
+# Limits of RateLimitMiddleware, checked by the client IP before the request
+# is authenticated or its body is parsed. The first route whose `path` regex
+# (and method) matches the request is applied, the other options are passed
+# to RateLimit. The auth route only stops floods, it is well above the
+# limits of the OTP views, which still apply.
+RATELIMIT_MIDDLEWARE_ENABLED = True
+RATELIMIT_AUTH_ROUTE_RATE = env.int('RATELIMIT_AUTH_ROUTE_RATE', default=30)
+RATELIMIT_AUTH_ROUTE_WINDOW = env.int('RATELIMIT_AUTH_ROUTE_WINDOW', default=60)
+RATELIMIT_AUTH_ROUTE_FREEZE = env.int('RATELIMIT_AUTH_ROUTE_FREEZE', default=300)
+RATELIMIT_ROUTES = {
+    "auth": {
+        "path": r"^/api/v1/auth/",
+        "methods": ["POST"],
+        "rate": RATELIMIT_AUTH_ROUTE_RATE,
+        "window": RATELIMIT_AUTH_ROUTE_WINDOW,
+        "freeze": RATELIMIT_AUTH_ROUTE_FREEZE,
+    },
+}
+
 RATELIMIT_NEWSLETTER_RATE = 3
 RATELIMIT_NEWSLETTER_WINDOW = 60  # 1 minute
 
@@ -13,6 +46,15 @@ RATELIMIT_USER_RATE = 3
 RATELIMIT_USER_WINDOW = 60  # 1 minute
 RATELIMIT_USER_FREEZE = 300  # 5 minute
 
+# Policies of the OTP request, evaluated together: per client IP, per phone
+# number, per /24 subnet of the client and the SMS sent to everyone
+RATELIMIT_OTP_PHONE_RATE = 3
+RATELIMIT_OTP_PHONE_WINDOW = 60 * 10  # 10 minute
+RATELIMIT_OTP_SUBNET_RATE = 20
+RATELIMIT_OTP_SUBNET_WINDOW = 60  # 1 minute
+RATELIMIT_OTP_GLOBAL_RATE = 300
+RATELIMIT_OTP_GLOBAL_WINDOW = 60  # 1 minute
+
 RATELIMIT_SEARCH_RATE = 2
 RATELIMIT_SEARCH_WINDOW = 1
 RATELIMIT_SEARCH_FREEZE = 60  # 1 minute
@@ -10,6 +10,37 @@ REDIS_CACHE_PORT = env.int('REDIS_CACHE_PORT', default='6379')
 REDIS_CACHE_USERNAME = env("REDIS_USERNAME", default=None)
 REDIS_CACHE_PASSWORD = env("REDIS_PASSWORD", default=None)
 
+# Topology of the cache servers:
+#   single: one server with numbered databases (REDIS_CACHE_HOST)
+#   sharded: keys spread over REDIS_CACHE_NODES by consistent hashing
+#   cluster: a Redis Cluster started from REDIS_CACHE_NODES (only db 0)
+#   memory: in the memory of the process, for tests and benchmarks
+# A `{tag}` in a key routes it by the tag, to keep related keys together.
+REDIS_CACHE_MODE = env('REDIS_CACHE_MODE', default='single')
+REDIS_CACHE_NODES = env.list('REDIS_CACHE_NODES', default=[])  # host:port
+REDIS_CACHE_SHARD_REPLICAS = 160  # points of every node on the hash ring
+
+# Connection pools (per database and process). A caller waits up to
+# REDIS_POOL_TIMEOUT seconds for a free connection when the pool is full.
+# The socket timeouts are the deadline of every command, keep them short so
+# a slow server can not pin the workers.
+REDIS_POOL_MAX_CONNECTIONS = env.int('REDIS_POOL_MAX_CONNECTIONS', default=50)
+REDIS_POOL_TIMEOUT = env.float('REDIS_POOL_TIMEOUT', default=1)
+REDIS_SOCKET_TIMEOUT = env.float('REDIS_SOCKET_TIMEOUT', default=0.5)
+REDIS_SOCKET_CONNECT_TIMEOUT = env.float('REDIS_SOCKET_CONNECT_TIMEOUT', default=0.5)
+REDIS_HEALTH_CHECK_INTERVAL = env.int('REDIS_HEALTH_CHECK_INTERVAL', default=30)
+
+# Circuit breaker per server: after REDIS_BREAKER_FAILURES connection errors
+# or timeouts in a row commands fail at once (CircuitOpenError) for
+# REDIS_BREAKER_RESET_TIMEOUT seconds, then one probe is let through.
+# Features degrade on errors: RateLimit fails open (RATELIMIT_FAIL_OPEN),
+# ApiCache and the lookup cache call the view / database and the OTP views
+# answer 503.
+REDIS_BREAKER_ENABLED = env.bool('REDIS_BREAKER_ENABLED', default=True)
+REDIS_BREAKER_FAILURES = 5
+REDIS_BREAKER_RESET_TIMEOUT = 10  # seconds
+REDIS_API_CACHE_FAIL_OPEN = True
+
 # Redis DB definition
 REDIS_CACHE_DB_COUNT = 2
 REDIS_CACHE_GENERAL_DB = 0
@@ -19,11 +50,95 @@ REDIS_CACHE_DJANGO_DB = 1
 REDIS_API_CACHE_PREFIX = 'API'
 REDIS_RATELIMIT_CACHE_PREFIX = 'RATELIMIT'
 REDIS_USER_VIEW_LOCK_PREFIX = 'USER_VIEW'
+REDIS_CACHE_TAG_PREFIX = 'TAG'
+REDIS_LOOKUP_CACHE_PREFIX = 'LOOKUP'
+
+# Number of keys sent in each UNLINK/SREM command
+REDIS_CACHE_DELETE_BATCH_SIZE = 500
 
 
 # Redis Expires Time
 REDIS_CACHE_LONG_TTL = 604800  # 1 week
 
+# CacheLock: default expiry of a lock and the bounds of the jittered
+# exponential backoff of a blocked acquire / wait
+REDIS_LOCK_TIMEOUT = 30000  # 30 seconds (in milliseconds)
+REDIS_LOCK_BACKOFF_MIN = 0.005  # seconds
+REDIS_LOCK_BACKOFF_MAX = 0.2  # seconds
+
+# CacheSemaphore: waiters that did not try again for this long (ms) lose
+# their place in the queue
+REDIS_SEMAPHORE_QUEUE_TTL = 2000
+
+# Concurrent calls to the external providers from all workers
+# (provider_semaphore): slots, seconds to wait for a slot and the lease of
+# a slot in milliseconds
+REDIS_PROVIDER_CONCURRENCY = {
+    'kavenegar': {
+        'limit': env.int('KAVENEGAR_CONCURRENCY', default=4),
+        'timeout': 5,
+        'expire': 15000,
+    },
+}
+
+# TaskQueue: attempts of a job before it is dead-lettered, the jittered
+# exponential delay between them (seconds) and the lease of a claimed job
+# in milliseconds, after which a job of a crashed worker runs again (keep
+# it above the longest job). With REDIS_QUEUE_LOCAL_WORKER every process
+# runs the jobs it enqueues in a thread instead of a run_queue worker.
+REDIS_QUEUE_LOCAL_WORKER = env.bool('REDIS_QUEUE_LOCAL_WORKER', default=False)
+REDIS_QUEUE_MAX_ATTEMPTS = 5
+REDIS_QUEUE_RETRY_BACKOFF = 1
+REDIS_QUEUE_RETRY_BACKOFF_MAX = 60
+REDIS_QUEUE_VISIBILITY_TIMEOUT = 60000
+REDIS_QUEUE_POLL_INTERVAL = 0.5  # seconds between polls of an idle worker
+REDIS_QUEUE_STATUS_TTL = 86400  # 1 day
+REDIS_QUEUE_DEAD_LETTER_TTL = 604800  # 1 week, since the last dead job
+
+# ApiCache regeneration lock
+REDIS_API_CACHE_LOCK_TIMEOUT = 10000  # 10 seconds (in milliseconds)
+REDIS_API_CACHE_LOCK_WAIT = 2  # seconds
+
+# Cache-Control directive of ApiCache responses, max-age is added from the TTL
+# of the entry (None disables the header)
+REDIS_API_CACHE_CONTROL = 'private'
+
+# Request header that holds the version of the client app
+# (ApiCache(vary_on_version=True))
+REDIS_API_CACHE_VERSION_HEADER = 'X-App-Version'
+
+# Short-TTL cache of get_object lookups (BaseCRUD.read) of these models
+# ("app_label.Model"), found objects are kept for REDIS_LOOKUP_CACHE_TTL
+# and missing ones for REDIS_LOOKUP_CACHE_NEGATIVE_TTL seconds. Entries are
+# invalidated on save/delete, not on queryset.update()
+REDIS_LOOKUP_CACHE_MODELS = env.list('REDIS_LOOKUP_CACHE_MODELS', default=[])
+REDIS_LOOKUP_CACHE_TTL = 60
+REDIS_LOOKUP_CACHE_NEGATIVE_TTL = 10
+
+# `manage.py warm_cache`: number of threads and requests per second
+REDIS_CACHE_WARMUP_WORKERS = 4
+REDIS_CACHE_WARMUP_RATE = 20
+
+# Encoding of cached values (json, msgpack or pickle) and compression of the
+# values bigger than the threshold in bytes (zlib or lz4).
+# msgpack and lz4 need their packages to be installed.
+REDIS_CACHE_CODEC = 'json'
+REDIS_CACHE_COMPRESSOR = 'zlib'
+REDIS_CACHE_COMPRESS_THRESHOLD = 1024
+
+# Per-process local cache in front of Redis (invalidated through pub/sub)
+REDIS_LOCAL_CACHE_ENABLED = env.bool('REDIS_LOCAL_CACHE_ENABLED', default=False)
+REDIS_LOCAL_CACHE_SIZE = 1024  # entries per database
+REDIS_LOCAL_CACHE_TTL = 30  # seconds
+REDIS_LOCAL_CACHE_CHANNEL = 'CACHE_INVALIDATION'
+# Let the servers push invalidations with RESP3 client tracking (Redis 6+)
+# instead of the pub/sub channel, for the keys starting with the prefixes
+# (all keys when empty). Best for hot keys that are rarely written.
+REDIS_LOCAL_CACHE_TRACKING = env.bool('REDIS_LOCAL_CACHE_TRACKING', default=False)
+REDIS_LOCAL_CACHE_TRACKING_PREFIXES = env.list(
+    'REDIS_LOCAL_CACHE_TRACKING_PREFIXES', default=[]
+)
+
 
 if REDIS_CACHE_USERNAME and REDIS_CACHE_PASSWORD:
     location = f"redis://{REDIS_CACHE_USERNAME}:{REDIS_CACHE_PASSWORD}@{REDIS_CACHE_HOST}:{REDIS_CACHE_PORT}/{REDIS_CACHE_DJANGO_DB}"
@@ -42,3 +157,11 @@ CACHES = {
         },
     }
 }
+
+if REDIS_CACHE_MODE == 'memory':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "TIMEOUT": 10 * 60,
+        }
+    }
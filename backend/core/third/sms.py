@@ -0,0 +1,25 @@
+from core.django.base import env
+
+# Kavenegar REST API (https://kavenegar.com/rest.html), SMS_PROVIDER_URL
+# can point at `manage.py fake_sms_provider` for local runs and benchmarks
+KAVEH_NEGAR_API_KEY = env("KAVEH_NEGAR_API_KEY", default="change_me")
+SMS_PROVIDER_URL = env.str('SMS_PROVIDER_URL', default='https://api.kavenegar.com/v1')
+SMS_SENDER = env.str('SMS_SENDER', default='2000660110')
+
+# One pooled keep-alive HTTP session per process: connections kept open to
+# the provider and the connect / read timeouts in seconds
+SMS_POOL_SIZE = env.int('SMS_POOL_SIZE', default=10)
+SMS_CONNECT_TIMEOUT = 2
+SMS_READ_TIMEOUT = 5
+
+# Attempts of one call (only connection errors, 429 and 5xx are retried),
+# the bounds of the jittered exponential backoff in seconds, and the retry
+# budget: retries are allowed for SMS_RETRY_BUDGET_RATIO of the calls of
+# the last SMS_RETRY_BUDGET_WINDOW seconds plus SMS_RETRY_BUDGET_MIN, so an
+# outage does not multiply the load on the provider
+SMS_RETRY_ATTEMPTS = 3
+SMS_RETRY_BACKOFF = 0.1
+SMS_RETRY_BACKOFF_MAX = 1
+SMS_RETRY_BUDGET_RATIO = 0.2
+SMS_RETRY_BUDGET_MIN = 10
+SMS_RETRY_BUDGET_WINDOW = 10